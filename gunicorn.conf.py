@@ -0,0 +1,46 @@
+import gc
+import os
+
+# Production server, from the repository root:
+#   gunicorn
+# The app is loaded once in the master process, which loads the qrels and the
+# run index; workers are forked from it and share that copy-on-write. New
+# runs are ingested and evaluated by a background job of a worker, on its
+# process pool (RUN_COMPARATOR_WORKERS, default: all cores). Later changes
+# are shared through runs/.snapshots and the score cache on disk, background
+# jobs through runs/.jobs.sqlite and the /metrics counts through a folder in
+# the score cache.
+
+pythonpath = "run-comparator"
+wsgi_app = "app:server"
+bind = os.environ.get("RUN_COMPARATOR_BIND", "0.0.0.0:8050")
+workers = int(os.environ.get("RUN_COMPARATOR_SERVER_WORKERS", os.cpu_count() or 1))
+threads = int(os.environ.get("RUN_COMPARATOR_SERVER_THREADS", 4))
+timeout = 300
+preload_app = True
+
+
+def when_ready(server):
+    # Runs in the master after the app is loaded, before any worker forks.
+    import app
+
+    app.preload()
+    # Keep the garbage collector from touching (and so copying) the pages of
+    # the preloaded objects in every worker.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+    from metrics import metrics
+
+    # The master's counts are in its own dump, see metrics.share.
+    metrics.reset()
+    # Every worker asks, a single job ingests and scores the runs.
+    app.warm_up()
+
+
+def worker_exit(server, worker):
+    from metrics import metrics
+
+    metrics.dump()
@@ -1,203 +1,449 @@
-import logging
+import json
+import os
+import time
+from functools import lru_cache, wraps
 
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
+import flask
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
-from dash.dependencies import Input, Output, State
-from scipy.stats import ttest_rel
+from dash.dependencies import ALL, ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
 
 import layout
-from evaluator import trec_eval
+from batch import reset_pool
+from cache import CACHE_DIR
+from evaluator import RANKING_MEASURES, parse_metric
+from folder_index import run_index
+from metrics import metrics
+from jobs import (
+    evaluation_job,
+    fusion_job,
+    overlap_job,
+    scheduler,
+    significance_job,
+    sweep_job,
+)
+from stages import (
+    PERMUTATIONS,
+    all_scores,
+    data_state,
+    missing_runs,
+    overlap_stage,
+    pairs_stage,
+    qrels_stage,
+    run_scores,
+    runs_state,
+    significance_stage,
+    topic_data,
+    topic_ranking,
+)
+from upload import upload_blueprint
 from utils import (
     files_in_folder,
-    find_relevance,
-    fuse_runs,
     mark_current_runs,
-    mark_new,
-    mark_new_text,
-    new_percentage,
-    read_qrels,
-    read_run,
     write_to_file,
 )
 
 pd.options.plotting.backend = "plotly"
 
-# temporary
-qrels_dict = read_qrels("qrels/qrels.backgroundlinking19.txt")
-pretty_metric = {"ndcg_cut_5": "NDCG@5", "ndcg_cut_10": "NDCG@10"}
+MEASURES = {
+    "ndcg_cut": "NDCG",
+    "P": "P",
+    "recall": "Recall",
+    "map_cut": "MAP",
+    "map": "MAP",
+    "recip_rank": "MRR",
+    "Rprec": "R-prec",
+}
+# MAP is cut at the cutoff or over the whole ranking, both are listed.
+METRIC_LABELS = dict(MEASURES, map="MAP (no cutoff)")
+DEFAULT_METRIC = "ndcg_cut_5"
+PAIR_LABELS = {
+    "delta": "difference of the mean",
+    "p_value": "p-value (t-test)",
+    "jaccard": "Jaccard",
+    "rbo": "rank-biased overlap",
+    "tau": "Kendall's tau",
+}
 
 external_stylesheets = ["https://codepen.io/chriddyp/pen/bWLwgP.css"]
 style_block = {"display": "inline-block", "float": "left", "margin-right": 20}
 
+# Pick up new or changed runs without a page reload.
+RUNS_POLL_MS = int(os.environ.get("RUN_COMPARATOR_POLL_MS", 5000))
+JOBS_POLL_MS = 1000
+
+# Above these sizes figures are aggregated or drawn with WebGL, so the
+# payload sent to the browser stays small for large folders.
+MAX_POINTS = int(os.environ.get("RUN_COMPARATOR_MAX_POINTS", 5000))
+MAX_BARS = int(os.environ.get("RUN_COMPARATOR_MAX_BARS", 500))
+TABLE_PAGE_SIZE = int(os.environ.get("RUN_COMPARATOR_TABLE_PAGE", 25))
+
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 app.title = "Run Comparator"
+app.server.register_blueprint(upload_blueprint)
+server = app.server  # WSGI entry point, see gunicorn.conf.py
 
-app.layout = html.Div(
-    [
-        html.Div(
-            [
-                html.P(id="placeholder"),
-                html.Div(
-                    [html.H3("TREC Run Comparator", style={"text_align": "center"})],
-                    style={
-                        "text-align": "center",
-                        "font-family": "courier,arial,helvetica",
-                    },
-                ),
-                html.Div(
-                    [
-                        dcc.Upload(
-                            id="upload-data",
-                            children=html.Div(
-                                ["Drag and Drop or ", html.A("Select Runs")]
-                            ),
-                            style={
-                                "width": "100%",
-                                "height": "60px",
-                                "lineHeight": "60px",
-                                "borderWidth": "1px",
-                                "borderStyle": "dashed",
-                                "borderRadius": "5px",
-                                "text-align": "center",
-                                "margin": "10px",
-                            },
-                            # Allow multiple files to be uploaded
-                            multiple=True,
-                        ),
-                        html.Div(
-                            id="output-data-upload",
-                            style={"display": "flex", "justify-content": "center"},
-                        ),
-                    ],
-                    style={"display": "flex", "justify-content": "center"},
-                ),
-                html.Div(
-                    [
-                        html.Div(
-                            [
-                                html.P("base"),
-                                dcc.Dropdown(
-                                    id="dropdown-run-1",
-                                    options=[
-                                        {"label": file, "value": file}
-                                        for file in files_in_folder("runs")
-                                    ],
-                                    value=files_in_folder("runs")[0],
-                                    style={"width": 180},
-                                ),
-                            ],
-                            style=style_block,
-                        ),
-                        html.Div(
-                            [
-                                html.P("alternative"),
-                                dcc.Dropdown(
-                                    id="dropdown-run-2",
-                                    options=[
-                                        {"label": file, "value": file}
-                                        for file in files_in_folder("runs")
-                                    ],
-                                    value=files_in_folder("runs")[1],
-                                    style={"width": 180},
-                                ),
-                            ],
-                            style=style_block,
-                        ),
-                        html.Div(
-                            [
-                                html.P("create new run"),
-                                html.Button("fuse", id="merge-runs", n_clicks=0),
-                            ],
-                            style=style_block,
-                        ),
-                        html.Div(
-                            [
-                                html.P("qrels"),
-                                dcc.Dropdown(
-                                    id="dropdown-qrels",
-                                    options=[
-                                        {"label": file, "value": file}
-                                        for file in files_in_folder("qrels")
-                                    ],
-                                    value=files_in_folder("qrels")[0],
-                                    style={"width": 300},
-                                ),
-                            ],
-                            style=style_block,
-                        ),
-                        html.Div(
-                            [
-                                html.P("metric"),
-                                dcc.Dropdown(
-                                    id="dropdown-metric",
-                                    options=[
-                                        {"label": "NDCG@5", "value": "ndcg_cut_5"},
-                                        {"label": "NDCG@10", "value": "ndcg_cut_10"},
-                                    ],
-                                    value="ndcg_cut_5",
-                                    style={"width": 180},
-                                ),
-                            ],
-                            style=style_block,
-                        ),
-                        html.Div(
-                            [
-                                html.P("topic"),
-                                dcc.Dropdown(
-                                    id="dropdown-topic",
-                                    options=[
-                                        {"label": topic, "value": topic}
-                                        for topic in qrels_dict.keys()
-                                    ],
-                                    value=list(qrels_dict.keys())[0],
-                                    style={"width": 180},
+
+@app.server.route("/metrics")
+def prometheus_metrics():
+    return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.server.before_request
+def start_request_timer():
+    flask.g.start = time.perf_counter()
+
+
+@app.server.after_request
+def stop_request_timer(response):
+    # Includes serializing the figures, which happens after the callback.
+    if flask.request.path == "/_dash-update-component":
+        seconds = time.perf_counter() - flask.g.start
+        metrics.observe("update_request_seconds", seconds)
+    return response
+
+
+@app.server.after_request
+def share_metrics(response):
+    # For /metrics of the other server processes, see metrics.py.
+    metrics.dump(every=1.0)
+    return response
+
+
+def timed(func):
+    # Callback latency with a breakdown per stage, see metrics.py.
+    return metrics.callback(func, expected=(PreventUpdate,))
+
+
+@lru_cache(maxsize=256)
+def _cached_figure(build, args, state):
+    return json.loads(build(*args).to_json())
+
+
+def cached_figure(build):
+    # Figures as JSON-ready dicts, cached on the callback inputs and the
+    # state of the qrels file and runs folder they are computed from.
+    @wraps(build)
+    def wrapper(qrels, *args):
+        if qrels is None:
+            raise PreventUpdate
+        return _cached_figure(build, (qrels,) + args, data_state(qrels))
+
+    return wrapper
+
+
+metrics.register_cache("figure", _cached_figure)
+
+
+@lru_cache(maxsize=None)
+def figure_template():
+    # Plotly's default look, for the figures drawn in the browser.
+    return json.loads(go.Figure().to_json())["layout"]["template"]
+
+
+def serve_layout():
+    # Built on every page load from the folder index, so the dropdowns list
+    # the current runs and qrels. Topics are filled in by a callback.
+    runs = run_index.runs()
+    qrels = files_in_folder("qrels")
+    return html.Div(
+        [
+            html.Div(
+                [
+                    html.P(id="placeholder"),
+                    dcc.Interval(id="runs-interval", interval=RUNS_POLL_MS),
+                    html.Div(
+                        [
+                            html.H3(
+                                "TREC Run Comparator", style={"text_align": "center"}
+                            )
+                        ],
+                        style={
+                            "text-align": "center",
+                            "font-family": "courier,arial,helvetica",
+                        },
+                    ),
+                    html.Div(
+                        [
+                            dcc.Upload(
+                                id="upload-data",
+                                children=html.Div(
+                                    ["Drag and Drop or ", html.A("Select Runs")]
                                 ),
-                            ],
-                            style=style_block,
-                        ),
-                    ],
-                    style={
-                        "width": "100%",
-                        "display": "flex",
-                        "align-items": "center",
-                        "justify-content": "center",
-                    },
-                ),
-                html.Div(
-                    [
-                        dcc.Graph(
-                            id="graph",
-                            config={"displayModeBar": False, "displaylogo": False},
-                        ),
-                        dcc.Graph(
-                            id="ranking",
-                            config={"displayModeBar": False, "displaylogo": False},
-                        ),
-                    ],
-                    style={"display": "flex", "justify-content": "center"},
-                ),
-                html.Div(
-                    [
-                        dcc.Graph(
-                            id="graph-boxplot",
-                            config={"displayModeBar": False, "displaylogo": False},
-                        ),
-                        dcc.Graph(
-                            id="table",
-                            config={"displayModeBar": False, "displaylogo": False},
-                        ),
-                    ],
-                    style={"display": "flex", "justify-content": "center"},
-                ),
-            ],
-        )
-    ],
-    style={"height": "100%"},
-)
+                                style={
+                                    "width": "100%",
+                                    "height": "60px",
+                                    "lineHeight": "60px",
+                                    "borderWidth": "1px",
+                                    "borderStyle": "dashed",
+                                    "borderRadius": "5px",
+                                    "text-align": "center",
+                                    "margin": "10px",
+                                },
+                                # Allow multiple files to be uploaded
+                                multiple=True,
+                            ),
+                            html.Div(
+                                id="output-data-upload",
+                                style={"display": "flex", "justify-content": "center"},
+                            ),
+                        ],
+                        style={"display": "flex", "justify-content": "center"},
+                    ),
+                    html.Div(
+                        [
+                            # Large runs, streamed in chunks by assets/upload.js
+                            html.Button("stream large runs", id="upload-stream"),
+                            html.P(
+                                id="upload-stream-status", style={"margin-left": 10}
+                            ),
+                        ],
+                        style={
+                            "display": "flex",
+                            "align-items": "center",
+                            "justify-content": "center",
+                        },
+                    ),
+                    html.Div(
+                        [
+                            html.Div(
+                                [
+                                    html.P("base"),
+                                    dcc.Dropdown(
+                                        id="dropdown-run-1",
+                                        options=[
+                                            {"label": file, "value": file}
+                                            for file in runs
+                                        ],
+                                        value=runs[0] if runs else None,
+                                        style={"width": 180},
+                                    ),
+                                ],
+                                style=style_block,
+                            ),
+                            html.Div(
+                                [
+                                    html.P("alternative"),
+                                    dcc.Dropdown(
+                                        id="dropdown-run-2",
+                                        options=[
+                                            {"label": file, "value": file}
+                                            for file in runs
+                                        ],
+                                        value=runs[1] if len(runs) > 1 else None,
+                                        style={"width": 180},
+                                    ),
+                                ],
+                                style=style_block,
+                            ),
+                            html.Div(
+                                [
+                                    html.P("create new run"),
+                                    html.Button("fuse", id="merge-runs", n_clicks=0),
+                                    html.Button("sweep", id="sweep-runs", n_clicks=0),
+                                ],
+                                style=style_block,
+                            ),
+                            html.Div(
+                                [
+                                    html.P("whole folder"),
+                                    html.Button(
+                                        "evaluate", id="evaluate-runs", n_clicks=0
+                                    ),
+                                ],
+                                style=style_block,
+                            ),
+                            html.Div(
+                                [
+                                    html.P("qrels"),
+                                    dcc.Dropdown(
+                                        id="dropdown-qrels",
+                                        options=[
+                                            {"label": file, "value": file}
+                                            for file in qrels
+                                        ],
+                                        value=qrels[0] if qrels else None,
+                                        style={"width": 300},
+                                    ),
+                                ],
+                                style=style_block,
+                            ),
+                            html.Div(
+                                [
+                                    html.P("metric"),
+                                    dcc.Dropdown(
+                                        id="dropdown-metric",
+                                        options=[
+                                            {"label": label, "value": measure}
+                                            for measure, label in METRIC_LABELS.items()
+                                        ],
+                                        value="ndcg_cut",
+                                        clearable=False,
+                                        style={"width": 180},
+                                    ),
+                                ],
+                                style=style_block,
+                            ),
+                            html.Div(
+                                [
+                                    html.P("cutoff"),
+                                    dcc.Input(
+                                        id="metric-cutoff",
+                                        type="number",
+                                        min=1,
+                                        value=5,
+                                        style={"width": 80},
+                                    ),
+                                ],
+                                style=style_block,
+                            ),
+                            dcc.Store(id="metric", data=DEFAULT_METRIC),
+                            dcc.Store(id="topic-data"),
+                            dcc.Store(id="ranking-page-data"),
+                            dcc.Store(id="figure-template", data=figure_template()),
+                            html.Div(
+                                [
+                                    html.P("p-value correction"),
+                                    dcc.Dropdown(
+                                        id="dropdown-correction",
+                                        options=[
+                                            {"label": "none", "value": ""},
+                                            {"label": "Holm", "value": "holm"},
+                                            {
+                                                "label": "Benjamini-Hochberg",
+                                                "value": "bh",
+                                            },
+                                        ],
+                                        value="",
+                                        clearable=False,
+                                        style={"width": 180},
+                                    ),
+                                ],
+                                style=style_block,
+                            ),
+                            html.Div(
+                                [
+                                    html.P("table page"),
+                                    dcc.Input(
+                                        id="table-page",
+                                        type="number",
+                                        min=1,
+                                        value=1,
+                                        style={"width": 80},
+                                    ),
+                                ],
+                                style=style_block,
+                            ),
+                            html.Div(
+                                [
+                                    html.P("topic"),
+                                    dcc.Dropdown(
+                                        id="dropdown-topic",
+                                        options=[],
+                                        style={"width": 180},
+                                    ),
+                                ],
+                                style=style_block,
+                            ),
+                            html.Div(
+                                [
+                                    html.P("ranking page"),
+                                    dcc.Input(
+                                        id="ranking-page",
+                                        type="number",
+                                        min=1,
+                                        value=1,
+                                        style={"width": 80},
+                                    ),
+                                ],
+                                style=style_block,
+                            ),
+                        ],
+                        style={
+                            "width": "100%",
+                            "display": "flex",
+                            "align-items": "center",
+                            "justify-content": "center",
+                        },
+                    ),
+                    # Background jobs (fusion, bulk evaluation, significance)
+                    dcc.Interval(id="jobs-interval", interval=JOBS_POLL_MS),
+                    html.P(id="jobs-cancelled", style={"display": "none"}),
+                    # Redraws the figures over all runs as they are evaluated.
+                    dcc.Store(id="scores-state"),
+                    html.Div(
+                        id="jobs-panel",
+                        style={"display": "flex", "justify-content": "center"},
+                    ),
+                    html.Div(
+                        [
+                            dcc.Graph(
+                                id="graph",
+                                config={"displayModeBar": False, "displaylogo": False},
+                            ),
+                            dcc.Graph(
+                                id="ranking",
+                                config={"displayModeBar": False, "displaylogo": False},
+                            ),
+                        ],
+                        style={"display": "flex", "justify-content": "center"},
+                    ),
+                    html.Div(
+                        [
+                            dcc.Graph(
+                                id="graph-boxplot",
+                                config={"displayModeBar": False, "displaylogo": False},
+                            ),
+                            dcc.Graph(
+                                id="table",
+                                config={"displayModeBar": False, "displaylogo": False},
+                            ),
+                        ],
+                        style={"display": "flex", "justify-content": "center"},
+                    ),
+                    # All pairs of runs
+                    html.Div(
+                        [
+                            html.P("compare all runs by", style={"margin-right": 10}),
+                            dcc.Dropdown(
+                                id="pairs-measure",
+                                options=[
+                                    {"label": label, "value": column}
+                                    for column, label in PAIR_LABELS.items()
+                                ],
+                                value="delta",
+                                clearable=False,
+                                style={"width": 220},
+                            ),
+                        ],
+                        style={
+                            "display": "flex",
+                            "align-items": "center",
+                            "justify-content": "center",
+                        },
+                    ),
+                    html.Div(
+                        [
+                            dcc.Graph(
+                                id="pairs-heatmap",
+                                config={"displayModeBar": False, "displaylogo": False},
+                            ),
+                        ],
+                        style={"display": "flex", "justify-content": "center"},
+                    ),
+                ],
+            )
+        ],
+        style={"height": "100%"},
+    )
+
+
+app.layout = serve_layout
 
 
 @app.callback(
@@ -206,6 +452,7 @@ app.layout = html.Div(
     State("upload-data", "filename"),
     State("upload-data", "last_modified"),
 )
+@timed
 def update_output(list_of_contents, list_of_names, list_of_dates):
     success = False
     if list_of_contents is not None:
@@ -214,243 +461,639 @@ def update_output(list_of_contents, list_of_names, list_of_dates):
         return layout.succeed_button()
 
 
+def metric_cutoff(metric):
+    # Depth of the ranking and overlap views: the metric's cutoff, else 10.
+    return parse_metric(metric)[1] or 10
+
+
+def pretty_metric(metric):
+    name, k = parse_metric(metric)
+    return f"{MEASURES[name]}@{k}" if k else MEASURES[name]
+
+
+@app.callback(
+    Output("metric", "data"),
+    Input("dropdown-metric", "value"),
+    Input("metric-cutoff", "value"),
+)
+@timed
+def update_metric(measure, cutoff):
+    # The cutoff applies to NDCG, P, recall and MAP (map_cut); MRR, R-prec
+    # and MAP without a cutoff (map) are over the whole ranking.
+    if measure is None:
+        raise PreventUpdate
+    if measure in RANKING_MEASURES:
+        return measure
+    if not cutoff or cutoff < 1:
+        raise PreventUpdate
+    return f"{measure}_{int(cutoff)}"
+
+
+def run_color(run, run1, run2):
+    if run == run2:
+        return "rgb(239, 85, 59)"
+    if run == run1:
+        return "rgb(99, 110, 250)"
+    return "rgb(0, 0, 0)"
+
+
+def box_statistics(df):
+    # Box plot statistics of every column, as plotly computes them from the
+    # points: linear quartiles and whiskers at 1.5 IQR. Columns are named
+    # after the go.Box arguments.
+    q1, median, q3 = (df.quantile(q) for q in (0.25, 0.5, 0.75))
+    iqr = q3 - q1
+    inside = df.where(df.ge(q1 - 1.5 * iqr) & df.le(q3 + 1.5 * iqr))
+    return pd.DataFrame(
+        {
+            "q1": q1,
+            "median": median,
+            "q3": q3,
+            "lowerfence": inside.min(),
+            "upperfence": inside.max(),
+            "mean": df.mean(),
+        }
+    )
+
+
+@app.callback(
+    Output("dropdown-run-1", "options"),
+    Output("dropdown-run-2", "options"),
+    Output("dropdown-run-1", "value"),
+    Output("dropdown-run-2", "value"),
+    Input("runs-interval", "n_intervals"),
+    Input("output-data-upload", "children"),
+    State("dropdown-run-1", "options"),
+    State("dropdown-run-1", "value"),
+    State("dropdown-run-2", "value"),
+    State("dropdown-qrels", "value"),
+    State("metric", "data"),
+)
+@timed
+def update_run_options(n_intervals, upload, current, run1, run2, qrels, metric):
+    run_index.refresh()
+    runs = run_index.runs()
+    options = [{"label": file, "value": file} for file in runs]
+    if options == current:
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+
+    # Evaluate new runs in the background before the overview asks for them.
+    if qrels:
+        submit_evaluation(metric, qrels)
+
+    # Select runs once the index knows them (e.g. on the first start).
+    if run1 not in runs:
+        run1 = runs[0] if runs else None
+    if run2 not in runs:
+        run2 = runs[1] if len(runs) > 1 else run1
+    return options, options, run1, run2
+
+
+@app.callback(
+    Output("dropdown-topic", "options"),
+    Output("dropdown-topic", "value"),
+    Input("dropdown-qrels", "value"),
+    State("dropdown-topic", "value"),
+)
+@timed
+def update_topic_options(qrels, top):
+    if qrels is None:
+        raise PreventUpdate
+    topics = list(qrels_stage(qrels).topics)
+    if not topics:
+        return [], None
+    if top not in topics:
+        top = topics[0]
+    return [{"label": topic, "value": topic} for topic in topics], top
+
+
 @app.callback(
     Output("graph", "figure"),
-    Output("ranking", "figure"),
-    Output("graph-boxplot", "figure"),
-    Output("table", "figure"),
     [
         Input("dropdown-qrels", "value"),
         Input("dropdown-run-1", "value"),
         Input("dropdown-run-2", "value"),
-        Input("dropdown-metric", "value"),
-        Input("dropdown-topic", "value"),
+        Input("metric", "data"),
     ],
 )
-def update_graphs(qrels, run1, run2, metric, top):
-    global qrels_dict
-
-    df_a = trec_eval(metric, "qrels/" + qrels, run1)
-    df_b = trec_eval(metric, "qrels/" + qrels, run2)
+@timed
+@cached_figure
+def update_topic_graph(qrels, run1, run2, metric):
+    if None in (qrels, run1, run2):
+        raise PreventUpdate
+    df_a = run_scores(metric, qrels, run1)
+    df_b = run_scores(metric, qrels, run2)
     df = pd.concat([df_a, df_b], axis=1)
     df = df.sort_values(run1, ascending=False)
 
-    # ranking
-    ranking_1 = read_run("runs/" + run1)
-    ranking_2 = read_run("runs/" + run2)
-
-    df_dict_a = {}
-    for topic in ranking_1.keys():
-        df_dict_a[topic] = pd.DataFrame(ranking_1[topic], columns=["docid"])
-        df_dict_a[topic][run1] = df_dict_a[topic]["docid"].apply(
-            lambda x: find_relevance(x, qrels_dict[topic])
+    with metrics.span("figure"):
+        # ndcg plot
+        if len(df) <= MAX_BARS:
+            fig_a = df.plot.bar(barmode="group")
+        else:
+            # WebGL markers instead of thousands of SVG bars.
+            fig_a = go.Figure(
+                [
+                    go.Scattergl(x=df.index, y=df.iloc[:, i], mode="markers", name=run)
+                    for i, run in enumerate(df.columns)
+                ]
+            )
+            fig_a.update_xaxes(type="category")
+        fig_a.update_layout(
+            plot_bgcolor="white",
+            yaxis_title=pretty_metric(metric),
+            xaxis_title="Topic",
+            title=(
+                f"{pretty_metric(metric)}: {df_a[run1].mean():.4f}"
+                f"({df_a[run1].median():.4f}) & {df_b[run2].mean():.4f}"
+                f" ({df_b[run2].median():.4f})"
+            ),
+            title_x=0.5,
         )
+    return fig_a
 
-    df_dict_b = {}
-    for topic in ranking_2.keys():
-        df_dict_b[topic] = pd.DataFrame(ranking_2[topic], columns=["docid"])
-        df_dict_b[topic][run2] = df_dict_b[topic]["docid"].apply(
-            lambda x: find_relevance(x, qrels_dict[topic])
-        )
 
-    # merge dataframes
-    df_dict = {}
-    df_dict[top] = df_dict_a[top].merge(
-        df_dict_b[top], left_index=True, right_index=True
-    )
+@app.callback(
+    Output("topic-data", "data"),
+    [
+        Input("dropdown-qrels", "value"),
+        Input("dropdown-run-1", "value"),
+        Input("dropdown-run-2", "value"),
+        Input("metric", "data"),
+    ],
+)
+@timed
+def update_topic_data(qrels, run1, run2, metric):
+    # The first ranking page of every topic, so switching topics happens in
+    # the browser (ranking.figure in assets/ranking.js).
+    if None in (qrels, run1, run2):
+        raise PreventUpdate
+    n = metric_cutoff(metric)
+    data = topic_data(metric, qrels, run1, run2, n)
+    return dict(data, metric=pretty_metric(metric), page_size=n)
 
-    # set n to 5 if @5 or 10 if @10:
-    total = 1
-    n = int("".join(filter(str.isdigit, metric)))
-    block_size = total / n
-
-    # ndcg plot
-    fig_a = df.plot.bar(barmode="group")
-    fig_a.update_layout(
-        plot_bgcolor="white",
-        yaxis_title=pretty_metric[metric],
-        xaxis_title="Topic",
-        title=(
-            f"{pretty_metric[metric]}: {df_a[run1].mean():.4f}"
-            f"({df_a[run1].median():.4f}) & {df_b[run2].mean():.4f}"
-            f" ({df_b[run2].median():.4f})"
-        ),
-        title_x=0.5,
-    )
 
-    # ranking annotations docids (should be put in separate function)
-    y1 = df_dict[top][run1].values
-    y2 = df_dict[top][run2].values
-
-    xcoord = df_dict[top].iloc[0:n].index  # [0,1,2]
-
-    annotations1 = [
-        dict(
-            x=8,  # xi-0.2,
-            y=xi - (total / 5) + (5 / 30),
-            text=df_dict[top]["docid_x"].iloc[xi],
-            xanchor="auto",
-            yanchor="bottom",
-            showarrow=False,
-            font={"size": block_size * 75, "color": "grey"},
-        )
-        for xi, yi in zip(xcoord, y1)
+@app.callback(
+    Output("ranking-page-data", "data"),
+    [
+        Input("dropdown-qrels", "value"),
+        Input("dropdown-run-1", "value"),
+        Input("dropdown-run-2", "value"),
+        Input("metric", "data"),
+        Input("dropdown-topic", "value"),
+        Input("ranking-page", "value"),
+    ],
+)
+@timed
+def update_ranking_page(qrels, run1, run2, metric, top, page):
+    # Deeper pages of the selected topic, read from the topic index of both
+    # runs. Ranks start:stop, deeper pages read deeper in the topic.
+    if None in (qrels, run1, run2, top):
+        raise PreventUpdate
+    page = max(page or 1, 1)
+    if page == 1:
+        return None
+    n = metric_cutoff(metric)
+    (base, base_grades), (alt, alt_grades) = [
+        topic_ranking(qrels, run, top, page * n) for run in (run1, run2)
     ]
+    length = min(len(base), len(alt))
+    start = min((page - 1) * n, max(length - 1, 0) // n * n)
+    stop = min(page * n, length)
+    return {
+        "runs": [run1, run2],
+        "topic": top,
+        "page": page,
+        "page_size": n,
+        "start": start,
+        "docids": [list(base[start:stop]), list(alt[start:stop])],
+        "grades": [base_grades[start:stop].tolist(), alt_grades[start:stop].tolist()],
+        "new": (~np.isin(alt[start:stop], base[:stop])).tolist(),
+    }
 
-    annotations2 = [
-        dict(
-            x=8,
-            y=xi + (total / 5) + (5 / 30),
-            text=mark_new_text(
-                df_dict[top]["docid_y"].iloc[xi],
-                df_dict[top]["docid_x"].iloc[0:n],
-            ),
-            xanchor="auto",
-            yanchor="bottom",
-            showarrow=False,
-            font={
-                "size": block_size * 75,
-                "color": mark_new(
-                    df_dict[top]["docid_y"].iloc[xi], df_dict[top]["docid_x"].iloc[0:n]
-                ),
-            },
-        )
-        for xi, yi in zip(xcoord, y2)
-    ]
 
-    annotations = annotations1 + annotations2
-
-    # ranking plot
-    fig_b = df_dict[top].iloc[0:n].plot.barh(x=[run1, run2], barmode="group")
-    fig_b.update_layout(
-        plot_bgcolor="white",
-        yaxis={
-            "tickmode": "array",
-            "tickvals": np.arange(n),
-            "ticktext": np.arange(1, n + 1),
-            "autorange": "reversed",
-        },
-        title=f"{pretty_metric[metric]}: {df_a[run1].loc[top]} & {df_b[run2].loc[top]}",
-        title_x=0.5,
-        yaxis_title="Rank",
-        xaxis={"range": [0, 16], "fixedrange": True},
-        xaxis_title="Relevance",
-        annotations=annotations,
-    )
+app.clientside_callback(
+    ClientsideFunction(namespace="ranking", function_name="figure"),
+    Output("ranking", "figure"),
+    Input("topic-data", "data"),
+    Input("ranking-page-data", "data"),
+    Input("dropdown-topic", "value"),
+    Input("ranking-page", "value"),
+    State("figure-template", "data"),
+)
 
-    df_all = pd.DataFrame()
-    for file in files_in_folder("runs"):
-        try:
-            df_tmp = trec_eval(metric, "qrels/" + qrels, file)
-            df_all = pd.concat([df_all, df_tmp], axis=1)
-        except Exception as e:
-            logging.info(f"{file} is not a TREC run. --> {e}")
-            continue
+
+@app.callback(
+    Output("graph-boxplot", "figure"),
+    [
+        Input("dropdown-qrels", "value"),
+        Input("dropdown-run-1", "value"),
+        Input("dropdown-run-2", "value"),
+        Input("metric", "data"),
+        Input("scores-state", "data"),
+    ],
+)
+@timed
+@cached_figure
+def update_boxplot(qrels, run1, run2, metric, scored):
+    if None in (qrels, run1, run2):
+        raise PreventUpdate
+    df_all = scored_runs(metric, qrels)
 
     medians = df_all.median().sort_values()
-    medians_desc = df_all.median().sort_values(ascending=False)
 
-    traces = []
-    for run_name, run_data in df_all[medians.index].iteritems():
-        color = "rgb(0, 0, 0)"
-        if run_name == run1:
-            color = "rgb(99, 110, 250)"
-        if run_name == run2:
-            color = "rgb(239, 85, 59)"
-        traces.append(
-            go.Box(
-                y=run_data,
-                name=run_name,
-                boxpoints="all",
-                jitter=0.5,
-                whiskerwidth=0.2,
-                marker=dict(size=2, color=color),
-                line=dict(width=1),
+    with metrics.span("figure"):
+        traces = []
+        if df_all.count().sum() <= MAX_POINTS:
+            for run_name, run_data in df_all[medians.index].items():
+                traces.append(
+                    go.Box(
+                        y=run_data,
+                        name=run_name,
+                        boxpoints="all",
+                        jitter=0.5,
+                        whiskerwidth=0.2,
+                        marker=dict(size=2, color=run_color(run_name, run1, run2)),
+                        line=dict(width=1),
+                    )
+                )
+        else:
+            # Send the statistics instead of every point, one trace per color.
+            stats = box_statistics(df_all[medians.index])
+            colors = pd.Series(
+                [run_color(run, run1, run2) for run in stats.index], stats.index
             )
+            for color, part in stats.groupby(colors, sort=False):
+                traces.append(
+                    go.Box(
+                        x=part.index,
+                        whiskerwidth=0.2,
+                        marker=dict(color=color),
+                        line=dict(width=1),
+                        **part,
+                    )
+                )
+
+        fig_box = go.Figure(data=traces)
+        fig_box.update_xaxes(categoryorder="array", categoryarray=medians.index)
+        fig_box.update_layout(
+            plot_bgcolor="white",
+            title="Overview",
+            title_x=0.5,
+            yaxis_title=pretty_metric(metric),
+            showlegend=False,
         )
+    return fig_box
+
 
-    fig_box = go.Figure(data=traces)
-    fig_box.update_layout(
-        plot_bgcolor="white",
-        title="Overview",
-        title_x=0.5,
-        yaxis_title=pretty_metric[metric],
-        showlegend=False,
+@app.callback(
+    Output("table", "figure"),
+    [
+        Input("dropdown-qrels", "value"),
+        Input("dropdown-run-1", "value"),
+        Input("dropdown-run-2", "value"),
+        Input("metric", "data"),
+        Input("dropdown-correction", "value"),
+        Input("table-page", "value"),
+        Input("scores-state", "data"),
+    ],
+)
+@timed
+@cached_figure
+def update_table(qrels, run1, run2, metric, correction, page, scored):
+    if None in (qrels, run1, run2):
+        raise PreventUpdate
+    # Scores and tests of the same runs, even if a job adds some meanwhile.
+    state = runs_state()
+    df_all = scored_runs(metric, qrels, state)
+    if run1 not in df_all:
+        # Tested against the base run once it is evaluated.
+        raise PreventUpdate
+    tests = significance_stage(
+        metric, qrels, run1, correction or None, df_all=df_all, state=state
     )
+    medians_desc = df_all.median().sort_values(ascending=False)
 
-    headerColor = "grey"
-
-    fig_table = go.Figure(
-        data=[
-            go.Table(
-                header=dict(
-                    values=[
-                        "<b>run</b>",
-                        f"<b>percentage new in top {n} (relative to base)</b>",
-                        f"<b>{pretty_metric[metric]} (mean : median)</b>",
-                        "<b>p-value (H0: Equal average with base)</b>",
-                    ],
-                    line_color="darkslategray",
-                    fill_color=headerColor,
-                    align=["left", "center"],
-                    font=dict(color="white", size=12),
-                ),
-                cells=dict(
-                    values=[
-                        df_all[medians_desc.index].columns,
-                        [
-                            "{:.2f}%".format(
-                                new_percentage(ranking_1, read_run("runs/" + file), n)
-                            )
-                            for file in df_all[medians_desc.index].columns
+    # One page of the ranking, so the table stays small for large folders.
+    pages = max(1, -(-len(medians_desc) // TABLE_PAGE_SIZE))
+    page = min(max(page or 1, 1), pages)
+    medians_desc = medians_desc.iloc[
+        (page - 1) * TABLE_PAGE_SIZE : page * TABLE_PAGE_SIZE
+    ]
+    n = metric_cutoff(metric)
+    overlap_summary, compare = overlap_stage(run1, n, state=state)
+    if compare:
+        # Filled in by a job, the table redraws when it is done.
+        scheduler.submit(
+            "overlap",
+            overlap_job,
+            run1,
+            n,
+            description=f"compare runs with {run1} (top {n})",
+        )
+
+    with metrics.span("figure"):
+        headerColor = "grey"
+
+        fig_table = go.Figure(
+            data=[
+                go.Table(
+                    header=dict(
+                        values=[
+                            "<b>run</b>",
+                            f"<b>percentage new in top {n} (relative to base)</b>",
+                            f"<b>Jaccard@{n}</b>",
+                            f"<b>RBO@{n}</b>",
+                            f"<b>Kendall's tau@{n}</b>",
+                            f"<b>{pretty_metric(metric)} (mean : median)</b>",
+                            "<b>p-value (H0: Equal average with base)</b>",
+                            f"<b>p-value (permutation, {PERMUTATIONS})</b>",
+                            "<b>95% CI of difference with base</b>",
                         ],
-                        [
-                            (
-                                f"{round(np.mean(df_all[run]), 4):.4f} : "
-                                f"{round(np.median(df_all[run]), 4):.4f}"
-                            )
-                            for run in df_all[medians_desc.index].columns
+                        line_color="darkslategray",
+                        fill_color=headerColor,
+                        align=["left", "center"],
+                        font=dict(color="white", size=12),
+                    ),
+                    cells=dict(
+                        values=[
+                            df_all[medians_desc.index].columns,
+                            [
+                                "{:.2f}%".format(overlap_summary.loc[file, "new"])
+                                for file in df_all[medians_desc.index].columns
+                            ],
+                            *[
+                                [
+                                    f"{overlap_summary.loc[file, column]:.4f}"
+                                    for file in df_all[medians_desc.index].columns
+                                ]
+                                for column in ["jaccard", "rbo", "tau"]
+                            ],
+                            [
+                                (
+                                    f"{round(np.mean(df_all[run]), 4):.4f} : "
+                                    f"{round(np.median(df_all[run]), 4):.4f}"
+                                )
+                                for run in df_all[medians_desc.index].columns
+                            ],
+                            [
+                                f"{tests.loc[col, 'p_ttest']:.4f}"
+                                if col != run1
+                                else "X"
+                                for col in df_all[medians_desc.index].columns
+                            ],
+                            [
+                                f"{tests.loc[col, 'p_permutation']:.4f}"
+                                if col != run1
+                                else "X"
+                                for col in df_all[medians_desc.index].columns
+                            ],
+                            [
+                                (
+                                    f"[{tests.loc[col, 'ci_low']:.4f}, "
+                                    f"{tests.loc[col, 'ci_high']:.4f}]"
+                                )
+                                if col != run1
+                                else "X"
+                                for col in df_all[medians_desc.index].columns
+                            ],
                         ],
-                        [
-                            f"{ttest_rel(df_a, df_all[col])[1][0]:.4f}"
-                            if col != run1
-                            else "X"
-                            for col in df_all[medians_desc.index].columns
+                        line_color="darkslategray",
+                        fill_color=[
+                            [
+                                mark_current_runs(run1, run2, run)
+                                for run in df_all[medians_desc.index].columns
+                            ]
                         ],
-                    ],
-                    line_color="darkslategray",
-                    fill_color=[
-                        [
-                            mark_current_runs(run1, run2, run)
-                            for run in df_all[medians_desc.index].columns
-                        ]
-                    ],
-                    align=["left", "center"],
-                    font=dict(color="darkslategray", size=11),
-                ),
-            )
-        ]
-    )
-    fig_table.update_layout(
-        plot_bgcolor="white",
-        title="Table",
-        title_x=0.5,
-        yaxis_title=pretty_metric[metric],
-    )
+                        align=["left", "center"],
+                        font=dict(color="darkslategray", size=11),
+                    ),
+                )
+            ]
+        )
+        fig_table.update_layout(
+            plot_bgcolor="white",
+            title="Table" if pages == 1 else f"Table (page {page} of {pages})",
+            title_x=0.5,
+            yaxis_title=pretty_metric(metric),
+        )
 
-    return fig_a, fig_b, fig_box, fig_table
+    return fig_table
+
+
+@app.callback(
+    Output("pairs-heatmap", "figure"),
+    [
+        Input("dropdown-qrels", "value"),
+        Input("dropdown-run-1", "value"),
+        Input("metric", "data"),
+        Input("pairs-measure", "value"),
+        Input("scores-state", "data"),
+    ],
+)
+@timed
+@cached_figure
+def update_pairs_heatmap(qrels, run1, metric, measure, scored):
+    if None in (qrels, measure):
+        raise PreventUpdate
+    n = metric_cutoff(metric)
+    # Best run first, the base run's row is outlined.
+    order = scored_runs(metric, qrels).mean().sort_values(ascending=False).index
+    matrix = pairs_stage(metric, qrels, n)[measure]
+    matrix = matrix.reindex(index=order, columns=order)
+
+    if measure == "delta":
+        colors = dict(colorscale="RdBu", zmid=0)
+        title = f"{pretty_metric(metric)} of the column run minus the row run"
+    elif measure == "p_value":
+        colors = dict(colorscale="Viridis", zmin=0, zmax=1)
+        title = f"p-value (t-test) of {pretty_metric(metric)}"
+    else:
+        colors = dict(colorscale="Blues")
+        title = f"{PAIR_LABELS[measure]} of the top {n}"
+
+    with metrics.span("figure"):
+        fig = go.Figure(
+            go.Heatmap(
+                z=matrix.values,
+                x=matrix.columns,
+                y=matrix.index,
+                hovertemplate="%{y} / %{x}: %{z:.4f}<extra></extra>",
+                **colors,
+            )
+        )
+        if run1 in matrix.index:
+            row = matrix.index.get_loc(run1)
+            fig.add_shape(
+                type="rect",
+                xref="paper",
+                x0=0,
+                x1=1,
+                y0=row - 0.5,
+                y1=row + 0.5,
+                line=dict(color=run_color(run1, run1, None), width=2),
+            )
+        fig.update_yaxes(autorange="reversed")
+        fig.update_layout(
+            plot_bgcolor="white",
+            title=title,
+            title_x=0.5,
+            width=900,
+            height=min(max(500, 20 * len(matrix) + 200), 1200),
+        )
+    return fig
 
 
 @app.callback(
     Output("placeholder", "children"),
-    [Input("merge-runs", "n_clicks")],
+    [
+        Input("merge-runs", "n_clicks"),
+        Input("sweep-runs", "n_clicks"),
+        Input("evaluate-runs", "n_clicks"),
+    ],
     State("dropdown-run-1", "value"),
     State("dropdown-run-2", "value"),
+    State("dropdown-qrels", "value"),
+    State("metric", "data"),
+    State("dropdown-correction", "value"),
 )
-def start_fusion(clicks, run1, run2):
-    if clicks > 0:
-        fuse_runs(run1, run2)
+@timed
+def start_jobs(
+    fuse_clicks, sweep_clicks, evaluate_clicks, run1, run2, qrels, metric, correction
+):
+    triggered = [t["prop_id"] for t in dash.callback_context.triggered]
+    if "merge-runs.n_clicks" in triggered and fuse_clicks > 0:
+        scheduler.submit(
+            "fusion", fusion_job, (run1, run2), description=f"fuse {run1} + {run2}"
+        )
+    if "sweep-runs.n_clicks" in triggered and sweep_clicks > 0:
+        scheduler.submit(
+            "sweep",
+            sweep_job,
+            (run1, run2),
+            metric,
+            qrels,
+            description=f"sweep fusions of {run1} + {run2} on {pretty_metric(metric)}",
+        )
+    if "evaluate-runs.n_clicks" in triggered and evaluate_clicks > 0:
+        submit_evaluation(metric, qrels)
+        scheduler.submit(
+            "significance",
+            significance_job,
+            metric,
+            qrels,
+            run1,
+            correction or None,
+            description=f"test runs against {run1}",
+        )
+
+
+def scored_runs(metric, qrels, state=None):
+    # Scores of the runs evaluated so far. The others are left to the
+    # evaluation job, the figures redraw as it scores them (scores-state).
+    df_all = all_scores(metric, qrels, state=state)
+    if missing_runs(df_all):
+        submit_evaluation(metric, qrels)
+    return df_all
+
+
+@app.callback(
+    Output("scores-state", "data"),
+    Input("jobs-interval", "n_intervals"),
+    State("scores-state", "data"),
+)
+@timed
+def update_scores_state(n_intervals, current):
+    # Polled by every open page, so only versions: the figures recompute
+    # when a job finishes or the run index changes.
+    state = f"{scheduler.version()} {run_index.version}"
+    if state == current:
+        raise PreventUpdate
+    return state
+
+
+def submit_evaluation(metric, qrels):
+    scheduler.submit(
+        "evaluation",
+        evaluation_job,
+        metric,
+        qrels,
+        description=f"evaluate runs ({pretty_metric(metric)}, {qrels})",
+    )
+
+
+@app.callback(
+    Output("jobs-panel", "children"),
+    Input("jobs-interval", "n_intervals"),
+    Input("jobs-cancelled", "children"),
+)
+@timed
+def update_jobs(n_intervals, cancelled):
+    return [
+        html.Div(
+            [
+                html.Span(
+                    f"{job.description}: {job.status}"
+                    + (f" {job.progress:.0%} {job.message}" if job.active else "")
+                    + (f" ({job.error})" if job.error else ""),
+                    style={"margin-right": 10},
+                ),
+                html.Button(
+                    "cancel",
+                    id={"type": "cancel-job", "index": job.id},
+                    style={"display": "inline" if job.active else "none"},
+                ),
+            ],
+            style={"margin": 5},
+        )
+        for job in scheduler.list()
+    ]
+
+
+@app.callback(
+    Output("jobs-cancelled", "children"),
+    Input({"type": "cancel-job", "index": ALL}, "n_clicks"),
+)
+@timed
+def cancel_job(clicks):
+    for t in dash.callback_context.triggered:
+        if t["value"]:
+            job_id = json.loads(t["prop_id"].rsplit(".", 1)[0])["index"]
+            scheduler.cancel(job_id)
+            return job_id
+    return dash.no_update
+
+
+def warm_up():
+    # Runs next to the server, which starts listening right away. Every
+    # gunicorn worker asks, the shared job table keeps it to one job, which
+    # ingests new runs (see jobs.evaluation_job) and scores them.
+    qrels = files_in_folder("qrels")
+    if qrels:
+        submit_evaluation(DEFAULT_METRIC, qrels[0])
+    else:
+        run_index.refresh()
+
+
+def preload():
+    # Load in the gunicorn master before it forks the workers, which then
+    # share the qrels and the run index. Runs are read from their snapshots
+    # when first used; new files and scoring are left to the workers'
+    # warm-up job (see gunicorn.conf.py).
+    metrics.share(os.path.join(CACHE_DIR, "metrics"))
+    scheduler.reset()
+    for file in files_in_folder("qrels"):
+        qrels_stage(file)
+    run_index.refresh(notify=False)
+    # Plotly loads its validators on the first figure, ~0.5 s.
+    go.Figure([go.Bar(), go.Box(), go.Scattergl(), go.Table(), go.Heatmap()]).to_json()
+    figure_template()
+    # Workers start their own evaluation pools, if any.
+    reset_pool()
+    metrics.dump()
 
 
 if __name__ == "__main__":
+    scheduler.reset()
+    warm_up()
     app.run_server(host="0.0.0.0")
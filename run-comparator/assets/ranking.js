@@ -0,0 +1,132 @@
+// Ranking view of one topic. The first page of every topic is in the
+// topic-data store (see update_topic_data in app.py), so switching topics
+// needs no request to the server; deeper pages are in ranking-page-data.
+const BASE_COLOR = "#636efa";
+const ALT_COLOR = "#EF553B";
+
+function formatScore(score) {
+    // As Python prints floats (1.0, nan).
+    if (score === null) {
+        return "nan";
+    }
+    return Number.isInteger(score) ? score.toFixed(1) : String(score);
+}
+
+function firstPage(data, t) {
+    // Ranks 0:n of topic t from the topic-data store, limited to the ranks
+    // both runs have.
+    const base = data.rankings[0][t];
+    const alt = data.rankings[1][t];
+    const length = Math.min(base.length, alt.length);
+    return {
+        start: 0,
+        docids: [base, alt].map((ranking) =>
+            ranking.slice(0, length).map((i) => data.docids[i])
+        ),
+        grades: data.grades.map((grades) => grades[t].slice(0, length)),
+        new: data.new[t].slice(0, length),
+    };
+}
+
+function rankingFigure(data, shown, t, template) {
+    // shown: one page of the ranking, from firstPage or update_ranking_page.
+    const [run1, run2] = data.runs;
+    const n = data.page_size;
+    const start = shown.start;
+    const stop = start + shown.docids[0].length;
+    const ranks = [];
+    for (let i = start; i < stop; i++) {
+        ranks.push(i);
+    }
+    const size = 75 / n;
+    const annotation = (y, text, color) => ({
+        x: 8,
+        y: y,
+        text: text,
+        xanchor: "auto",
+        yanchor: "bottom",
+        showarrow: false,
+        font: {size: size, color: color},
+    });
+    const annotations = ranks
+        .map((i) => annotation(i - 1 / 5 + 5 / 30, shown.docids[0][i - start], "grey"))
+        .concat(
+            ranks.map((i) => {
+                const docid = shown.docids[1][i - start];
+                const isNew = shown.new[i - start];
+                return annotation(
+                    i + 1 / 5 + 5 / 30,
+                    isNew ? docid + " <b>(new)</b>" : docid,
+                    isNew ? "green" : "grey"
+                );
+            })
+        );
+
+    const bar = (run, grades, color) => ({
+        type: "bar",
+        orientation: "h",
+        name: run,
+        legendgroup: run,
+        offsetgroup: run,
+        alignmentgroup: "True",
+        showlegend: true,
+        marker: {color: color},
+        x: ranks.map((i) => grades[i - start]),
+        y: ranks,
+        hovertemplate: "variable=" + run + "<br>value=%{x}<br>index=%{y}<extra></extra>",
+    });
+
+    let title =
+        data.metric + ": " + formatScore(data.scores[0][t]) + " & " + formatScore(data.scores[1][t]);
+    if (start) {
+        title += " (ranks " + (start + 1) + "-" + stop + ")";
+    }
+    return {
+        data: [
+            bar(run1, shown.grades[0], BASE_COLOR),
+            bar(run2, shown.grades[1], ALT_COLOR),
+        ],
+        layout: {
+            template: template,
+            barmode: "group",
+            legend: {title: {text: "variable"}, tracegroupgap: 0},
+            margin: {t: 60},
+            plot_bgcolor: "white",
+            title: {text: title, x: 0.5},
+            yaxis: {
+                tickmode: "array",
+                tickvals: ranks,
+                ticktext: ranks.map((i) => i + 1),
+                autorange: "reversed",
+                title: {text: "Rank"},
+            },
+            xaxis: {range: [0, 16], fixedrange: true, title: {text: "Relevance"}},
+            annotations: annotations,
+        },
+    };
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    ranking: {
+        figure: function (data, pageData, topic, page, template) {
+            const t = data ? data.topics.indexOf(topic) : -1;
+            if (t < 0) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            if (Math.max(page || 1, 1) === 1) {
+                return rankingFigure(data, firstPage(data, t), t, template);
+            }
+            // Deeper pages come from the server, wait for the one asked for.
+            if (
+                !pageData ||
+                pageData.topic !== topic ||
+                pageData.page !== page ||
+                pageData.page_size !== data.page_size ||
+                pageData.runs.join("\n") !== data.runs.join("\n")
+            ) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            return rankingFigure(data, pageData, t, template);
+        },
+    },
+});
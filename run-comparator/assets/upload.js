@@ -0,0 +1,58 @@
+// Chunked, resumable upload of large runs to /upload/<name>.
+const CHUNK_SIZE = 4 * 1024 * 1024;
+
+function setUploadStatus(text) {
+    const status = document.getElementById("upload-stream-status");
+    if (status) {
+        status.textContent = text;
+    }
+}
+
+async function uploadRun(file) {
+    const url = "/upload/" + encodeURIComponent(file.name);
+    let offset = (await (await fetch(url)).json()).offset;
+
+    while (offset < file.size) {
+        const chunk = file.slice(offset, offset + CHUNK_SIZE);
+        const response = await fetch(url + "?offset=" + offset, {
+            method: "POST",
+            body: chunk,
+        });
+        const result = await response.json();
+        if (response.status === 400) {
+            throw new Error(result.error);
+        }
+        // 409 means the server has a different offset, resume from there.
+        offset = result.offset;
+        setUploadStatus(file.name + ": " + Math.floor((100 * offset) / file.size) + "%");
+    }
+
+    const response = await fetch(url + "/complete", {method: "POST"});
+    const result = await response.json();
+    if (!response.ok) {
+        throw new Error(result.error);
+    }
+    setUploadStatus(file.name + ": done");
+}
+
+async function uploadRuns(files) {
+    for (const file of files) {
+        try {
+            await uploadRun(file);
+        } catch (error) {
+            setUploadStatus(error.message);
+        }
+    }
+}
+
+// The button is rendered by Dash, so listen on the document.
+document.addEventListener("click", (event) => {
+    if (event.target.id !== "upload-stream") {
+        return;
+    }
+    const input = document.createElement("input");
+    input.type = "file";
+    input.multiple = true;
+    input.addEventListener("change", () => uploadRuns(input.files));
+    input.click();
+});
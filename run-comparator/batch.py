@@ -0,0 +1,89 @@
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+
+from evaluator import evaluate
+from metrics import metrics
+
+WORKERS = int(os.environ.get("RUN_COMPARATOR_WORKERS", os.cpu_count() or 1))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(workers=WORKERS):
+    # Worker processes are kept alive, so qrels stay loaded between requests.
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers)
+        return _pool
+
+
+def reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = None
+
+
+def map_jobs(func, jobs, workers=WORKERS, chunksize=1):
+    # func over the jobs, on the process pool if there is more than one of
+    # each; in process if the pool broke (e.g. a worker ran out of memory).
+    if workers > 1 and len(jobs) > 1:
+        try:
+            return list(get_pool(workers).map(func, jobs, chunksize=chunksize))
+        except BrokenProcessPool:
+            reset_pool()
+    return [func(job) for job in jobs]
+
+
+def evaluate_file(job):
+    # (run, scores, error, metrics) so one bad file does not fail the batch;
+    # the metrics of a pool worker are merged by the server process.
+    metric, qrels, run, folder, memory_mb = job
+    with metrics.capture() as captured:
+        try:
+            scores = evaluate(metric, qrels, run, folder=folder, memory_mb=memory_mb)
+            scores, error = scores[run], None
+        except Exception as e:
+            scores, error = None, str(e)
+    return run, scores, error, captured
+
+
+def score_matrix(results):
+    # Topic x run DataFrame built in a single allocation.
+    topics = sorted(set().union(*(scores.index for _, scores in results)))
+    matrix = np.full((len(topics), len(results)), np.nan)
+    index = pd.Index(topics)
+    for j, (_, scores) in enumerate(results):
+        matrix[index.get_indexer(scores.index), j] = scores.values
+    return pd.DataFrame(matrix, index=index, columns=[run for run, _ in results])
+
+
+def evaluate_folder(
+    metric, qrels, runs, workers=WORKERS, folder="runs", memory_mb=None
+):
+    # Evaluate many runs over a process pool, returns (df_all, errors). With
+    # memory_mb, each worker streams its runs within that budget.
+    jobs = [(metric, qrels, run, folder, memory_mb) for run in runs]
+    chunksize = max(1, len(jobs) // (4 * workers))
+    outcome = map_jobs(evaluate_file, jobs, workers, chunksize)
+
+    results, errors = [], {}
+    for run, scores, error, captured in outcome:
+        metrics.merge(captured)
+        if error is None:
+            results.append((run, scores))
+        else:
+            logging.info(f"{run} is not a TREC run. --> {error}")
+            metrics.inc("run_errors_total")
+            errors[run] = error
+
+    return score_matrix(results), errors
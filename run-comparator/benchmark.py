@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import synthetic
+
+# Benchmarks on synthetic data, written as JSON so runs can be compared:
+#   python run-comparator/benchmark.py --topics 1000 --depth 1000 --runs 500
+# Each step is timed on its own; a step that fails (e.g. out of memory) is
+# recorded with its error and the remaining steps still run.
+
+TREC_EVAL = os.path.abspath("trec_eval/trec_eval")
+
+
+class Benchmark:
+    def __init__(self, repeat=3):
+        self.repeat = repeat
+        self.results = []
+
+    def time(self, name, func, *args, repeat=None, **info):
+        # Run func `repeat` times, records min/median seconds and peak memory.
+        times = []
+        try:
+            for _ in range(repeat or self.repeat):
+                start = time.perf_counter()
+                result = func(*args)
+                times.append(time.perf_counter() - start)
+        except Exception as e:
+            self.results.append({"name": name, "error": f"{type(e).__name__}: {e}"})
+            print(f"{name:40} failed: {e}", file=sys.stderr)
+            return None
+        self.results.append(
+            {
+                "name": name,
+                "min": min(times),
+                "median": statistics.median(times),
+                "repeat": len(times),
+                "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                **info,
+            }
+        )
+        print(f"{name:40} {min(times):10.4f}s", file=sys.stderr)
+        return result
+
+
+def run_benchmarks(bench, names, trec_eval, workers):
+    # Modules are imported here, after moving into the synthetic workspace:
+    # the run index and caches use paths relative to it.
+    import app
+    import stages
+    from batch import evaluate_folder, reset_pool
+    from evaluator import (
+        FAMILY,
+        evaluate_metrics,
+        evaluate_run,
+        trec_eval as run_trec_eval,
+    )
+    from folder_index import run_index
+    from fusion import fuse
+    from overlap import compare_tops
+    from qrels import parse_qrels
+    from runstore import _load_run, drop_snapshot, load_run, parse_run
+    from significance import significance
+    from sweep import sample_candidates, sweep
+    from utils import new_percentage
+
+    qrels_file = "synthetic.txt"
+    qrels_path = "qrels/" + qrels_file
+    metric = "ndcg_cut_10"
+    run1, run2 = names[0], names[min(1, len(names) - 1)]
+
+    # Parsing, and indexing the folder as the ingest job does.
+    bench.time("ingest folder", run_index.ingest, repeat=1, runs=len(names))
+    bench.time("parse qrels", parse_qrels, qrels_path)
+    bench.time("parse run (text)", parse_run, "runs/" + run1)
+
+    def load_cold():
+        drop_snapshot("runs/" + run1)
+        _load_run.cache_clear()
+        return load_run("runs/" + run1)
+
+    def load_snapshot():
+        _load_run.cache_clear()
+        return load_run("runs/" + run1)
+
+    bench.time("load run (text + snapshot)", load_cold)
+    bench.time("load run (snapshot)", load_snapshot)
+
+    # Evaluation of one run.
+    qrels = parse_qrels(qrels_path)
+    run = load_run("runs/" + run1)
+    if trec_eval:
+        bench.time("trec_eval (subprocess)", run_trec_eval, metric, qrels_path, run1)
+    bench.time("evaluate run (in-process)", evaluate_run, metric, qrels, run)
+    bench.time(
+        "evaluate metric family (in-process)",
+        evaluate_metrics,
+        FAMILY,
+        qrels,
+        run,
+        metrics=len(FAMILY),
+    )
+
+    # Evaluation of the folder, without and with the disk cache.
+    def folder():
+        df_all, errors = evaluate_folder(metric, qrels_path, names, workers)
+        return df_all
+
+    df_all = bench.time("evaluate folder (cold)", folder, repeat=1, runs=len(names))
+    bench.time("evaluate folder (cached)", folder, runs=len(names))
+
+    # Comparisons.
+    other = load_run("runs/" + run2)
+    bench.time("new_percentage top 10", new_percentage, run, other, 10)
+
+    def overlap_all():
+        # As the overlap job, from the top 10 of the topic indexes.
+        stages._top.cache_clear()
+        base = stages.top_stage(run1, 10)
+        return [compare_tops(base, stages.top_stage(name, 10)) for name in names]
+
+    bench.time("overlap with base (all runs)", overlap_all, repeat=1, runs=len(names))
+    loaded = [load_run("runs/" + name) for name in names]
+    bench.time("fusion rrf (2 runs)", fuse, [run, other])
+    bench.time(
+        "fusion combsum (all runs)", fuse, loaded, "combsum", repeat=1, runs=len(names)
+    )
+    candidates = sample_candidates(names[:3], 100, weights=[0.5, 1.0, 2.0])
+    bench.time(
+        "fusion sweep (scored in memory)",
+        sweep,
+        metric,
+        qrels_path,
+        {name: "runs/" + name for name in names[:3]},
+        candidates,
+        workers,
+        repeat=1,
+        runs=len(candidates),
+    )
+    if df_all is not None and len(names) > 1:
+        bench.time(
+            "significance",
+            significance,
+            df_all[run1],
+            df_all.drop(columns=run1),
+            10000,
+            10000,
+            repeat=1,
+            runs=len(names),
+        )
+
+    # End-to-end dashboard callbacks, on cold in-memory stages.
+    def callbacks():
+        for func in [
+            stages._run,
+            stages._run_scores,
+            stages._topic_data,
+            stages._topic_ranking,
+            stages._top,
+            stages._significance,
+            stages._pairs,
+        ]:
+            func.cache_clear()
+        stages._run_columns.clear()
+        app.update_topic_graph.__wrapped__(qrels_file, run1, run2, metric)
+        app.update_topic_data.__wrapped__(qrels_file, run1, run2, metric)
+        top = stages.qrels_stage(qrels_file).topics[0]
+        app.update_ranking_page.__wrapped__(qrels_file, run1, run2, metric, top, 2)
+        app.update_boxplot.__wrapped__(qrels_file, run1, run2, metric, None)
+        app.update_table.__wrapped__(qrels_file, run1, run2, metric, None, 1, None)
+        app.update_pairs_heatmap.__wrapped__(qrels_file, run1, metric, "delta", None)
+
+    bench.time("dashboard callbacks", callbacks, repeat=1, runs=len(names))
+    reset_pool()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark on synthetic runs.")
+    parser.add_argument("--topics", type=int, default=50)
+    parser.add_argument("--depth", type=int, default=100)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--density", type=float, default=0.3, help="judged fraction")
+    parser.add_argument(
+        "--docids", choices=synthetic.DOCID_FORMATS, default="mixed", help="format"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="keep the synthetic data here")
+    parser.add_argument("-o", "--output", help="JSON file (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output) if args.output else None
+    trec_eval = os.path.exists(TREC_EVAL)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="run-comparator-bench-")
+    os.environ["RUN_COMPARATOR_WORKERS"] = str(args.workers)
+    os.environ["RUN_COMPARATOR_CACHE"] = os.path.join(workdir, ".cache")
+
+    bench = Benchmark(args.repeat)
+    names = bench.time(
+        "generate",
+        synthetic.generate,
+        workdir,
+        args.topics,
+        args.depth,
+        args.runs,
+        args.density,
+        args.docids,
+        args.seed,
+        repeat=1,
+    )
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    if trec_eval:
+        os.makedirs("trec_eval", exist_ok=True)
+        shutil.copy(TREC_EVAL, "trec_eval/trec_eval")
+    try:
+        run_benchmarks(bench, names, trec_eval, args.workers)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "config": {
+            "topics": args.topics,
+            "depth": args.depth,
+            "runs": args.runs,
+            "density": args.density,
+            "docids": args.docids,
+            "workers": args.workers,
+            "seed": args.seed,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": bench.results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import threading
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+from metrics import metrics
+
+CACHE_DIR = os.environ.get("RUN_COMPARATOR_CACHE", ".cache")
+CACHE_MAX_BYTES = int(os.environ.get("RUN_COMPARATOR_CACHE_MB", 256)) * 2 ** 20
+
+
+def file_digest(path, chunk_size=2 ** 20):
+    # Content hash of a run or qrels file.
+    h = hashlib.blake2b(digest_size=12)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ScoreCache:
+    # On-disk cache of per-topic scores, one .npz file per
+    # (run content, qrels content, metric, depth). Entries are content
+    # addressed, so replaced files never hit stale scores. File names start
+    # with the digests of the files an entry is computed from, so the entries
+    # of a replaced file can be found and removed (see invalidate).
+
+    def __init__(self, folder=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.digests = {}  # {path: (size, mtime_ns, digest)}
+        self.total = None  # bytes in the folder, scanned on the first save
+        self.lock = threading.Lock()
+
+    def digest(self, path):
+        # Hash each file once per (size, mtime).
+        st = os.stat(path)
+        with self.lock:
+            known = self.digests.get(path)
+        if known and known[:2] == (st.st_size, st.st_mtime_ns):
+            return known[2]
+        digest = file_digest(path)
+        with self.lock:
+            self.digests[path] = (st.st_size, st.st_mtime_ns, digest)
+        return digest
+
+    def remember(self, path, size, mtime_ns, digest):
+        # Digest known from elsewhere (e.g. the folder index).
+        with self.lock:
+            self.digests[path] = (size, mtime_ns, digest)
+
+    def entry(self, run_path, qrels_path, metric, depth):
+        run, qrels = self.digest(run_path), self.digest(qrels_path)
+        return os.path.join(self.folder, f"{run}-{qrels}-{metric}-{depth}.npz")
+
+    def load(self, path):
+        # Arrays of an entry, or None if missing.
+        try:
+            with np.load(path) as data:
+                arrays = dict(data)
+        except (OSError, ValueError):
+            return None
+
+        # Mark as recently used for LRU eviction.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return arrays
+
+    def save(self, path, **arrays):
+        os.makedirs(self.folder, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        size = os.path.getsize(tmp)
+        try:
+            size -= os.path.getsize(path)
+        except OSError:
+            pass
+        os.replace(tmp, path)
+
+        # Entries written by other processes are only counted by a scan, so
+        # the folder is scanned once here and again when over the cap.
+        with self.lock:
+            if self.total is not None:
+                self.total += size
+            over = self.total is None or self.total > self.max_bytes
+        if over:
+            self.evict()
+
+    def get(self, run_path, qrels_path, metric, depth=1000):
+        arrays = self.load(self.entry(run_path, qrels_path, metric, depth))
+        if arrays is None:
+            metrics.inc("score_cache_total", kind="scores", result="miss")
+            return None
+        metrics.inc("score_cache_total", kind="scores", result="hit")
+        return pd.Series(arrays["scores"], index=arrays["topics"])
+
+    def put(self, run_path, qrels_path, metric, scores, depth=1000):
+        self.save(
+            self.entry(run_path, qrels_path, metric, depth),
+            topics=np.asarray(scores.index, dtype=str),
+            scores=np.asarray(scores.values, dtype=np.float64),
+        )
+
+    def frame_entry(self, key, digests):
+        # Derived results (e.g. significance tests) under a hashed key, after
+        # the digests of the run and qrels files they are computed from.
+        name = hashlib.blake2b(repr(key).encode(), digest_size=12).hexdigest()
+        return os.path.join(self.folder, "-".join([*digests, name]) + ".npz")
+
+    def get_frame(self, key, digests=()):
+        arrays = self.load(self.frame_entry(key, digests))
+        if arrays is None:
+            metrics.inc("score_cache_total", kind="frame", result="miss")
+            return None
+        metrics.inc("score_cache_total", kind="frame", result="hit")
+        return pd.DataFrame(
+            arrays["values"], index=arrays["index"], columns=arrays["columns"]
+        )
+
+    def put_frame(self, key, frame, digests=()):
+        self.save(
+            self.frame_entry(key, digests),
+            index=np.asarray(frame.index, dtype=str),
+            columns=np.asarray(frame.columns, dtype=str),
+            values=np.asarray(frame.values, dtype=np.float64),
+        )
+
+    def evict(self):
+        # Drop least recently used entries until under the size cap, with
+        # some room so the next saves do not scan the folder again.
+        entries = []
+        for path in glob(os.path.join(self.folder, "*.npz")):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            entries = []
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        with self.lock:
+            self.total = total
+
+    def invalidate(self, path):
+        # Forget a replaced file and drop the entries computed from it.
+        with self.lock:
+            known = self.digests.pop(path, None)
+        if known is None:
+            return
+        for pattern in (f"{known[2]}-*.npz", f"*-{known[2]}-*.npz"):
+            for entry in glob(os.path.join(self.folder, pattern)):
+                try:
+                    size = os.path.getsize(entry)
+                    os.remove(entry)
+                except OSError:
+                    continue
+                with self.lock:
+                    if self.total is not None:
+                        self.total -= size
+
+
+score_cache = ScoreCache()
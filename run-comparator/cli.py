@@ -0,0 +1,167 @@
+import argparse
+import importlib.util
+import logging
+import os
+import sys
+from glob import glob
+
+import pandas as pd
+
+from batch import WORKERS, evaluate_folder
+from fusion import METHODS, fusion_tag
+from overlap import compare_runs
+from runstore import load_run
+
+# Headless evaluation of a folder (or glob) of runs, without the dashboard:
+#   python run-comparator/cli.py runs/ --qrels qrels/*.txt -m ndcg_cut_10 -o out
+# Runs larger than memory are evaluated (and fused, --fuse) a chunk of topics
+# at a time with --memory-mb, see streaming.py.
+# Only numpy/pandas are needed; scipy is imported when significance tests
+# are asked for, dash and plotly never.
+
+
+def find_runs(patterns):
+    # Paths of run files in the given folders, globs or files.
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*")
+        for path in glob(pattern):
+            if os.path.isfile(path) and not os.path.basename(path).startswith("."):
+                paths.add(path)
+    return sorted(paths)
+
+
+def run_names(paths):
+    # Shortest unambiguous names: paths relative to the common folder.
+    if not paths:
+        return {}
+    common = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+    return {path: os.path.relpath(os.path.abspath(path), common) for path in paths}
+
+
+def write_table(df, path, fmt):
+    if fmt == "parquet":
+        df.to_parquet(f"{path}.parquet")
+    else:
+        df.to_csv(f"{path}.csv")
+
+
+def summarize(scores, qrels, metric):
+    # One row per run: mean over the topics it was evaluated on.
+    summary = pd.DataFrame({"mean": scores.mean(), "topics": scores.count()})
+    summary.index.name = "run"
+    summary.insert(0, "metric", metric)
+    summary.insert(0, "qrels", os.path.basename(qrels))
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Evaluate TREC runs against one or more qrels files."
+    )
+    parser.add_argument("runs", nargs="+", help="run files, folders or globs")
+    parser.add_argument("-q", "--qrels", nargs="+", required=True)
+    parser.add_argument(
+        "-m", "--metric", nargs="+", default=["ndcg_cut_10"], help="e.g. ndcg_cut_10"
+    )
+    parser.add_argument("-o", "--output", default="results")
+    parser.add_argument("-f", "--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS)
+    parser.add_argument("--base", help="run to test the others against")
+    parser.add_argument("--overlap", type=int, metavar="K", help="overlap at depth K")
+    parser.add_argument(
+        "--correction", choices=["holm", "bh"], help="multiple comparisons"
+    )
+    parser.add_argument("--permutations", type=int, default=10000)
+    parser.add_argument("--bootstrap", type=int, default=10000)
+    parser.add_argument(
+        "--memory-mb", type=int, help="stream runs within MB per worker"
+    )
+    parser.add_argument(
+        "--fuse", metavar="PATH", help="also write a fusion of the runs"
+    )
+    parser.add_argument("--fusion", choices=METHODS, default="rrf")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        sys.exit("Parquet output needs pyarrow (pip install pyarrow).")
+
+    names = run_names(find_runs(args.runs))
+    if not names:
+        sys.exit("No runs found.")
+    paths = {name: path for path, name in names.items()}
+    if args.base and args.base not in paths:
+        sys.exit(f"Base run {args.base} is not among the runs.")
+    os.makedirs(args.output, exist_ok=True)
+    logging.info(f"Evaluating {len(names)} runs on {args.workers} workers.")
+
+    summaries, errors = [], {}
+    for qrels in args.qrels:
+        stem = os.path.splitext(os.path.basename(qrels))[0]
+        for metric in args.metric:
+            scores, failed = evaluate_folder(
+                metric,
+                qrels,
+                list(names),
+                args.workers,
+                folder="",
+                memory_mb=args.memory_mb,
+            )
+            errors.update(failed)
+            scores = scores.rename(columns=names)
+            scores.index.name = "topic"
+            write_table(
+                scores, os.path.join(args.output, f"{stem}.{metric}"), args.format
+            )
+
+            summary = summarize(scores, qrels, metric)
+            if args.base and args.base in scores:
+                from significance import significance
+
+                tests = significance(
+                    scores[args.base],
+                    scores.drop(columns=args.base),
+                    permutations=args.permutations,
+                    bootstrap=args.bootstrap,
+                    correction=args.correction,
+                    workers=args.workers,
+                )
+                summary = summary.join(tests)
+            summaries.append(summary)
+
+    write_table(pd.concat(summaries), os.path.join(args.output, "summary"), args.format)
+
+    if args.base and args.overlap:
+        runs = {
+            name: load_run(path)
+            for name, path in paths.items()
+            if name != args.base and path not in errors
+        }
+        _, summary = compare_runs(load_run(paths[args.base]), runs, args.overlap)
+        summary.index.name = "run"
+        write_table(summary, os.path.join(args.output, "overlap"), args.format)
+
+    if args.fuse:
+        from streaming import MEMORY_MB, fuse_stream
+
+        fuse_stream(
+            [path for path in names if path not in errors],
+            args.fuse,
+            fusion_tag(args.fusion),
+            args.memory_mb or MEMORY_MB,
+            method=args.fusion,
+        )
+        logging.info(f"Wrote {args.fuse}.")
+
+    logging.info(f"Wrote {args.output}/ ({len(names) - len(errors)} runs).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+import bz2
+import io
+import lzma
+import os
+import zlib
+
+# Runs and qrels may be compressed, the format follows the file extension
+# (sample1.txt.gz). Files are decompressed as a stream of chunks straight
+# into the parser, the decompressed text is never held in memory as a whole.
+
+CHUNK_SIZE = 2 ** 20
+
+
+def zstd_decompressobj():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("Reading .zst files needs zstandard (pip install zstandard)")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+FORMATS = {
+    ".gz": lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    ".bz2": bz2.BZ2Decompressor,
+    ".xz": lzma.LZMADecompressor,
+    ".zst": zstd_decompressobj,
+}
+
+
+def compression(name):
+    # Extension of a compressed file, None for plain text.
+    ext = os.path.splitext(name)[1]
+    return ext if ext in FORMATS else None
+
+
+class Decompressor:
+    # Incremental decompression, also of concatenated streams (pigz, pbzip2).
+
+    def __init__(self, ext):
+        self.factory = FORMATS[ext]
+        self.current = self.factory()
+        self.pending = False  # inside a stream that has not ended
+
+    def decompress(self, data):
+        out = []
+        while data:
+            try:
+                out.append(self.current.decompress(data))
+            except Exception as e:
+                # zlib.error, OSError (bz2), LZMAError, ZstdError
+                raise ValueError(f"Invalid compressed data: {e}") from e
+            # Older zstandard versions do not tell where a frame ends.
+            self.pending = hasattr(self.current, "eof") and not self.current.eof
+            if self.pending or not hasattr(self.current, "eof"):
+                break
+            data = self.current.unused_data
+            self.current = self.factory()
+        return b"".join(out)
+
+    def check_end(self):
+        # After the last chunk: a stream cut off halfway is an error.
+        if self.pending:
+            raise ValueError("Truncated compressed file")
+
+
+class DecompressingReader(io.RawIOBase):
+    def __init__(self, raw, ext):
+        self.raw = raw
+        self.decompressor = Decompressor(ext)
+        self.buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            data = self.raw.read(CHUNK_SIZE)
+            if not data:
+                self.decompressor.check_end()
+                return 0
+            self.buffer = memoryview(self.decompressor.decompress(data))
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+def open_binary(path):
+    # Binary file object of the decompressed content.
+    ext = compression(path)
+    if ext is None:
+        return open(path, "rb")
+    return io.BufferedReader(DecompressingReader(open(path, "rb"), ext), CHUNK_SIZE)
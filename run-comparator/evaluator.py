@@ -1,36 +1,79 @@
 import os
+import subprocess
+import threading
 
+import numpy as np
 import pandas as pd
 
+from cache import score_cache
+from compression import CHUNK_SIZE, compression, open_binary
+from metrics import metrics
+from qrels import load_qrels
+from runstore import load_run
+from streaming import evaluate_stream
 
-def load_metrics(file):
+
+def load_metrics(lines):
     # from anserini project.
     metrics = {}
-    with open(file, "r") as f:
-        for line in f:
-            metric, qid, score = line.split("\t")
-            metric = metric.strip()
-            qid = qid.strip()
-            score = score.strip()
-            if qid == "all":
-                continue
-            if metric not in metrics:
-                metrics[metric] = {}
-            metrics[metric][qid] = float(score)
+    for line in lines:
+        metric, qid, score = line.split("\t")
+        metric = metric.strip()
+        qid = qid.strip()
+        score = score.strip()
+        if qid == "all":
+            continue
+        if metric not in metrics:
+            metrics[metric] = {}
+        metrics[metric][qid] = float(score)
 
     return metrics
 
 
+def copy_run(path, stdin):
+    try:
+        with open_binary(path) as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                stdin.buffer.write(chunk)
+    except (BrokenPipeError, ValueError):
+        # trec_eval failed (and its pipe may be closed), its exit code tells.
+        pass
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+@metrics.timed("trec_eval")
 def trec_eval(metric, qrels, run):
     # TREC eval for evaluation.
-    os.system(
-        "./trec_eval/trec_eval -q -M1000 -m "
-        f"{metric[:8]} {qrels} runs/{run} > .{run}"
-    )
+    name, k = parse_metric(metric)
+    measure = name if k is None else f"{name}.{k}"
+    if compression(qrels):
+        raise ValueError("trec_eval needs plain-text qrels")
+    # Output is read from the pipe, so concurrent calls cannot clash. A
+    # compressed run is streamed to trec_eval's stdin.
+    path = f"runs/{run}"
+    compressed = compression(path) is not None
+    command = ["./trec_eval/trec_eval", "-q", "-M1000", "-m", measure, qrels]
+    command.append("/dev/stdin" if compressed else path)
+    with subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE if compressed else None,
+        stdout=subprocess.PIPE,
+        text=True,
+    ) as process:
+        if compressed:
+            threading.Thread(
+                target=copy_run, args=(path, process.stdin), daemon=True
+            ).start()
+        output = process.stdout.read()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
 
-    # Store results in dictionary & clean up.
-    run_metrics = load_metrics(f".{run}")
-    os.remove(f".{run}")
+    # Store results in dictionary.
+    run_metrics = load_metrics(output.splitlines())
 
     # Store results in DataFrame.
     run_metrics_df = pd.DataFrame.from_dict(
@@ -38,3 +81,156 @@ def trec_eval(metric, qrels, run):
     )
 
     return run_metrics_df
+
+
+# Measures as named by trec_eval, with a cutoff (ndcg_cut_10, P_5, ...) or
+# over the whole ranking. The family (every measure at trec_eval's default
+# cutoffs) is computed in one pass and cached together.
+CUTOFF_MEASURES = ["ndcg_cut", "P", "recall", "map_cut"]
+RANKING_MEASURES = ["map", "recip_rank", "Rprec"]
+CUTOFFS = [5, 10, 15, 20, 30, 100, 200, 500, 1000]
+FAMILY = [f"{name}_{k}" for name in CUTOFF_MEASURES for k in CUTOFFS]
+FAMILY += RANKING_MEASURES
+
+
+def parse_metric(metric):
+    # "ndcg_cut_10" -> ("ndcg_cut", 10), "map" -> ("map", None)
+    name, _, cutoff = metric.rpartition("_")
+    if name in CUTOFF_MEASURES and cutoff.isdigit() and int(cutoff) > 0:
+        return name, int(cutoff)
+    if metric in RANKING_MEASURES:
+        return metric, None
+    raise ValueError(f"Unsupported metric: {metric}")
+
+
+def gain_matrix(run, qrels, topics, k):
+    # Topic x rank matrix with the relevance gain of each retrieved document.
+    pos = run.positions()
+    top = np.flatnonzero(pos < k)
+    rel = qrels.lookup(qrels.topic_codes(run.topics)[run.topic[top]], run.docid[top])
+    rows = pd.Index(topics).get_indexer(run.topics)[run.topic[top]]
+    keep = rows >= 0
+    gains = np.zeros((len(topics), k))
+    gains[rows[keep], pos[top][keep]] = np.clip(rel[keep], 0, None)
+    return gains
+
+
+def ndcg_cut(gains, ideal):
+    # nDCG for all topics at once, gains / log2(rank + 1).
+    discount = 1.0 / np.log2(np.arange(2, gains.shape[1] + 2))
+    dcg = gains @ discount
+    idcg = ideal @ discount
+    return np.divide(dcg, idcg, out=np.zeros_like(dcg), where=idcg > 0)
+
+
+@metrics.timed("evaluate run")
+def evaluate_metrics(names, qrels, run, depth=1000):
+    # Per-topic scores of many metrics from a single gain matrix, as a
+    # topic x metric DataFrame for the topics in both run and qrels.
+    parsed = [parse_metric(metric) for metric in names]
+    cutoffs = [k for _, k in parsed if k is not None]
+    if any(k is None for _, k in parsed):
+        width = depth
+    else:
+        width = min(depth, max(cutoffs))
+
+    metrics.inc("runs_evaluated_total")
+    topics = np.intersect1d(run.topics, qrels.topics)
+    gains = gain_matrix(run, qrels, topics, width)
+    num_rel = qrels.num_rel(topics)
+
+    # Relevant documents up to each rank, and the sum of the precision at
+    # the relevant ones (for average precision).
+    relevant = gains > 0
+    hits = np.cumsum(relevant, axis=1)
+    precision_sums = np.cumsum(relevant * hits / np.arange(1, width + 1), axis=1)
+    hits = np.pad(hits, ((0, 0), (1, 0)))
+    precision_sums = np.pad(precision_sums, ((0, 0), (1, 0)))
+
+    def per_rel(values):
+        return np.divide(values, num_rel, out=np.zeros(len(topics)), where=num_rel > 0)
+
+    max_ndcg = max([k for name, k in parsed if name == "ndcg_cut"], default=0)
+    ideal = qrels.ideal(topics, max_ndcg)
+    if max_ndcg > width:
+        gains = np.pad(gains, ((0, 0), (0, max_ndcg - width)))
+
+    scores = {}
+    for metric, (name, k) in zip(names, parsed):
+        at = min(k or width, width)
+        if name == "ndcg_cut":
+            scores[metric] = ndcg_cut(gains[:, :k], ideal[:, :k])
+        elif name == "P":
+            scores[metric] = hits[:, at] / k
+        elif name == "recall":
+            scores[metric] = per_rel(hits[:, at])
+        elif name in ("map_cut", "map"):
+            scores[metric] = per_rel(precision_sums[:, at])
+        elif name == "recip_rank":
+            first = relevant.argmax(axis=1) + 1.0
+            scores[metric] = np.where(relevant.any(axis=1), 1 / first, 0.0)
+        elif name == "Rprec":
+            r = np.minimum(num_rel, width)
+            found = hits[np.arange(len(topics)), r]
+            scores[metric] = per_rel(found)
+
+    return pd.DataFrame(scores, index=topics, columns=names)
+
+
+def evaluate_run(metric, qrels, run, depth=1000):
+    # Per-topic scores of one metric.
+    return evaluate_metrics([metric], qrels, run, depth)[metric]
+
+
+def evaluate(metric, qrels, run, cache=score_cache, folder="runs", memory_mb=None):
+    # In-process replacement for trec_eval, same per-topic DataFrame. Metrics
+    # of the family are cached together: the first one computes them all.
+    run_path = os.path.join(folder, run)
+    if metric in FAMILY:
+        scores = evaluate_family(qrels, run_path, cache, memory_mb)[metric]
+    else:
+        scores = cache.get(run_path, qrels, metric) if cache else None
+        if scores is None:
+            scores = score_file([metric], qrels, run_path, memory_mb)[metric]
+            if cache:
+                cache.put(run_path, qrels, metric, scores)
+
+    # trec_eval reports four decimals.
+    return scores.round(4).to_frame(run)
+
+
+def cached_scores(metric, qrels, run, cache=score_cache, folder="runs"):
+    # Scores of evaluate from the cache only, None if not evaluated yet.
+    run_path = os.path.join(folder, run)
+    if metric in FAMILY:
+        key = family_key(qrels, run_path, cache)
+        family = cache.get_frame(key, key[1:3])
+        scores = None if family is None else family[metric]
+    else:
+        scores = cache.get(run_path, qrels, metric)
+    return None if scores is None else scores.round(4).to_frame(run)
+
+
+def family_key(qrels, run_path, cache):
+    return ("family", cache.digest(run_path), cache.digest(qrels), 1000)
+
+
+def evaluate_family(qrels, run_path, cache=score_cache, memory_mb=None):
+    # Topic x metric DataFrame of every metric in FAMILY.
+    if cache:
+        key = family_key(qrels, run_path, cache)
+        family = cache.get_frame(key, key[1:3])
+        if family is not None:
+            return family
+    family = score_file(FAMILY, qrels, run_path, memory_mb)
+    if cache:
+        cache.put_frame(key, family, key[1:3])
+    return family
+
+
+def score_file(names, qrels, run_path, memory_mb=None):
+    # evaluate_metrics of a run file, loaded whole or, given a memory budget,
+    # a chunk of topics at a time (see streaming.py).
+    if memory_mb:
+        return evaluate_stream(names, load_qrels(qrels), run_path, memory_mb)
+    return evaluate_metrics(names, load_qrels(qrels), load_run(run_path))
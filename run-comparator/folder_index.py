@@ -0,0 +1,165 @@
+import json
+import logging
+import os
+import threading
+
+from batch import WORKERS, map_jobs
+from cache import file_digest, score_cache
+from metrics import metrics
+from runstore import ingest_run
+from utils import files_in_folder
+
+INDEX_FILE = ".index.json"
+
+
+def ingest_file(job):
+    # Hash and validate one new or changed file, writing its snapshot. Many
+    # new files (e.g. a folder of compressed runs) are spread over the pool.
+    name, path, size, mtime_ns = job
+    with metrics.capture() as captured:
+        entry = {"size": size, "mtime_ns": mtime_ns, "digest": None, "error": None}
+        try:
+            entry["digest"] = file_digest(path)
+            ingest_run(path)
+        except Exception as e:
+            entry["error"] = str(e)
+    return name, entry, captured
+
+
+class FolderIndex:
+    # Persistent record of the runs in a folder: size, mtime and content hash
+    # of every file, and whether it parsed as a TREC run. refresh() only
+    # lists and stats the folder: new or changed files wait in pending until
+    # ingest() hashes and validates them (in a background job, see
+    # jobs.submit_ingest) and swaps them into the index.
+
+    def __init__(self, folder="runs"):
+        self.folder = folder
+        self.path = os.path.join(folder, INDEX_FILE)
+        self.entries = {}  # {name: {size, mtime_ns, digest, error}}
+        self.pending = {}  # {name: (path, size, mtime_ns)}
+        self.loaded = None  # mtime_ns of the index file last read or written
+        self.on_pending = None  # called by refresh() when files are pending
+        self.version = 0  # counts the changes of the entries
+        self.lock = threading.Lock()
+        self.ingest_lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        # Entries of the index file, which other server processes update.
+        try:
+            with open(self.path) as f:
+                self.loaded = os.fstat(f.fileno()).st_mtime_ns
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+            self.loaded = os.stat(self.path).st_mtime_ns
+        except OSError:
+            # Read-only folder, keep the index in memory.
+            pass
+
+    def stored(self):
+        # Entries of the index file if another process wrote it since.
+        try:
+            with open(self.path) as f:
+                mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+                if mtime_ns == self.loaded:
+                    return {}
+                self.loaded = mtime_ns
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def refresh(self, notify=True):
+        # Sync with the folder without reading any run, returns the names
+        # of the new or changed files waiting to be ingested.
+        with self.lock:
+            stored = self.stored()
+            entries, pending = {}, {}
+            for name in files_in_folder(self.folder):
+                path = os.path.join(self.folder, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stat = (st.st_size, st.st_mtime_ns)
+                for entry in (self.entries.get(name), stored.get(name)):
+                    if entry is not None and (entry["size"], entry["mtime_ns"]) == stat:
+                        entries[name] = entry
+                        break
+                else:
+                    pending[name] = (path,) + stat
+
+            for name, entry in entries.items():
+                if entry["digest"] is not None:
+                    score_cache.remember(
+                        os.path.join(self.folder, name),
+                        entry["size"],
+                        entry["mtime_ns"],
+                        entry["digest"],
+                    )
+
+            removed = self.entries.keys() - entries.keys()
+            if entries != self.entries:
+                self.version += 1
+            self.entries = entries
+            self.pending = pending
+            if removed:
+                self.save()
+        if notify and pending and self.on_pending is not None:
+            self.on_pending()
+        return list(pending)
+
+    def ingest(self, job=None):
+        # Hash and validate the pending files over the process pool, then
+        # swap them into the index. Returns the names that were ingested.
+        with self.ingest_lock:
+            self.refresh(notify=False)
+            jobs = [(name,) + pending for name, pending in self.pending.items()]
+            ingested = {}
+            chunk = 4 * WORKERS
+            for start in range(0, len(jobs), chunk):
+                if job:
+                    job.check()
+                    job.report(start / len(jobs), f"{start}/{len(jobs)} files")
+                for name, entry, captured in map_jobs(
+                    ingest_file, jobs[start : start + chunk]
+                ):
+                    metrics.merge(captured)
+                    if entry["error"]:
+                        logging.info(f"{name} is not a TREC run. --> {entry['error']}")
+                    ingested[name] = entry
+
+            with self.lock:
+                for name, entry in ingested.items():
+                    # Unless the file changed again meanwhile.
+                    if self.pending.get(name, (None,))[1:] == (
+                        entry["size"],
+                        entry["mtime_ns"],
+                    ):
+                        self.entries[name] = entry
+                        del self.pending[name]
+                if ingested:
+                    self.version += 1
+                    self.save()
+        return list(ingested)
+
+    def runs(self):
+        # Names of the files that are valid TREC runs.
+        return sorted(name for name, e in self.entries.items() if e["error"] is None)
+
+    def errors(self):
+        return {name: e["error"] for name, e in self.entries.items() if e["error"]}
+
+    def digest(self, name):
+        return self.entries[name]["digest"]
+
+
+run_index = FolderIndex("runs")
@@ -0,0 +1,176 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from runstore import Run, docid_table
+
+# Fusion of any number of runs in the columnar store:
+#   rrf      sum of w / (k + rank)        (Cormack et al., 2009)
+#   combsum  sum of w * normalized score
+#   combmnz  combsum * number of runs retrieving the document
+# https://dl.acm.org/doi/10.1145/1571941.1572114
+# Ties: a run's ranks are those trec_eval reads (score descending, ties by
+# docid descending, see runstore.run_columns) and fused ties are broken by
+# docid ascending. trectools' reciprocal_rank_fusion breaks fused ties the
+# same way, but TrecRun.read_run ranks tied scores by docid ascending, so
+# for runs with tied scores it can fuse files differently.
+
+METHODS = ["rrf", "combsum", "combmnz"]
+NORMALIZATIONS = ["minmax", "zscore", "none"]
+
+
+def normalize(run, rows, norm):
+    # Per-topic normalized scores of the given rows (topics are contiguous).
+    score = np.asarray(run.score, dtype=np.float64)
+    if norm == "none":
+        return score[rows]
+    starts = run.offsets[:-1]
+    present = starts < run.offsets[1:]
+    topic = run.topic[rows]
+
+    if norm == "minmax":
+        low = np.zeros(len(run.topics))
+        high = np.zeros(len(run.topics))
+        low[present] = np.minimum.reduceat(score, starts[present])
+        high[present] = np.maximum.reduceat(score, starts[present])
+        spread = high - low
+        with np.errstate(invalid="ignore", divide="ignore"):
+            scaled = (score[rows] - low[topic]) / spread[topic]
+        return np.where(spread[topic] > 0, scaled, 1.0)
+
+    if norm == "zscore":
+        counts = np.diff(run.offsets)
+        sums = np.bincount(run.topic, score, minlength=len(run.topics))
+        mean = sums / np.maximum(counts, 1)
+        squares = np.bincount(
+            run.topic, (score - mean[run.topic]) ** 2, minlength=len(run.topics)
+        )
+        std = np.sqrt(squares / np.maximum(counts, 1))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            scaled = (score[rows] - mean[topic]) / std[topic]
+        return np.where(std[topic] > 0, scaled, 0.0)
+
+    raise ValueError(f"Unknown normalization: {norm}")
+
+
+def fuse(
+    runs,
+    method="rrf",
+    k=60,
+    weights=None,
+    norm="minmax",
+    max_docs=1000,
+    depth=1000,
+    collation=None,
+):
+    # Fused ranking of a list of Run objects, as a DataFrame with columns
+    # query, docid (code in the runs' table), rank and score, sorted per topic.
+    # collation: docid_collation of the runs, when fusing them many times.
+    if method not in METHODS:
+        raise ValueError(f"Unknown fusion method: {method}")
+    if weights is None:
+        weights = np.ones(len(runs))
+
+    topics = np.unique(np.concatenate([run.topics for run in runs]))
+    keys, values = [], []
+    for run, weight in zip(runs, weights):
+        pos = run.positions()
+        rows = np.flatnonzero(pos < depth)
+        topic = pd.Index(topics).get_indexer(run.topics)[run.topic[rows]]
+        keys.append(topic.astype(np.int64) << 32 | run.docid[rows])
+        if method == "rrf":
+            values.append(weight / (k + pos[rows] + 1.0))
+        else:
+            values.append(weight * normalize(run, rows, norm))
+
+    # Group by (topic, docid) over all runs at once.
+    unique, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    score = np.bincount(inverse, np.concatenate(values))
+    if method == "combmnz":
+        score *= np.bincount(inverse)
+
+    # Per topic by score, ties by docid ascending.
+    topic = unique >> 32
+    docid = (unique & 0xFFFFFFFF).astype(np.int32)
+    ranks = docid_ranks(docid, runs[0].table, collation)
+    order = np.lexsort((ranks, -score, topic))
+    topic, docid, score = topic[order], docid[order], score[order]
+    rank = np.arange(len(topic)) - np.searchsorted(topic, topic) + 1
+    fused = pd.DataFrame(
+        {"query": topics[topic], "docid": docid, "score": score, "rank": rank}
+    )
+    return fused[fused["rank"] <= max_docs].reset_index(drop=True)
+
+
+def docid_ranks(codes, table=docid_table, collation=None):
+    # Position of each docid code in the sorted docid strings, so rows sort
+    # by docid without comparing strings more than once.
+    if collation is not None:
+        return collation[codes]
+    unique, inverse = np.unique(codes, return_inverse=True)
+    ranks = np.empty(len(unique), dtype=np.int64)
+    ranks[np.argsort(table.lookup(unique), kind="stable")] = np.arange(len(unique))
+    return ranks[inverse]
+
+
+def docid_collation(runs):
+    # docid_ranks of every docid code of the runs, indexed by code.
+    codes = np.unique(np.concatenate([run.docid for run in runs]))
+    collation = np.full(codes.max() + 1 if len(codes) else 0, -1, dtype=np.int64)
+    collation[codes] = docid_ranks(codes, runs[0].table)
+    return collation
+
+
+def fused_run(fused, table=docid_table, collation=None):
+    # Run of a fusion (sorted by query, as fuse returns it), ordered as its
+    # written file is read back (see runstore.run_columns), so it can be
+    # scored without writing it.
+    topic, topics = pd.factorize(fused["query"])
+    docid = fused["docid"].values
+    score = fused["score"].values
+    order = np.lexsort((-docid_ranks(docid, table, collation), -score, topic))
+    return Run(
+        np.asarray(topics, dtype=object),
+        topic[order].astype(np.int32),
+        docid[order].astype(np.int32),
+        fused["rank"].values[order],
+        score[order],
+        table,
+    )
+
+
+def fusion_tag(method, k=60, norm="minmax"):
+    if method == "rrf":
+        return f"reciprocal_rank_fusion_k={k}"
+    return f"{method}_{norm}"
+
+
+def write_fused(f, fused, tag, table=docid_table, chunk_size=100000):
+    # Append a fused run to an open file in TREC format.
+    for start in range(0, len(fused), chunk_size):
+        chunk = fused.iloc[start : start + chunk_size]
+        pd.DataFrame(
+            {
+                "query": chunk["query"].values,
+                "q0": "Q0",
+                "docid": table.lookup(chunk["docid"].values),
+                "rank": chunk["rank"].values,
+                "score": chunk["score"].values,
+                "tag": tag,
+            }
+        ).to_csv(f, sep=" ", header=False, index=False)
+
+
+def tmp_path(path):
+    folder, name = os.path.split(path)
+    return os.path.join(folder, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def write_run(fused, path, tag, table=docid_table):
+    # Stream a fused run to disk in TREC format, moved in place when done.
+    tmp = tmp_path(path)
+    with open(tmp, "w") as f:
+        write_fused(f, fused, tag, table)
+    os.replace(tmp, path)
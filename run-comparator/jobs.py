@@ -0,0 +1,294 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import stages
+from folder_index import run_index
+from fusion import fuse, fusion_tag, write_run
+from sweep import WEIGHTS, grid_candidates, rank_candidates, sweep, write_best
+
+JOB_WORKERS = int(os.environ.get("RUN_COMPARATOR_JOB_WORKERS", 2))
+JOB_HISTORY = 20
+JOB_DB = os.path.join("runs", ".jobs.sqlite")
+ACTIVE = ("queued", "running")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT,
+    key TEXT,
+    description TEXT,
+    status TEXT,
+    progress REAL DEFAULT 0,
+    message TEXT DEFAULT '',
+    error TEXT,
+    pid INTEGER,
+    created REAL,
+    finished REAL,
+    cancelled INTEGER DEFAULT 0
+)
+"""
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    # A unit of background work, a row of the jobs table (see JobScheduler).
+    # The job function receives the Job and reports progress through it; it
+    # should call check() between steps so that a cancellation takes effect.
+
+    def __init__(self, scheduler, row):
+        self.scheduler = scheduler
+        self.id = row["id"]
+        self.kind = row["kind"]
+        self.key = row["key"]
+        self.description = row["description"]
+        self.status = row["status"]
+        self.progress = row["progress"]
+        self.message = row["message"]
+        self.error = row["error"]
+        self.pid = row["pid"]
+        self.created = row["created"]
+        self.finished = row["finished"]
+        self.result = None
+        self.future = None
+
+    @property
+    def active(self):
+        return self.status in ACTIVE
+
+    def report(self, progress, message=""):
+        self.progress = progress
+        self.message = message
+        self.scheduler.update(self.id, progress=progress, message=message)
+
+    def check(self):
+        if self.scheduler.cancelled(self.id):
+            raise JobCancelled()
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobScheduler:
+    # Runs jobs on a small thread pool; the heavy lifting inside a job goes
+    # to the evaluation process pool, so dashboard callbacks stay free. Job
+    # state lives in a sqlite file shared by the server processes: a job
+    # runs in the process that submitted it, but every process lists,
+    # deduplicates and cancels it.
+
+    def __init__(self, workers=JOB_WORKERS, path=JOB_DB):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.path = path
+        self.futures = {}  # {id: Future} of the jobs of this process
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def db(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            connection.execute(SCHEMA)
+            yield connection
+        finally:
+            connection.close()
+
+    def submit(self, kind, func, *args, description=""):
+        # Identical submissions share the job that is still queued or running.
+        key = repr((kind, func.__name__, args))
+        with self.db() as db:
+            db.execute("BEGIN IMMEDIATE")
+            self.expire(db)
+            row = db.execute(
+                "SELECT * FROM jobs WHERE key = ? AND status IN (?, ?)",
+                (key,) + ACTIVE,
+            ).fetchone()
+            if row is not None:
+                db.execute("COMMIT")
+                return Job(self, row)
+            job_id = db.execute(
+                "INSERT INTO jobs (kind, key, description, status, pid, created)"
+                " VALUES (?, ?, ?, 'queued', ?, ?)",
+                (kind, key, description or kind, os.getpid(), time.time()),
+            ).lastrowid
+            self.prune(db)
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            db.execute("COMMIT")
+        job = Job(self, row)
+        with self.lock:
+            job.future = self.futures[job.id] = self.executor.submit(
+                self.run, job, func, args
+            )
+        return job
+
+    def run(self, job, func, args):
+        try:
+            if self.cancelled(job.id):
+                raise JobCancelled()
+            self.update(job.id, status="running")
+            job.result = func(job, *args)
+            self.update(job.id, status="done", progress=1.0, finished=time.time())
+        except JobCancelled:
+            self.update(job.id, status="cancelled", finished=time.time())
+        except Exception as e:
+            logging.exception(f"Job {job.description} failed")
+            self.update(job.id, status="failed", error=str(e), finished=time.time())
+        finally:
+            with self.lock:
+                self.futures.pop(job.id, None)
+
+    def update(self, job_id, **fields):
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self.db() as db:
+            db.execute(
+                f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id)
+            )
+
+    def cancelled(self, job_id):
+        with self.db() as db:
+            row = db.execute(
+                "SELECT cancelled FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return row is None or bool(row["cancelled"])
+
+    def cancel(self, job_id):
+        # The process running the job sees the flag at its next check().
+        with self.db() as db:
+            db.execute(
+                "UPDATE jobs SET cancelled = 1 WHERE id = ? AND status IN (?, ?)",
+                (job_id,) + ACTIVE,
+            )
+        with self.lock:
+            future = self.futures.get(job_id)
+        if future is not None and future.cancel():
+            self.update(job_id, status="cancelled", finished=time.time())
+
+    def expire(self, db):
+        # Active jobs of server processes that are gone will never finish.
+        for row in db.execute(
+            "SELECT id, pid FROM jobs WHERE status IN (?, ?)", ACTIVE
+        ).fetchall():
+            if not process_alive(row["pid"]):
+                db.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished = ?"
+                    " WHERE id = ?",
+                    ("server process exited", time.time(), row["id"]),
+                )
+
+    def reset(self):
+        # On server start no job is running yet: fail the ones a previous
+        # server left active, whose process ids may have been reused.
+        with self.db() as db:
+            db.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished = ?"
+                " WHERE status IN (?, ?)",
+                ("server restarted", time.time()) + ACTIVE,
+            )
+
+    def prune(self, db):
+        # Keep all active jobs and the most recent finished ones.
+        db.execute(
+            "DELETE FROM jobs WHERE status NOT IN (?, ?) AND id NOT IN"
+            " (SELECT id FROM jobs WHERE status NOT IN (?, ?)"
+            " ORDER BY finished DESC LIMIT ?)",
+            ACTIVE + ACTIVE + (JOB_HISTORY,),
+        )
+
+    def version(self):
+        # Changes whenever a job finishes or reports progress: a cheap poll
+        # for the figures to redraw with the results (app.update_scores_state).
+        with self.db() as db:
+            row = db.execute(
+                "SELECT MAX(CASE WHEN status = 'done' THEN finished END),"
+                " SUM(CASE WHEN status = 'running' THEN progress END) FROM jobs"
+            ).fetchone()
+        return f"{row[0]}:{row[1]}"
+
+    def list(self):
+        with self.db() as db:
+            self.expire(db)
+            rows = db.execute("SELECT * FROM jobs ORDER BY id DESC").fetchall()
+        return [Job(self, row) for row in rows]
+
+
+scheduler = JobScheduler()
+
+
+def ingest_job(job):
+    # New or changed files of the runs folder, see FolderIndex.
+    return run_index.ingest(job=job)
+
+
+def submit_ingest():
+    return scheduler.submit("ingest", ingest_job, description="indexing new runs")
+
+
+run_index.on_pending = submit_ingest
+
+
+def fusion_job(job, runs, method="rrf", k=60, max_docs=100, name=None):
+    loaded = []
+    for i, run in enumerate(runs):
+        job.check()
+        job.report(0.5 * i / len(runs), f"loading {run}")
+        loaded.append(stages.run_stage(run))
+
+    job.check()
+    job.report(0.5, "fusing")
+    fused = fuse(loaded, method=method, k=k, max_docs=max_docs)
+
+    job.check()
+    job.report(0.8, "writing")
+    if name is None:
+        name = "fuse_" + "_".join(run.replace(".txt", "") for run in runs) + ".txt"
+    write_run(fused, f"runs/{name}", fusion_tag(method, k))
+    run_index.ingest()
+    return name
+
+
+def sweep_job(job, runs, metric, qrels):
+    # Fusion settings of the runs scored in memory (see sweep.py); only the
+    # best fusion is written to the runs folder.
+    candidates = grid_candidates(list(runs), weights=WEIGHTS)
+    paths = {run: "runs/" + run for run in runs}
+    scores = sweep(metric, "qrels/" + qrels, paths, candidates, job=job)
+    ranked = rank_candidates(candidates, scores)
+
+    job.check()
+    job.report(0.9, "writing")
+    prefix = "sweep_" + "_".join(run.replace(".txt", "") for run in runs)
+    (name,) = write_best(ranked, paths, 1, "runs", prefix)
+    run_index.ingest()
+    return name
+
+
+def evaluation_job(job, metric, qrels):
+    # Evaluate every run in the folder, warming the dashboard caches.
+    run_index.ingest(job=job)
+    return stages.all_scores(metric, qrels, job=job).shape
+
+
+def overlap_job(job, run1, n):
+    # Compare the runs of the folder with the base run (see
+    # stages.overlap_stage) for the table.
+    return stages.overlap_stage(run1, n, job=job)[0].shape
+
+
+def significance_job(job, metric, qrels, run1, correction=None):
+    stages.all_scores(metric, qrels, job=job)
+    job.report(0.9, "testing")
+    return stages.significance_stage(metric, qrels, run1, correction)
@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Counters and timings of the evaluation pipeline, rendered in the Prometheus
+# text format on /metrics. Timings are summaries (_count and _sum); a span
+# inside a callback is also added to that callback's stage breakdown, which
+# is logged when the callback is slower than RUN_COMPARATOR_SLOW_MS.
+# Under several server processes (see gunicorn.conf.py), every process dumps
+# its values to a shared folder and /metrics adds them up.
+
+PREFIX = "run_comparator_"
+SLOW_CALLBACK_MS = float(os.environ.get("RUN_COMPARATOR_SLOW_MS", 1000))
+
+
+class Metrics:
+    def __init__(self):
+        self.values = {}  # {(name, labels): value}
+        self.types = {}  # {name: "counter" | "summary"}
+        self.caches = {}  # {stage: lru_cache wrapped function}
+        self.cache_base = {}  # {stage: (hits, misses)} at the last reset
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.folder = None  # shared by the server processes, see share
+        self.dumped = 0.0
+
+    def add(self, kind, base, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        captured = getattr(self.local, "captured", None)
+        values, types = captured or (self.values, self.types)
+        with self.lock:
+            types[base] = kind
+            values[key] = values.get(key, 0) + value
+
+    def inc(self, name, value=1, **labels):
+        self.add("counter", name, name, value, labels)
+
+    def observe(self, name, seconds, **labels):
+        self.add("summary", name, name + "_count", 1, labels)
+        self.add("summary", name, name + "_sum", seconds, labels)
+
+    @contextmanager
+    def capture(self):
+        # Collect (values, types) apart from the registry, e.g. in a pool
+        # worker whose counts are sent back to the server process (see merge).
+        self.local.captured = captured = ({}, {})
+        try:
+            yield captured
+        finally:
+            self.local.captured = None
+
+    def merge(self, captured):
+        values, types = captured
+        with self.lock:
+            self.types.update(types)
+            for key, value in values.items():
+                self.values[key] = self.values.get(key, 0) + value
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe("stage_seconds", seconds, stage=stage)
+            trace = getattr(self.local, "trace", None)
+            if trace is not None:
+                trace.append((stage, seconds))
+
+    def timed(self, stage):
+        # Decorator form of span.
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def callback(self, func, expected=()):
+        # Times a dashboard callback with the spans it went through. Raising
+        # one of `expected` (e.g. PreventUpdate) is not an error.
+        @wraps(func)
+        def wrapper(*args):
+            self.local.trace = trace = []
+            status = "ok"
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            except expected:
+                status = "skipped"
+                raise
+            except Exception:
+                status = "error"
+                logging.exception(f"Callback {func.__name__} failed")
+                raise
+            finally:
+                seconds = time.perf_counter() - start
+                self.local.trace = None
+                self.observe("callback_seconds", seconds, callback=func.__name__)
+                self.inc("callbacks_total", callback=func.__name__, status=status)
+                if seconds * 1000 >= SLOW_CALLBACK_MS:
+                    totals = {}  # {stage: [seconds, calls]}, in order of finishing
+                    for stage, t in trace:
+                        total = totals.setdefault(stage, [0.0, 0])
+                        total[0] += t
+                        total[1] += 1
+                    breakdown = ", ".join(
+                        f"{s} {1000 * t:.0f} ms" + (f" ({n}x)" if n > 1 else "")
+                        for s, (t, n) in totals.items()
+                    )
+                    logging.warning(
+                        f"Slow callback {func.__name__}: {1000 * seconds:.0f} ms"
+                        f" ({breakdown or 'no stages'})"
+                    )
+
+        return wrapper
+
+    def register_cache(self, stage, func):
+        # In-memory lru_cache of a stage, reported as hits and misses.
+        self.caches[stage] = func
+
+    def share(self, folder):
+        # Called once before the server processes fork: each one dumps its
+        # values to folder/<pid>.json, render adds up all of them.
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        self.folder = folder
+
+    def reset(self):
+        # Start from zero in a forked process, whose parent dumps its own
+        # counts; forked lru_caches keep their hits and misses.
+        with self.lock:
+            self.values.clear()
+            self.dumped = 0.0
+        self.cache_base = {
+            stage: func.cache_info()[:2] for stage, func in self.caches.items()
+        }
+
+    def snapshot(self):
+        # (values, types) of this process, including the stage caches.
+        with self.lock:
+            values = dict(self.values)
+            types = dict(self.types, stage_cache_total="counter")
+        for stage, func in self.caches.items():
+            hits, misses = func.cache_info()[:2]
+            base = self.cache_base.get(stage, (0, 0))
+            for result, count in [("hit", hits - base[0]), ("miss", misses - base[1])]:
+                labels = (("result", result), ("stage", stage))
+                values[("stage_cache_total", labels)] = count
+        return values, types
+
+    def dump(self, every=0.0):
+        # Write the values of this process to the shared folder, at most
+        # once per `every` seconds.
+        now = time.time()
+        if self.folder is None or now - self.dumped < every:
+            return
+        self.dumped = now
+        values, types = self.snapshot()
+        path = os.path.join(self.folder, f"{os.getpid()}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(
+                {
+                    "types": types,
+                    "values": [
+                        [name, labels, value]
+                        for (name, labels), value in values.items()
+                    ],
+                },
+                f,
+            )
+        os.replace(f"{path}.tmp", path)
+
+    def shared(self):
+        # (values, types) added up over the dumps of the other processes.
+        values, types = {}, {}
+        own = f"{os.getpid()}.json"
+        for file in os.listdir(self.folder) if self.folder else []:
+            if not file.endswith(".json") or file == own:
+                continue
+            try:
+                with open(os.path.join(self.folder, file)) as f:
+                    dumped = json.load(f)
+            except (OSError, ValueError):
+                continue
+            types.update(dumped["types"])
+            for name, labels, value in dumped["values"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                values[key] = values.get(key, 0) + value
+        return values, types
+
+    def render(self):
+        values, types = self.snapshot()
+        shared_values, shared_types = self.shared()
+        types.update(shared_types)
+        for key, value in shared_values.items():
+            values[key] = values.get(key, 0) + value
+
+        lines = []
+        for name, kind in sorted(types.items()):
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            names = [name + "_count", name + "_sum"] if kind == "summary" else [name]
+            for (key, labels), value in sorted(values.items()):
+                if key in names:
+                    label = ",".join(f'{k}="{v}"' for k, v in labels)
+                    label = f"{{{label}}}" if label else ""
+                    lines.append(f"{PREFIX}{key}{label} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+
+OVERLAP_COLUMNS = ["new", "jaccard", "rbo", "tau"]
+
+
+def top_matrix(run, topics, k):
+    # Topic x rank matrix of docid codes in the top k, -1 where empty.
+    pos = run.positions()
+    top = np.flatnonzero(pos < k)
+    rows = pd.Index(topics).get_indexer(run.topics)[run.topic[top]]
+    keep = rows >= 0
+    matrix = np.full((len(topics), k), -1, dtype=np.int64)
+    matrix[rows[keep], pos[top][keep]] = run.docid[top][keep]
+    return matrix
+
+
+def align(top, topics):
+    # Top matrix of a (topics, matrix) pair for other topics, -1 for the
+    # topics it does not have.
+    run_topics, matrix = top
+    aligned = np.full((len(topics), matrix.shape[1]), -1, dtype=np.int64)
+    rows = pd.Index(topics).get_indexer(run_topics)
+    aligned[rows[rows >= 0]] = matrix[rows >= 0]
+    return aligned
+
+
+def inversions(positions):
+    # Discordant pairs per row, ignoring NaN (documents not in both lists),
+    # by a bottom-up merge sort of all rows at once: O(k log k) per row.
+    n, k = positions.shape
+    size = 1 << max(k - 1, 0).bit_length()
+    # NaN go behind the documents of their row and get increasing values past
+    # any position, as does the padding to a power of two: they add no pairs.
+    values = np.take_along_axis(
+        positions, np.argsort(np.isnan(positions), axis=1, kind="stable"), axis=1
+    )
+    matrix = np.tile(np.arange(k, k + size, dtype=np.float64), (n, 1))
+    matrix[:, :k] = np.where(np.isnan(values), matrix[:, :k], values)
+    counts = np.zeros(n)
+    width = 1
+    while width < size:
+        # Merge sorted halves of 2 * width: a pair of the left and the right
+        # half is concordant if the left element is merged first.
+        blocks = matrix.reshape(n, size // (2 * width), 2 * width)
+        merged = np.argsort(blocks, axis=2, kind="stable")
+        left = merged < width
+        concordant = np.where(left, 0, np.cumsum(left, axis=2)).sum(axis=(1, 2))
+        counts += blocks.shape[1] * width ** 2 - concordant
+        matrix = np.take_along_axis(blocks, merged, axis=2).reshape(n, size)
+        width *= 2
+    return counts
+
+
+def overlap(base, other, p=0.9):
+    # Per-topic overlap of two top-k matrices (see top_matrix):
+    #   new      percentage of other's documents not in base
+    #   jaccard  |base & other| / |base | other|
+    #   rbo      extrapolated rank-biased overlap (Webber et al., 2010)
+    #   tau      Kendall's tau of the documents in both rankings
+    n_topics, k = base.shape
+    rows = np.repeat(np.arange(n_topics), k)
+    ranks = np.tile(np.arange(k), n_topics)
+    in_base = base.ravel() >= 0
+    in_other = other.ravel() >= 0
+
+    # Position in base of every document of other, via sorted (topic, docid).
+    base_keys = rows[in_base] << 32 | base.ravel()[in_base]
+    order = np.argsort(base_keys)
+    base_keys = base_keys[order]
+    base_ranks = ranks[in_base][order]
+    keys = rows[in_other] << 32 | other.ravel()[in_other]
+    i = np.minimum(np.searchsorted(base_keys, keys), max(len(base_keys) - 1, 0))
+    hit = base_keys[i] == keys if len(base_keys) else np.zeros(len(keys), bool)
+    hit_rows = rows[in_other][hit]
+    hit_ranks = ranks[in_other][hit]
+    hit_base_ranks = base_ranks[i[hit]]
+
+    n_base = in_base.reshape(n_topics, k).sum(axis=1)
+    n_other = in_other.reshape(n_topics, k).sum(axis=1)
+    shared = np.bincount(hit_rows, minlength=n_topics)
+    missing = n_other == 0
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        new = (100 / k) * (n_other - shared)
+        jaccard = shared / (n_base + n_other - shared)
+
+        # Overlap at every depth d: a shared document counts from the depth
+        # at which it appears in both rankings.
+        depth = np.maximum(hit_ranks, hit_base_ranks)
+        found = np.bincount(hit_rows * k + depth, minlength=n_topics * k)
+        agreement = found.reshape(n_topics, k).cumsum(axis=1) / np.arange(1, k + 1)
+        weights = p ** np.arange(1, k + 1)
+        rbo = agreement[:, -1] * p ** k + (1 - p) / p * agreement @ weights
+
+        positions = np.full((n_topics, k), np.nan)
+        positions[hit_rows, hit_ranks] = hit_base_ranks
+        pairs = shared * (shared - 1) / 2
+        tau = np.where(pairs > 0, 1 - 2 * inversions(positions) / pairs, np.nan)
+
+    result = np.column_stack([new, jaccard, rbo, tau])
+    result[missing] = np.nan
+    return result
+
+
+def compare_runs(base, runs, k, p=0.9):
+    # Overlap of the base run with every run in `runs` ({name: Run}).
+    # Returns per-topic values {column: topic x run DataFrame} and the
+    # run x column DataFrame of means over each run's topics.
+    topics = np.unique(
+        np.concatenate([base.topics] + [run.topics for run in runs.values()])
+    )
+    base_top = top_matrix(base, topics, k)
+
+    per_topic = np.full((len(OVERLAP_COLUMNS), len(topics), len(runs)), np.nan)
+    for j, run in enumerate(runs.values()):
+        per_topic[:, :, j] = overlap(base_top, top_matrix(run, topics, k), p).T
+
+    names = list(runs)
+    frames = {
+        column: pd.DataFrame(values, index=topics, columns=names)
+        for column, values in zip(OVERLAP_COLUMNS, per_topic)
+    }
+    summary = pd.DataFrame({column: frames[column].mean() for column in frames})
+    return frames, summary
+
+
+def compare_tops(base, other, p=0.9):
+    # Means over topics of the overlap of two (topics, top matrix) pairs, in
+    # the order of OVERLAP_COLUMNS: the same as a row of compare_runs, whose
+    # topics of other runs only add topics missing from both.
+    topics = np.union1d(base[0], other[0])
+    result = overlap(align(base, topics), align(other, topics), p)
+    return pd.DataFrame(result, columns=OVERLAP_COLUMNS).mean().values
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+from overlap import compare_tops
+
+# Comparison of every pair of runs, shown as run x run matrices:
+#   delta    mean score of the column run minus the row run
+#   p_value  paired t-test of the per-topic scores
+#   jaccard, rbo, tau  overlap of the top k, averaged over topics
+# Pairs are keyed by the content digests of both runs and kept between
+# calls (see stages.pairs_stage), so a new run costs one comparison with
+# every other run instead of all pairs again.
+
+PAIR_COLUMNS = ["delta", "p_value", "jaccard", "rbo", "tau"]
+DIAGONAL = {"delta": 0.0, "p_value": np.nan, "jaccard": 1.0, "rbo": 1.0, "tau": 1.0}
+
+
+def pair_key(a, b):
+    return f"{a}-{b}"
+
+
+def score_tests(base, others):
+    # Mean difference and paired t-test of every column of others with base,
+    # over the topics both have scores for (as scipy's ttest_rel).
+    from scipy import stats
+
+    diff = others.sub(base, axis=0)
+    n = diff.count()
+    mean = diff.mean()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = mean / (diff.std(ddof=1) / np.sqrt(n))
+        p = 2 * stats.t.sf(np.abs(t), n - 1)
+    return mean.values, p
+
+
+def compare_pairs(known, scores, digests, top):
+    # Frame of all pairs of the runs in scores (topic x run), indexed by
+    # pair_key of their digests in sorted order. Pairs in known (an earlier
+    # result, or None) are reused; top(name) is the (topics, top k matrix)
+    # of a run for the overlap (see stages.top_stage). Returns the frame and
+    # the number of pairs computed.
+    runs = sorted(scores.columns, key=lambda name: digests[name])
+    if known is None:
+        known = pd.DataFrame(columns=PAIR_COLUMNS, dtype=float)
+
+    current, rows = [], {}
+    for i, a in enumerate(runs):
+        keys = {b: pair_key(digests[a], digests[b]) for b in runs[i + 1 :]}
+        current.extend(keys.values())
+        missing = [b for b, key in keys.items() if key not in known.index]
+        if not missing:
+            continue
+        delta, p = score_tests(scores[a], scores[missing])
+        for j, b in enumerate(missing):
+            rows[keys[b]] = [delta[j], p[j], *compare_tops(top(a), top(b))[1:]]
+
+    new = pd.DataFrame.from_dict(rows, orient="index", columns=PAIR_COLUMNS)
+    pairs = pd.concat([known[known.index.isin(current)], new])
+    return pairs[~pairs.index.duplicated()], len(new)
+
+
+def pair_matrix(pairs, digests, column):
+    # run x run DataFrame of one column of compare_pairs: row is the base,
+    # column the other run.
+    runs = sorted(digests)
+    keys = [digests[name] for name in runs]
+    values = np.full((len(runs), len(runs)), np.nan)
+    if len(pairs):
+        split = pairs.index.str.split("-", n=1)
+        a, b = split.str[0], split.str[1]
+        column_values = pairs[column].values
+        mirrored = -column_values if column == "delta" else column_values
+        by_digest = pd.Series(
+            np.concatenate([column_values, mirrored]),
+            index=pd.MultiIndex.from_arrays(
+                [np.concatenate([a, b]), np.concatenate([b, a])]
+            ),
+        )
+        by_digest = by_digest[~by_digest.index.duplicated()].unstack()
+        values = by_digest.reindex(index=keys, columns=keys).values.copy()
+    np.fill_diagonal(values, DIAGONAL[column])
+    return pd.DataFrame(values, index=runs, columns=runs)
@@ -0,0 +1,113 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from compression import open_binary
+from metrics import metrics
+from runstore import docid_table
+
+
+class Qrels:
+    # Judgements indexed by (topic, docid code), sorted, so grades of many
+    # documents are looked up in one searchsorted call.
+
+    def __init__(self, topics, topic, docid, rel, table=docid_table):
+        order = np.lexsort((docid, topic))
+        self.topics = topics  # unique topic ids, sorted
+        self.topic = topic[order]
+        self.docid = docid[order]
+        self.rel = rel[order]
+        self.keys = self.topic.astype(np.int64) << 32 | self.docid
+        self.table = table
+
+    def topic_codes(self, topics):
+        # Index of each topic in self.topics, -1 if not judged.
+        return pd.Index(self.topics).get_indexer(topics)
+
+    def lookup(self, topic, docid, default=0):
+        # Grades for arrays of topic codes and docid codes.
+        keys = np.asarray(topic, dtype=np.int64) << 32 | np.asarray(docid)
+        if not len(self.keys):
+            return np.full(len(keys), default)
+        i = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = (self.keys[i] == keys) & (np.asarray(topic) >= 0)
+        return np.where(found, self.rel[i], default)
+
+    def grades(self, topic, docids, default=0.0):
+        # Grades of the docid codes retrieved for one topic.
+        t = self.topic_codes([topic])[0]
+        return self.lookup(np.full(len(docids), t), docids, default)
+
+    def num_rel(self, topics):
+        # Number of relevant documents of each topic.
+        counts = np.bincount(self.topic[self.rel > 0], minlength=len(self.topics))
+        return counts[self.topic_codes(topics)]
+
+    def ideal(self, topics, k):
+        # Topic x rank matrix of the best possible ranking.
+        judged = np.flatnonzero(self.rel > 0)
+        order = judged[np.lexsort((-self.rel[judged], self.topic[judged]))]
+        topic = self.topic[order]
+        first = np.searchsorted(topic, topic)
+        pos = np.arange(len(order)) - first
+        keep = pos < k
+        rows = pd.Index(topics).get_indexer(self.topics[topic[keep]])
+        found = rows >= 0
+        ideal = np.zeros((len(topics), k))
+        ideal[rows[found], pos[keep][found]] = self.rel[order][keep][found]
+        return ideal
+
+
+@metrics.timed("parse qrels")
+def parse_qrels(path, table=docid_table):
+    # 886 0 00183d98-741b-11e5-8248-98e0f5a2e830 0
+    metrics.inc("bytes_parsed_total", os.path.getsize(path), kind="qrels")
+    with open_binary(path) as f:
+        df = pd.read_csv(
+            f,
+            sep=r"\s+",
+            header=None,
+            usecols=[0, 2, 3],
+            names=["topic", "docid", "rel"],
+            dtype={"topic": str, "docid": str, "rel": np.int32},
+        )
+    topic, topics = pd.factorize(df["topic"], sort=True)
+    local, docids = pd.factorize(df["docid"])
+    return Qrels(
+        np.asarray(topics, dtype=object),
+        topic.astype(np.int32),
+        table.intern(docids)[local],
+        df["rel"].values,
+        table,
+    )
+
+
+class QrelsRegistry:
+    # Every qrels file is parsed once and reloaded only when it changes.
+
+    def __init__(self, table=docid_table):
+        self.table = table
+        self.loaded = {}  # {path: ((size, mtime_ns), Qrels)}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        st = os.stat(path)
+        fp = (st.st_size, st.st_mtime_ns)
+        with self.lock:
+            known = self.loaded.get(path)
+        if known and known[0] == fp:
+            return known[1]
+
+        qrels = parse_qrels(path, self.table)
+        with self.lock:
+            self.loaded[path] = (fp, qrels)
+        return qrels
+
+
+qrels_registry = QrelsRegistry()
+
+
+def load_qrels(path):
+    return qrels_registry.get(path)
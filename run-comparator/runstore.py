@@ -0,0 +1,551 @@
+import codecs
+import json
+import os
+import shutil
+import threading
+from functools import lru_cache
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+from compression import Decompressor, compression, open_binary
+from metrics import metrics
+
+SNAPSHOT_DIR = ".snapshots"
+SNAPSHOT_VERSION = 4
+SORT_BLOCK = 2 ** 20  # rows copied at a time by RunBuilder.finish
+
+
+class DocidTable:
+    # Interned document ids shared by all loaded runs and qrels. Docids are
+    # looked up in pd.Index segments (vectorized hashing), merged as they
+    # grow so there are O(log n) of them.
+
+    def __init__(self):
+        self.segments = []  # [(code of the first docid, pd.Index), ]
+        self.strings = np.empty(1024, dtype=object)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def intern(self, docids):
+        # Codes for an array of (unique) docid strings, adding unseen ones.
+        with self.lock:
+            codes = self.codes(docids)
+            new = np.flatnonzero(codes < 0)
+            if len(new):
+                codes[new] = np.arange(self.size, self.size + len(new))
+                self.append(np.asarray(docids, dtype=object)[new])
+        return codes
+
+    def append(self, docids):
+        start, self.size = self.size, self.size + len(docids)
+        if self.size > len(self.strings):
+            self.strings = np.resize(
+                self.strings, max(self.size, 2 * len(self.strings))
+            )
+        self.strings[start : self.size] = docids
+        segments = self.segments + [(start, pd.Index(docids, dtype=object))]
+        while len(segments) > 1 and len(segments[-1][1]) >= len(segments[-2][1]):
+            (start, older), (_, newer) = segments[-2:]
+            segments[-2:] = [(start, older.append(newer))]
+        # Replaced, not changed in place: codes() reads without the lock.
+        self.segments = segments
+
+    def lookup(self, codes):
+        return self.strings[codes]
+
+    def find(self, docid):
+        return self.codes([docid])[0]
+
+    def codes(self, docids):
+        # Codes of known docids, -1 for unseen ones (which are not added).
+        docids = np.asarray(docids, dtype=object)
+        codes = np.full(len(docids), -1, dtype=np.int32)
+        missing = np.arange(len(docids))
+        for start, index in self.segments:
+            found = index.get_indexer(docids[missing])
+            hit = found >= 0
+            codes[missing[hit]] = start + found[hit]
+            missing = missing[~hit]
+            if not len(missing):
+                break
+        return codes
+
+
+docid_table = DocidTable()
+
+
+class Run:
+    # Columnar TREC run. Rows are grouped by topic (sorted) and ordered the
+    # way trec_eval ranks them (score desc, docid desc), so each topic is
+    # the slice offsets[t]:offsets[t + 1].
+
+    def __init__(self, topics, topic, docid, rank, score, table=docid_table):
+        self.topics = topics  # unique topic ids, sorted
+        self.topic = topic  # int32 index into topics
+        self.docid = docid  # int32 index into table
+        self.rank = rank  # rank column from the file
+        self.score = score
+        self.table = table
+        self.offsets = np.searchsorted(topic, np.arange(len(topics) + 1))
+
+    def __len__(self):
+        return len(self.docid)
+
+    def positions(self):
+        # 0-based position of each row within its topic ranking.
+        return np.arange(len(self.topic)) - self.offsets[self.topic]
+
+    def topic_slice(self, topic):
+        t = np.searchsorted(self.topics, topic)
+        if t == len(self.topics) or self.topics[t] != topic:
+            return slice(0, 0)
+        return slice(self.offsets[t], self.offsets[t + 1])
+
+    def top(self, topic, n=None):
+        # Docid codes of a topic ranking, optionally cut at n.
+        rows = self.topic_slice(topic)
+        codes = self.docid[rows]
+        return codes if n is None else codes[:n]
+
+    def ranking(self, topic, n=None):
+        return list(self.table.lookup(self.top(topic, n)))
+
+    def top_docids(self, k):
+        # Topic x rank matrix of the docids in the top k, None where empty.
+        rows, topic, rank = top_rows(self.offsets, k)
+        matrix = np.full((len(self.topics), k), None, dtype=object)
+        matrix[topic, rank] = self.table.lookup(self.docid[rows])
+        return matrix
+
+    def topic_rows(self, topic, start=0, stop=None):
+        # Docids and scores at positions start:stop of a topic ranking.
+        rows = self.topic_slice(topic)
+        rows = slice(rows.start + start, clip_stop(rows, stop))
+        return self.table.lookup(self.docid[rows]), self.score[rows]
+
+    def frame(self, name="run"):
+        # Long DataFrame in TREC run column order.
+        return pd.DataFrame(
+            {
+                "query": self.topics[self.topic],
+                "q0": "Q0",
+                "docid": self.table.lookup(self.docid),
+                "rank": self.rank,
+                "score": self.score,
+                "system": name,
+            }
+        )
+
+
+def read_run_csv(source, chunksize=None):
+    # 886 Q0 39fff39a71e2e8e0aeaf1666f7d78697 1 1.0 run1
+    return pd.read_csv(
+        source,
+        sep=r"\s+",
+        header=None,
+        usecols=[0, 2, 3, 4],
+        names=["topic", "docid", "rank", "score"],
+        dtype={"topic": str, "docid": str, "rank": np.int32, "score": np.float64},
+        # Exact scores, as trec_eval reads them: the default parser can make
+        # scores one ulp apart (e.g. of a fusion) equal, which reorders ties.
+        float_precision="round_trip",
+        chunksize=chunksize,
+    )
+
+
+@metrics.timed("parse run")
+def parse_run(path, table=docid_table):
+    metrics.inc("bytes_parsed_total", os.path.getsize(path), kind="run")
+    with open_binary(path) as f:
+        return run_columns(read_run_csv(f))
+
+
+def run_columns(df):
+    # Snapshot columns of a parsed run, grouped by topic in trec_eval order.
+    df = df.sort_values(
+        ["topic", "score", "docid"], ascending=[True, False, False], kind="mergesort"
+    )
+    topic_codes, topics = pd.factorize(df["topic"], sort=True)
+    local_codes, docids = pd.factorize(df["docid"])
+    return (
+        np.asarray(topics, dtype=object),
+        topic_codes.astype(np.int32),
+        local_codes.astype(np.int32),
+        np.asarray(docids, dtype=object),
+        df["rank"].values,
+        df["score"].values,
+    )
+
+
+class RunBuilder:
+    # Parses a run from text chunks as they arrive (e.g. during an upload).
+    # Every chunk is spilled to files in `folder`: its columns, with topics
+    # and docids coded against the chunk's own vocabulary, appended to one
+    # file each. Memory holds a chunk and the unfinished last line; docids
+    # are interned when the snapshot is loaded. Chunks of a compressed file
+    # (see compression.py) are decompressed first. The state of a plain text
+    # run can be saved to the folder and resumed, e.g. by another process.
+
+    COLUMNS = {
+        "topic": np.int32,
+        "docid": np.int32,
+        "rank": np.int32,
+        "score": np.float64,
+    }
+
+    def __init__(self, folder, name="", resume=False):
+        self.folder = folder
+        ext = compression(name)
+        self.decompressor = Decompressor(ext) if ext else None
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.tail = ""
+        self.rows = 0
+        self.vocabulary = {"topics": 0, "docids": 0}  # lines spilled
+        self.offset = 0  # input bytes fed, as of the saved state
+        if resume:
+            self.load()
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder)
+
+    def file(self, name):
+        return os.path.join(self.folder, name)
+
+    def feed(self, data, final=False):
+        metrics.inc("bytes_parsed_total", len(data), kind="upload")
+        if self.decompressor:
+            data = self.decompressor.decompress(data)
+            if final:
+                self.decompressor.check_end()
+        text = self.tail + self.decoder.decode(data, final)
+        end = len(text) if final else text.rfind("\n") + 1
+        self.tail = text[end:]
+        if text[:end].strip():
+            self.spill(read_run_csv(StringIO(text[:end])))
+
+    def spill(self, df):
+        # Codes of a chunk point into the lines of topics.txt and docids.txt.
+        topic, topics = pd.factorize(df["topic"])
+        docid, docids = pd.factorize(df["docid"])
+        for name, values in (("topics", topics), ("docids", docids)):
+            with open(self.file(f"{name}.txt"), "a") as f:
+                f.write("\n".join(values) + "\n")
+        columns = {
+            "topic": topic + self.vocabulary["topics"],
+            "docid": docid + self.vocabulary["docids"],
+            "rank": df["rank"].values,
+            "score": df["score"].values,
+        }
+        for name, dtype in self.COLUMNS.items():
+            with open(self.file(f"{name}.bin"), "ab") as f:
+                columns[name].astype(dtype).tofile(f)
+        self.vocabulary["topics"] += len(topics)
+        self.vocabulary["docids"] += len(docids)
+        self.rows += len(df)
+
+    def save(self, offset):
+        # State after `offset` bytes of input. A decompressor cannot be saved.
+        if self.decompressor:
+            raise ValueError("Cannot save the state of a compressed run")
+        state = {
+            "offset": offset,
+            "rows": self.rows,
+            "vocabulary": self.vocabulary,
+            "tail": self.tail,
+            "pending": self.decoder.getstate()[0].hex(),
+            "sizes": {
+                file: os.path.getsize(self.file(file))
+                for file in os.listdir(self.folder)
+                if file != "state.json"
+            },
+        }
+        with open(self.file("state.json.tmp"), "w") as f:
+            json.dump(state, f)
+        os.replace(self.file("state.json.tmp"), self.file("state.json"))
+
+    def load(self):
+        # Back to the saved state: spilled files are cut to their size then,
+        # in case they were appended to after it.
+        with open(self.file("state.json")) as f:
+            state = json.load(f)
+        for file in os.listdir(self.folder):
+            if file != "state.json":
+                os.truncate(self.file(file), state["sizes"].get(file, 0))
+        self.offset = state["offset"]
+        self.rows = state["rows"]
+        self.vocabulary = state["vocabulary"]
+        self.tail = state["tail"]
+        self.decoder.setstate((bytes.fromhex(state["pending"]), 0))
+
+    def unique_lines(self, name):
+        # Sorted unique lines of a spilled vocabulary and the code of each line.
+        with open(self.file(f"{name}.txt")) as f:
+            lines = np.array(f.read().split("\n")[:-1], dtype=object)
+        unique, codes = np.unique(lines, return_inverse=True)
+        return unique, codes.astype(np.int32)
+
+    def finish(self):
+        # Snapshot columns, as returned by parse_run. Rows are sorted as in
+        # run_columns: only the sort keys are in memory, the sorted columns
+        # are memory-mapped from the folder.
+        self.feed(b"", final=True)
+        if not self.rows:
+            raise ValueError("Empty run")
+        spilled = {
+            name: np.memmap(self.file(f"{name}.bin"), dtype, mode="r")
+            for name, dtype in self.COLUMNS.items()
+        }
+        # Sorted vocabularies, so codes order like the strings do.
+        topics, topic_codes = self.unique_lines("topics")
+        docids, docid_codes = self.unique_lines("docids")
+        order = np.lexsort(
+            (
+                -docid_codes[spilled["docid"]],
+                -spilled["score"],
+                topic_codes[spilled["topic"]],
+            )
+        )
+
+        columns = {}
+        for name, dtype in self.COLUMNS.items():
+            columns[name] = np.lib.format.open_memmap(
+                self.file(f"{name}.npy"), mode="w+", dtype=dtype, shape=(self.rows,)
+            )
+            codes = {"topic": topic_codes, "docid": docid_codes}.get(name)
+            for start in range(0, self.rows, SORT_BLOCK):
+                rows = order[start : start + SORT_BLOCK]
+                values = spilled[name][rows]
+                columns[name][start : start + SORT_BLOCK] = (
+                    values if codes is None else codes[values]
+                )
+            columns[name].flush()
+        return (
+            topics,
+            columns["topic"],
+            columns["docid"],
+            docids,
+            columns["rank"],
+            columns["score"],
+        )
+
+    def discard(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def clip_stop(rows, stop):
+    return rows.stop if stop is None else min(rows.stop, rows.start + stop)
+
+
+def top_rows(offsets, k):
+    # Rows of the top k of every topic, given the topic offsets, and their
+    # (topic, rank) cells.
+    lengths = np.minimum(np.diff(offsets), k)
+    topic = np.repeat(np.arange(len(lengths)), lengths)
+    rank = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.asarray(offsets)[topic] + rank, topic, rank
+
+
+def snapshot_path(path):
+    # runs/sample1.txt -> runs/.snapshots/sample1.txt
+    folder, name = os.path.split(path)
+    return os.path.join(folder, SNAPSHOT_DIR, name)
+
+
+def write_snapshot(path, topics, topic, local, docids, rank, score):
+    st = os.stat(path)
+    target = snapshot_path(path)
+    tmp = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.makedirs(tmp)
+
+    # The docid vocabulary is one line per local code; byte offsets of the
+    # lines let single docids be read from the memory map.
+    blob = "\n".join(docids).encode()
+    breaks = np.flatnonzero(np.frombuffer(blob, dtype=np.uint8) == ord("\n"))
+    for name, array in (
+        ("topic", topic),
+        ("docid", local),
+        ("rank", rank),
+        ("score", score),
+        ("offsets", np.searchsorted(topic, np.arange(len(topics) + 1))),
+        ("docid_offsets", np.concatenate([[0], breaks + 1, [len(blob) + 1]])),
+    ):
+        np.save(os.path.join(tmp, f"{name}.npy"), array)
+    with open(os.path.join(tmp, "docids.txt"), "wb") as f:
+        f.write(blob)
+    with open(os.path.join(tmp, "topics.txt"), "w") as f:
+        f.write("\n".join(topics))
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "version": SNAPSHOT_VERSION,
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+            },
+            f,
+        )
+
+    shutil.rmtree(target, ignore_errors=True)
+    try:
+        os.replace(tmp, target)
+    except OSError:
+        # Another process put its snapshot of the same file in place first.
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def snapshot_array(target, name):
+    if name == "docids":
+        return np.memmap(os.path.join(target, "docids.txt"), np.uint8, mode="r")
+    return np.load(os.path.join(target, f"{name}.npy"), mmap_mode="r")
+
+
+def open_snapshot(path, names):
+    # Memory-mapped arrays and topics of a snapshot, None if missing or stale.
+    # "docids" are the bytes of the docid vocabulary (see vocabulary).
+    target = snapshot_path(path)
+    try:
+        with open(os.path.join(target, "meta.json")) as f:
+            meta = json.load(f)
+        st = os.stat(path)
+        if (meta["version"], meta["size"], meta["mtime_ns"]) != (
+            SNAPSHOT_VERSION,
+            st.st_size,
+            st.st_mtime_ns,
+        ):
+            return None
+
+        arrays = {name: snapshot_array(target, name) for name in names}
+        with open(os.path.join(target, "topics.txt")) as f:
+            arrays["topics"] = np.array(f.read().split("\n"), dtype=object)
+    except (OSError, ValueError, KeyError):
+        return None
+    return arrays
+
+
+def vocabulary(blob):
+    # Docids of a snapshot's docids.txt, split in one pass.
+    return np.array(blob.tobytes().decode().split("\n"), dtype=object)
+
+
+def read_snapshot(path):
+    # Columns of a snapshot, as returned by parse_run, or None.
+    arrays = open_snapshot(path, ("topic", "docid", "docids", "rank", "score"))
+    if arrays is None:
+        return None
+    return (
+        arrays["topics"],
+        arrays["topic"],
+        arrays["docid"],
+        vocabulary(arrays["docids"]),
+        arrays["rank"],
+        arrays["score"],
+    )
+
+
+class TopicIndex:
+    # Single topics of a run, read from its snapshot: the topic offsets give
+    # the rows, and only the docids of those rows are decoded.
+
+    def __init__(self, arrays):
+        self.topics = arrays["topics"]
+        self.offsets = arrays["offsets"]
+        self.docid = arrays["docid"]
+        self.docids = arrays["docids"]
+        self.docid_offsets = arrays["docid_offsets"]
+        self.score = arrays["score"]
+
+    def lookup(self, codes):
+        starts, stops = self.docid_offsets[codes], self.docid_offsets[codes + 1] - 1
+        return np.array(
+            [self.docids[a:b].tobytes().decode() for a, b in zip(starts, stops)],
+            dtype=object,
+        )
+
+    def topic_rows(self, topic, start=0, stop=None):
+        # Docids and scores at positions start:stop of a topic ranking.
+        t = np.searchsorted(self.topics, topic)
+        if t == len(self.topics) or self.topics[t] != topic:
+            return np.array([], dtype=object), np.array([])
+        rows = slice(self.offsets[t], self.offsets[t + 1])
+        rows = slice(rows.start + start, clip_stop(rows, stop))
+        return self.lookup(self.docid[rows]), np.asarray(self.score[rows])
+
+    def top_docids(self, k):
+        # Topic x rank matrix of the docids in the top k, None where empty;
+        # each docid is decoded once.
+        rows, topic, rank = top_rows(self.offsets, k)
+        codes, inverse = np.unique(self.docid[rows], return_inverse=True)
+        matrix = np.full((len(self.topics), k), None, dtype=object)
+        matrix[topic, rank] = self.lookup(codes)[inverse]
+        return matrix
+
+
+@lru_cache(maxsize=256)
+def _topic_index(path, size, mtime_ns):
+    names = ("offsets", "docid", "docids", "docid_offsets", "score")
+    arrays = open_snapshot(path, names)
+    if arrays is None:
+        # Not ingested yet: parse once, which writes the snapshot.
+        run = load_run(path)
+        arrays = open_snapshot(path, names)
+        if arrays is None:
+            # Read-only folder, the parsed run it is.
+            return run
+    return TopicIndex(arrays)
+
+
+def topic_rows(path, topic, start=0, stop=None):
+    # One topic of a run file, without loading the rest of the run.
+    st = os.stat(path)
+    return _topic_index(path, st.st_size, st.st_mtime_ns).topic_rows(topic, start, stop)
+
+
+def top_docids(path, k):
+    # Topics of a run file and the docids of their top k, without loading
+    # the rest of the run.
+    st = os.stat(path)
+    index = _topic_index(path, st.st_size, st.st_mtime_ns)
+    return index.topics, index.top_docids(k)
+
+
+def snapshot_run(path, table=docid_table):
+    # Columns of a run, parsed from the text file into a snapshot if it has
+    # no up-to-date one.
+    parsed = read_snapshot(path)
+    if parsed is None:
+        parsed = parse_run(path, table)
+        try:
+            write_snapshot(path, *parsed)
+        except OSError:
+            # Read-only folder, work from the parsed text.
+            pass
+    return parsed
+
+
+def ingest_run(path):
+    # Validate a run and write its snapshot, without keeping it in memory.
+    # Raises for files that are not TREC runs.
+    if open_snapshot(path, ()) is None:
+        snapshot_run(path)
+
+
+@lru_cache(maxsize=64)
+def _load_run(path, size, mtime_ns, table):
+    parsed = snapshot_run(path, table)
+    topics, topic, local, docids, rank, score = parsed
+    docid = table.intern(docids)[local]
+    return Run(topics, topic, docid, rank, score, table)
+
+
+def load_run(path, table=docid_table):
+    # Parsed run, from memory, its binary snapshot or the text file.
+    st = os.stat(path)
+    return _load_run(path, st.st_size, st.st_mtime_ns, table)
+
+
+def drop_snapshot(path):
+    shutil.rmtree(snapshot_path(path), ignore_errors=True)
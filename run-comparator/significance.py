@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from batch import WORKERS, get_pool
+
+SIGNIFICANCE_COLUMNS = [
+    "diff",
+    "t",
+    "p_ttest",
+    "p_permutation",
+    "ci_low",
+    "ci_high",
+]
+
+
+def paired_differences(base, scores):
+    # Topic x run differences with the base (NaN where a topic is missing),
+    # the same differences with NaN as 0, and the number of pairs per run.
+    diffs = scores.sub(base.reindex(scores.index), axis=0).values
+    valid = ~np.isnan(diffs)
+    return diffs, np.where(valid, diffs, 0.0), valid
+
+
+def ttest(diffs, valid):
+    # Paired t-test of every column at once, as scipy.stats.ttest_rel.
+    n = valid.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.nansum(diffs, axis=0) / n
+        sd = np.sqrt(np.nansum((diffs - mean) ** 2, axis=0) / (n - 1))
+        t = mean / (sd / np.sqrt(n))
+    p = 2 * stats.t.sf(np.abs(t), n - 1)
+    return mean, t, p
+
+
+def sign_flips(filled, n, size, seed):
+    # Exceedances of |mean difference| under random sign flips of the topics.
+    rng = np.random.default_rng(seed)
+    observed = np.abs(filled.sum(axis=0) / n)
+    signs = rng.integers(0, 2, size=(size, len(filled))) * 2 - 1.0
+    permuted = np.abs(signs @ filled / n)
+    return (permuted >= observed - 1e-12).sum(axis=0)
+
+
+def bootstrap_means(filled, valid, size, seed):
+    # Mean differences over topics resampled with replacement.
+    rng = np.random.default_rng(seed)
+    counts = rng.multinomial(len(filled), np.full(len(filled), 1 / len(filled)), size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (counts @ filled) / (counts @ valid)
+
+
+def batched(func, args, total, seed, workers, chunk=1000):
+    # Split `total` resamples over worker processes with independent seeds.
+    sizes = [min(chunk, total - start) for start in range(0, total, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    jobs = [args + (size, s) for size, s in zip(sizes, seeds)]
+    if workers > 1 and len(jobs) > 1:
+        pool = get_pool(workers)
+        return list(pool.map(func, *zip(*jobs)))
+    return [func(*job) for job in jobs]
+
+
+def holm(p):
+    # Holm-Bonferroni adjusted p-values, NaN left untouched.
+    adjusted = np.full(len(p), np.nan)
+    tested = np.flatnonzero(~np.isnan(p))
+    order = tested[np.argsort(p[tested])]
+    m = len(order)
+    steps = np.maximum.accumulate((m - np.arange(m)) * p[order])
+    adjusted[order] = np.minimum(steps, 1)
+    return adjusted
+
+
+def benjamini_hochberg(p):
+    # Benjamini-Hochberg adjusted p-values, NaN left untouched.
+    adjusted = np.full(len(p), np.nan)
+    tested = np.flatnonzero(~np.isnan(p))
+    order = tested[np.argsort(p[tested])]
+    m = len(order)
+    steps = p[order] * m / np.arange(1, m + 1)
+    adjusted[order] = np.minimum(np.minimum.accumulate(steps[::-1])[::-1], 1)
+    return adjusted
+
+
+CORRECTIONS = {"holm": holm, "bh": benjamini_hochberg}
+
+
+def significance(
+    base,
+    scores,
+    permutations=10000,
+    bootstrap=10000,
+    confidence=0.95,
+    correction=None,
+    seed=0,
+    workers=WORKERS,
+):
+    # Paired tests of every run (columns of `scores`) against the base run's
+    # per-topic scores: t-test, sign-flip permutation test and a bootstrap
+    # confidence interval of the mean difference, run x column DataFrame.
+    diffs, filled, valid = paired_differences(base, scores)
+    n = valid.sum(axis=0)
+    mean, t, p_ttest = ttest(diffs, valid)
+
+    exceed = batched(sign_flips, (filled, n), permutations, seed, workers)
+    p_permutation = (1 + np.sum(exceed, axis=0)) / (1 + permutations)
+
+    means = np.concatenate(
+        batched(bootstrap_means, (filled, valid), bootstrap, seed + 1, workers)
+    )
+    tail = 100 * (1 - confidence) / 2
+    with np.errstate(invalid="ignore"):
+        ci_low, ci_high = np.nanpercentile(means, [tail, 100 - tail], axis=0)
+
+    result = pd.DataFrame(
+        np.column_stack([mean, t, p_ttest, p_permutation, ci_low, ci_high]),
+        index=scores.columns,
+        columns=SIGNIFICANCE_COLUMNS,
+    )
+    result.loc[n < 2, ["p_ttest", "p_permutation"]] = np.nan
+    if correction:
+        for column in ["p_ttest", "p_permutation"]:
+            result[column] = CORRECTIONS[correction](result[column].values)
+    return result
@@ -0,0 +1,362 @@
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from batch import WORKERS, evaluate_folder, score_matrix
+from cache import score_cache
+from evaluator import cached_scores, evaluate
+from folder_index import run_index
+from metrics import metrics
+from overlap import OVERLAP_COLUMNS, compare_tops, top_matrix
+from pairs import PAIR_COLUMNS, compare_pairs, pair_matrix
+from qrels import qrels_registry
+from runstore import docid_table, load_run, top_docids, topic_rows
+
+# Intermediate results of the dashboard callbacks. Every stage is memoized on
+# the size and mtime of the files it reads, so a callback only recomputes
+# what its inputs invalidate.
+
+RUN_COLUMNS = 4096  # per-topic scores kept in memory
+PERMUTATIONS = int(os.environ.get("RUN_COMPARATOR_PERMUTATIONS", 10000))
+BOOTSTRAP = int(os.environ.get("RUN_COMPARATOR_BOOTSTRAP", 10000))
+
+
+def fingerprint(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+@metrics.timed("qrels")
+def qrels_stage(qrels):
+    return qrels_registry.get("qrels/" + qrels)
+
+
+@lru_cache(maxsize=64)
+def _run(run, run_fp):
+    return load_run("runs/" + run)
+
+
+@metrics.timed("run")
+def run_stage(run):
+    return _run(run, fingerprint("runs/" + run))
+
+
+@lru_cache(maxsize=256)
+def _run_scores(metric, qrels, run, qrels_fp, run_fp):
+    return evaluate(metric, "qrels/" + qrels, run)
+
+
+@metrics.timed("run scores")
+def run_scores(metric, qrels, run):
+    # Per-topic DataFrame of one run.
+    return _run_scores(
+        metric, qrels, run, fingerprint("qrels/" + qrels), fingerprint("runs/" + run)
+    )
+
+
+class RunColumns:
+    # Per-topic scores of evaluated runs, {(metric, qrels, qrels_fp, run
+    # digest): scores}: the most recently used ones, shared by the callback
+    # threads and the jobs. added counts the scores ever put, which only
+    # grows (see data_state).
+
+    def __init__(self, size=RUN_COLUMNS):
+        self.size = size
+        self.columns = OrderedDict()
+        self.added = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            scores = self.columns.get(key)
+            if scores is not None:
+                self.columns.move_to_end(key)
+            return scores
+
+    def put(self, key, scores):
+        with self.lock:
+            self.columns[key] = scores
+            self.columns.move_to_end(key)
+            self.added += 1
+            while len(self.columns) > self.size:
+                self.columns.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.columns.clear()
+
+
+_run_columns = RunColumns()
+
+
+@metrics.timed("all scores")
+def all_scores(metric, qrels, job=None, state=None):
+    # Topic x run DataFrame of the valid runs in the folder that are
+    # evaluated. Only a background job (see jobs.evaluation_job) evaluates
+    # new or changed runs, in chunks to report progress; without one, runs
+    # another process evaluated come from the score cache and the others
+    # are left out (see missing_runs). state is the runs_state() to take the
+    # runs from, so the stages of one callback see the same runs.
+    qrels_fp = fingerprint("qrels/" + qrels)
+    state = runs_state() if state is None else state
+    keys = {run: (metric, qrels, qrels_fp, digest) for run, digest in state}
+    columns = {run: _run_columns.get(key) for run, key in keys.items()}
+
+    missing = [run for run, scores in columns.items() if scores is None]
+    if job is None:
+        for run in missing:
+            scores = cached_scores(metric, "qrels/" + qrels, run)
+            if scores is not None:
+                columns[run] = scores[run].dropna()
+                _run_columns.put(keys[run], columns[run])
+        missing = []
+    chunk = 4 * WORKERS
+    for start in range(0, len(missing), chunk):
+        job.check()
+        job.report(start / len(missing), f"{start}/{len(missing)} runs")
+        df_new, _ = evaluate_folder(
+            metric, "qrels/" + qrels, missing[start : start + chunk]
+        )
+        for run in df_new.columns:
+            columns[run] = df_new[run].dropna()
+            _run_columns.put(keys[run], columns[run])
+
+    return score_matrix(
+        [(run, scores) for run, scores in columns.items() if scores is not None]
+    )
+
+
+def missing_runs(df_all):
+    # Valid runs of the folder that all_scores left out.
+    return [run for run in run_index.runs() if run not in df_all.columns]
+
+
+@lru_cache(maxsize=16)
+def _topic_data(metric, qrels, run1, run2, depth, qrels_fp, run1_fp, run2_fp):
+    qrels_data = qrels_stage(qrels)
+    topics = qrels_data.topics
+    rows = np.arange(len(topics))[:, None]
+    tops = [top_matrix(run_stage(run), topics, depth) for run in (run1, run2)]
+    lengths = [(top >= 0).sum(axis=1) for top in tops]
+    grades = [qrels_data.lookup(np.broadcast_to(rows, top.shape), top) for top in tops]
+
+    # A docid of run2 is new if run1 does not have it in the ranks both
+    # runs have.
+    keys = [np.where(top >= 0, rows << 32 | top, -1) for top in tops]
+    shown = np.arange(depth) < np.minimum(*lengths)[:, None]
+    new = ~np.isin(keys[1], keys[0][shown])
+
+    # Docids are sent once, rankings as indexes into them.
+    ranked = np.stack(tops)
+    codes, inverse = np.unique(ranked[ranked >= 0], return_inverse=True)
+    index = np.full(ranked.shape, -1)
+    index[ranked >= 0] = inverse
+
+    scores = [
+        run_scores(metric, qrels, run)[run].reindex(topics) for run in (run1, run2)
+    ]
+
+    def ragged(matrix, lengths):
+        return [row[:n].tolist() for row, n in zip(matrix, lengths)]
+
+    return {
+        "topics": list(topics),
+        "runs": [run1, run2],
+        "docids": list(docid_table.lookup(codes)),
+        "rankings": [ragged(index[j], lengths[j]) for j in range(2)],
+        "grades": [ragged(grades[j], lengths[j]) for j in range(2)],
+        "new": ragged(new, lengths[1]),
+        "scores": [s.astype(object).where(s.notna(), None).tolist() for s in scores],
+    }
+
+
+@metrics.timed("topic data")
+def topic_data(metric, qrels, run1, run2, depth):
+    # Top depth docids of both runs for every topic of the qrels, with their
+    # grades and per-topic scores, for browsing topics in the browser:
+    #   docids    every docid in the rankings, once
+    #   rankings  per run and topic, indexes into docids
+    #   grades    per run and topic, relevance of each ranked docid
+    #   new       per topic, whether each docid of run2 is new (see above)
+    #   scores    per run, score of each topic (None if the run misses it)
+    return _topic_data(
+        metric,
+        qrels,
+        run1,
+        run2,
+        depth,
+        fingerprint("qrels/" + qrels),
+        fingerprint("runs/" + run1),
+        fingerprint("runs/" + run2),
+    )
+
+
+@lru_cache(maxsize=256)
+def _topic_ranking(qrels, run, top, depth, qrels_fp, run_fp):
+    docids, _ = topic_rows("runs/" + run, top, stop=depth)
+    return docids, qrels_stage(qrels).grades(top, docid_table.codes(docids))
+
+
+@metrics.timed("topic ranking")
+def topic_ranking(qrels, run, top, depth):
+    # Top depth docids of one topic with their grades, read from the run's
+    # topic index: the ranking pages past the ones of topic_data.
+    return _topic_ranking(
+        qrels,
+        run,
+        top,
+        depth,
+        fingerprint("qrels/" + qrels),
+        fingerprint("runs/" + run),
+    )
+
+
+def runs_state():
+    # (run, content digest) of every valid run in the folder.
+    run_index.refresh()
+    return tuple((run, run_index.digest(run)) for run in run_index.runs())
+
+
+def data_state(qrels):
+    # Key of everything the figures are computed from, including how many
+    # scores all_scores has put, which only grows.
+    return fingerprint("qrels/" + qrels), runs_state(), _run_columns.added
+
+
+@lru_cache(maxsize=256)
+def _top(run, k, digest):
+    topics, docids = top_docids("runs/" + run, k)
+    codes = np.full(docids.shape, -1, dtype=np.int64)
+    found = pd.notna(docids)
+    unique, inverse = np.unique(docids[found], return_inverse=True)
+    codes[found] = docid_table.intern(unique)[inverse]
+    return topics, codes
+
+
+@metrics.timed("top")
+def top_stage(run, k):
+    # Topics of a run and the topic x rank matrix of the docid codes in their
+    # top k (-1 where empty), from the run's topic index: only the top k
+    # docids are read. Cached by the content digest of the run.
+    return _top(run, k, run_index.digest(run))
+
+
+@metrics.timed("overlap")
+def overlap_stage(run1, n, job=None, state=None):
+    # run x column DataFrame of the overlap of the base run with every run
+    # in the folder (see overlap.compare_tops), and the runs not compared
+    # yet, which are NaN. Rows are stored on disk per base run and n, by
+    # the digest of the other run; only a job (jobs.overlap_job) compares
+    # the missing runs, so a new run costs one comparison.
+    state = runs_state() if state is None else state
+    digests = dict(state)
+    key = ("overlap", digests[run1], n)
+    known = score_cache.get_frame(key, [digests[run1]])
+    if known is None:
+        known = pd.DataFrame(columns=OVERLAP_COLUMNS, dtype=float)
+    missing = [run for run, digest in state if digest not in known.index]
+    if job is not None and missing:
+        base = top_stage(run1, n)
+        rows = {}
+        for i, run in enumerate(missing):
+            job.check()
+            job.report(i / len(missing), f"{i}/{len(missing)} runs")
+            rows[digests[run]] = compare_tops(base, top_stage(run, n))
+        new = pd.DataFrame.from_dict(rows, orient="index", columns=OVERLAP_COLUMNS)
+        known = pd.concat([known[known.index.isin(list(digests.values()))], new])
+        known = known[~known.index.duplicated(keep="last")]
+        score_cache.put_frame(key, known, [digests[run1]])
+        missing = []
+    summary = known.reindex([digest for _, digest in state])
+    summary.index = [run for run, _ in state]
+    return summary, missing
+
+
+@lru_cache(maxsize=64)
+def _significance(metric, qrels, run1, correction, qrels_fp, runs_state, scored):
+    # Stored on disk once every run is evaluated, see all_scores.
+    key = (
+        "significance",
+        metric,
+        qrels_fp,
+        run1,
+        runs_state,
+        correction,
+        PERMUTATIONS,
+        BOOTSTRAP,
+    )
+    # Named after the qrels and the base run, entries of earlier states of
+    # the other runs are no longer read and age out of the cache.
+    files = [qrels_fp, dict(runs_state)[run1]]
+    result = score_cache.get_frame(key, files)
+    if result is None:
+        # scipy is only imported once a test is asked for.
+        from significance import significance
+
+        df_all = all_scores(metric, qrels, state=runs_state)
+        df_all = df_all.reindex(columns=list(scored))
+        result = significance(
+            df_all[run1],
+            df_all.drop(columns=run1),
+            permutations=PERMUTATIONS,
+            bootstrap=BOOTSTRAP,
+            correction=correction,
+        )
+        if len(scored) == len(runs_state):
+            score_cache.put_frame(key, result, files)
+    return result
+
+
+@metrics.timed("significance")
+def significance_stage(metric, qrels, run1, correction=None, df_all=None, state=None):
+    # Tests of every run in the folder against the base run, on disk and
+    # in memory next to the per-topic scores. df_all and state, of
+    # all_scores and runs_state, test the runs a callback already has.
+    qrels_fp = score_cache.digest("qrels/" + qrels)
+    state = runs_state() if state is None else state
+    if df_all is None:
+        df_all = all_scores(metric, qrels, state=state)
+    scored = tuple(df_all.columns)
+    return _significance(metric, qrels, run1, correction, qrels_fp, state, scored)
+
+
+@lru_cache(maxsize=16)
+def _pairs(metric, qrels, k, qrels_fp, runs_state, scored):
+    # Pairs are stored per (metric, qrels, k) and grow with the folder: only
+    # pairs with a new or changed run are computed. They are stored once
+    # every run is evaluated, so pairs of runs not scored yet are kept.
+    key = ("pairs", metric, qrels_fp, k)
+    known = score_cache.get_frame(key, [qrels_fp])
+    digests = {run: digest for run, digest in runs_state if run in scored}
+    df_all = all_scores(metric, qrels, state=runs_state)
+    df_all = df_all.reindex(columns=list(digests))
+    pairs, added = compare_pairs(known, df_all, digests, lambda run: top_stage(run, k))
+    complete = len(scored) == len(runs_state)
+    if complete and (added or known is None or len(pairs) < len(known)):
+        score_cache.put_frame(key, pairs, [qrels_fp])
+    return {column: pair_matrix(pairs, digests, column) for column in PAIR_COLUMNS}
+
+
+@metrics.timed("pairs")
+def pairs_stage(metric, qrels, k):
+    # {column: run x run DataFrame} of all pairs of runs, see pairs.py.
+    qrels_fp = score_cache.digest("qrels/" + qrels)
+    state = runs_state()
+    scored = tuple(all_scores(metric, qrels, state=state).columns)
+    return _pairs(metric, qrels, k, qrels_fp, state, scored)
+
+
+for stage, func in [
+    ("run", _run),
+    ("run scores", _run_scores),
+    ("topic data", _topic_data),
+    ("topic ranking", _topic_ranking),
+    ("top", _top),
+    ("significance", _significance),
+    ("pairs", _pairs),
+]:
+    metrics.register_cache(stage, func)
@@ -0,0 +1,210 @@
+import math
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from compression import compression, open_binary
+from fusion import fuse, tmp_path, write_fused
+from runstore import DocidTable, Run, docid_table, read_run_csv, run_columns
+
+# Evaluation and fusion of runs larger than memory, a group of whole topics
+# at a time, within a memory budget (RUN_COMPARATOR_MEMORY_MB):
+# - a run with its topics in ascending order is read in one pass, chunk by
+#   chunk, holding back the last topic of a chunk until the next one;
+# - any other run is spilled to disk in buckets by topic hash (an external
+#   sort), and each bucket is sorted in memory.
+# Topics are scored and fused the same way as in memory, per topic.
+
+MEMORY_MB = int(os.environ.get("RUN_COMPARATOR_MEMORY_MB", 512))
+SPILL_DIR = os.environ.get("RUN_COMPARATOR_SPILL_DIR")  # default: system temp
+ROW_BYTES = 250  # a parsed row in memory, docid string included
+LINE_BYTES = 60  # a line of a run file
+COMPRESSION_RATIO = 5
+
+
+class Unsorted(Exception):
+    pass
+
+
+def topic_key(topic):
+    # Numeric topics in numeric order, before any others.
+    return (0, int(topic), "") if topic.isdigit() else (1, 0, topic)
+
+
+def chunk_rows(memory_mb):
+    return max(1000, memory_mb * 2 ** 20 // ROW_BYTES)
+
+
+def sorted_chunks(path, rows):
+    # DataFrames of whole topics of a run whose topics come in ascending
+    # order (topic_key); raises Unsorted as soon as one does not.
+    carry = None
+    with open_binary(path) as f:
+        for df in read_run_csv(f, chunksize=rows):
+            if carry is not None:
+                df = pd.concat([carry, df], ignore_index=True)
+            topics = df["topic"].values
+            starts = np.flatnonzero(np.r_[True, topics[1:] != topics[:-1]])
+            keys = [topic_key(topic) for topic in topics[starts]]
+            if any(a >= b for a, b in zip(keys, keys[1:])):
+                raise Unsorted(path)
+            # The last topic may go on in the next chunk.
+            carry = df.iloc[starts[-1] :]
+            if starts[-1]:
+                yield df.iloc[: starts[-1]]
+    if carry is not None:
+        yield carry
+
+
+def buckets_for(path, memory_mb):
+    # Number of spill buckets so that each fits the budget.
+    size = os.path.getsize(path)
+    if compression(path):
+        size *= COMPRESSION_RATIO
+    rows = size / LINE_BYTES
+    return max(2, math.ceil(rows * ROW_BYTES / (memory_mb * 2 ** 20)))
+
+
+def spill(path, folder, buckets, rows):
+    # Rows of a run in `buckets` TREC files by topic hash, returns their paths.
+    paths = [os.path.join(folder, f"{i}.txt") for i in range(buckets)]
+    with open_binary(path) as f:
+        for df in read_run_csv(f, chunksize=rows):
+            hashes = pd.util.hash_array(df["topic"].values.astype(object))
+            for bucket, part in df.groupby(hashes % buckets):
+                pd.DataFrame(
+                    {
+                        "topic": part["topic"],
+                        "q0": "Q0",
+                        "docid": part["docid"],
+                        "rank": part["rank"],
+                        "score": part["score"],
+                        "tag": "spill",
+                    }
+                ).to_csv(paths[bucket], mode="a", sep=" ", header=False, index=False)
+    return paths
+
+
+def read_bucket(path):
+    # All rows of a spill bucket, or None if no topic hashed to it.
+    if not os.path.exists(path):
+        return None
+    return read_run_csv(path)
+
+
+def chunk_run(df, table=None):
+    # Run of a chunk of whole topics. Without a table docids get their codes
+    # in the global table (-1 if unseen, e.g. unjudged), so it does not grow.
+    topics, topic, local, docids, rank, score = run_columns(df)
+    if table is None:
+        return Run(topics, topic, docid_table.codes(docids)[local], rank, score)
+    return Run(topics, topic, table.intern(docids)[local], rank, score, table)
+
+
+def map_chunks(func, path, memory_mb=MEMORY_MB):
+    # [func(Run) for every chunk of whole topics of the run file].
+    rows = chunk_rows(memory_mb)
+    try:
+        return [func(chunk_run(df)) for df in sorted_chunks(path, rows)]
+    except Unsorted:
+        pass
+    with tempfile.TemporaryDirectory(dir=SPILL_DIR) as folder:
+        buckets = spill(path, folder, buckets_for(path, memory_mb), rows)
+        results = []
+        for bucket in buckets:
+            df = read_bucket(bucket)
+            if df is not None:
+                results.append(func(chunk_run(df)))
+        return results
+
+
+def evaluate_stream(names, qrels, path, memory_mb=MEMORY_MB):
+    # evaluator.evaluate_metrics of a run file that need not fit in memory.
+    from evaluator import evaluate_metrics
+
+    frames = map_chunks(
+        lambda run: evaluate_metrics(names, qrels, run), path, memory_mb
+    )
+    return pd.concat(frames).sort_index()
+
+
+def split_topics(df, last):
+    # Rows of a chunk (topics ascending) up to topic key `last`, and the rest.
+    topics = df["topic"].values
+    starts = np.flatnonzero(np.r_[True, topics[1:] != topics[:-1]])
+    done = sum(topic_key(topic) <= last for topic in topics[starts])
+    cut = starts[done] if done < len(starts) else len(df)
+    return df.iloc[:cut], df.iloc[cut:]
+
+
+def merged_chunks(paths, rows):
+    # Lists of DataFrames (None where a run has none) of the same whole
+    # topics, one per run, for runs that all have ascending topics.
+    readers = [sorted_chunks(path, rows) for path in paths]
+    pending = [next(reader, None) for reader in readers]
+    while any(df is not None for df in pending):
+        # Topics up to the smallest last topic are complete in every run.
+        last = min(
+            topic_key(df["topic"].values[-1]) for df in pending if df is not None
+        )
+        chunk = []
+        for i, df in enumerate(pending):
+            if df is None:
+                chunk.append(None)
+                continue
+            done, rest = split_topics(df, last)
+            chunk.append(done)
+            pending[i] = rest if len(rest) else next(readers[i], None)
+        yield chunk
+
+
+def bucket_chunks(paths, folder, memory_mb, rows):
+    # Lists of DataFrames (None where a run has none) of the same topics, one
+    # per run, from spill buckets that hash the topics of every run alike.
+    buckets = sum(buckets_for(path, memory_mb) for path in paths)
+    spilled = []
+    for i, path in enumerate(paths):
+        os.makedirs(os.path.join(folder, str(i)))
+        spilled.append(spill(path, os.path.join(folder, str(i)), buckets, rows))
+    for parts in zip(*spilled):
+        yield [read_bucket(part) for part in parts]
+
+
+def fuse_stream(paths, path, tag, memory_mb=MEMORY_MB, **options):
+    # fusion.fuse of run files that need not fit in memory, written to path.
+    # Every run gets an equal share of the budget.
+    rows = chunk_rows(memory_mb) // len(paths)
+    tmp = tmp_path(path)
+    try:
+        with open(tmp, "w") as f:
+            try:
+                fuse_chunks(f, merged_chunks(paths, rows), tag, options)
+            except Unsorted:
+                f.seek(0)
+                f.truncate()
+                with tempfile.TemporaryDirectory(dir=SPILL_DIR) as folder:
+                    chunks = bucket_chunks(paths, folder, memory_mb, rows)
+                    fuse_chunks(f, chunks, tag, options)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def fuse_chunks(f, chunks, tag, options):
+    options = dict(options)
+    weights = options.pop("weights", None)
+    for dfs in chunks:
+        present = [i for i, df in enumerate(dfs) if df is not None and len(df)]
+        if not present:
+            continue
+        # Docids of a chunk only, so the table does not grow with the run.
+        table = DocidTable()
+        fused = fuse(
+            [chunk_run(dfs[i], table) for i in present],
+            weights=None if weights is None else np.asarray(weights)[present],
+            **options,
+        )
+        write_fused(f, fused, tag, table)
@@ -0,0 +1,295 @@
+import argparse
+import itertools
+import logging
+import math
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from batch import WORKERS, map_jobs, score_matrix
+from cli import find_runs, run_names
+from evaluator import evaluate_metrics
+from fusion import (
+    METHODS,
+    NORMALIZATIONS,
+    docid_collation,
+    fuse,
+    fused_run,
+    fusion_tag,
+    write_run,
+)
+from metrics import metrics
+from qrels import load_qrels
+from runstore import load_run
+
+# Search over fusion settings: every candidate is fused and scored in memory
+# on the process pool, only the best ones are written as runs.
+#   python run-comparator/sweep.py runs/ -q qrels/x.txt -m ndcg_cut_10 \
+#       --weights 0.5 1 2 --samples 1000 --folds 5 -o sweep
+# Candidates are the grid of the settings (methods, RRF k, normalizations,
+# max_docs, per-run weights and subsets of the runs) or a random sample of
+# it. With --folds, the best candidate is picked on all but one fold of the
+# topics and scored on that fold, which estimates how well a tuned fusion
+# does on unseen topics.
+
+K_VALUES = [10, 20, 40, 60, 80, 100]
+WEIGHTS = [0.5, 1.0, 2.0]  # of the dashboard's sweep
+CHUNK_SIZE = 50  # candidates per pool task
+CANDIDATE_COLUMNS = ["runs", "method", "k", "norm", "max_docs", "weights"]
+
+
+def candidate(runs, method, k, norm, max_docs, weights):
+    # One row of candidates: k only for rrf, norm only for combsum/combmnz.
+    # Weights are relative, so (2, 2) is the same candidate as (1, 1).
+    weights = np.asarray(weights, dtype=np.float64)
+    return {
+        "runs": tuple(runs),
+        "method": str(method),
+        "k": int(k) if method == "rrf" else None,
+        "norm": None if method == "rrf" else str(norm),
+        "max_docs": int(max_docs),
+        "weights": tuple(np.round(weights / weights.max(), 6).tolist()),
+    }
+
+
+def candidate_frame(rows):
+    df = pd.DataFrame(rows, columns=CANDIDATE_COLUMNS).drop_duplicates()
+    return df.astype({"k": "Int64"}).reset_index(drop=True)
+
+
+def grid_candidates(
+    runs,
+    methods=METHODS,
+    ks=K_VALUES,
+    norms=NORMALIZATIONS,
+    max_docs=(1000,),
+    weights=(1.0,),
+    sizes=None,
+):
+    # Every combination of the settings, for the subsets of the runs of the
+    # given sizes (default: all runs together).
+    rows = []
+    for size in sizes or [len(runs)]:
+        for subset in itertools.combinations(runs, size):
+            for w in itertools.product(weights, repeat=size):
+                for method, docs in itertools.product(methods, max_docs):
+                    for k, norm in itertools.product(
+                        ks if method == "rrf" else [None],
+                        [None] if method == "rrf" else norms,
+                    ):
+                        rows.append(candidate(subset, method, k, norm, docs, w))
+    return candidate_frame(rows)
+
+
+def sample_candidates(
+    runs,
+    n,
+    methods=METHODS,
+    ks=K_VALUES,
+    norms=NORMALIZATIONS,
+    max_docs=(1000,),
+    weights=(1.0,),
+    sizes=None,
+    seed=0,
+):
+    # n distinct random candidates of the same grid (fewer if it is smaller),
+    # drawn without building the grid.
+    rng = np.random.default_rng(seed)
+    sizes = [size for size in sizes or [len(runs)] if size <= len(runs)]
+    rows = {}
+    for _ in range(20 * n):
+        if len(rows) == n or not sizes:
+            break
+        size = rng.choice(sizes)
+        subset = [runs[i] for i in sorted(rng.choice(len(runs), size, replace=False))]
+        row = candidate(
+            subset,
+            rng.choice(methods),
+            rng.choice(ks),
+            rng.choice(norms),
+            rng.choice(max_docs),
+            rng.choice(weights, size),
+        )
+        rows[tuple(row.values())] = row
+    return candidate_frame(list(rows.values()))
+
+
+def fusion_options(row):
+    options = {
+        "method": row["method"],
+        "weights": np.asarray(row["weights"]),
+        "max_docs": int(row["max_docs"]),
+    }
+    if row["method"] == "rrf":
+        options["k"] = int(row["k"])
+    else:
+        options["norm"] = row["norm"]
+    return options
+
+
+def score_candidates(job):
+    # Per-topic scores of a chunk of candidates, and the metrics of the
+    # worker (see batch.evaluate_file).
+    metric, qrels, paths, rows = job
+    with metrics.capture() as captured:
+        qrels = load_qrels(qrels)
+        runs = {name: load_run(paths[name]) for row in rows for name in row["runs"]}
+        # Docids sorted once for all fusions of the chunk.
+        collation = docid_collation(list(runs.values()))
+        columns = []
+        for row in rows:
+            fused = fuse(
+                [runs[name] for name in row["runs"]],
+                collation=collation,
+                **fusion_options(row),
+            )
+            run = fused_run(fused, collation=collation)
+            columns.append(evaluate_metrics([metric], qrels, run)[metric])
+    return columns, captured
+
+
+@metrics.timed("sweep")
+def sweep(metric, qrels, paths, candidates, workers=WORKERS, job=None):
+    # Topic x candidate DataFrame of the scores of every candidate (columns
+    # are the index of candidates). paths: {run name: run file}.
+    rows = candidates.to_dict("records")
+    size = max(1, min(CHUNK_SIZE, math.ceil(len(rows) / (4 * workers))))
+    chunks = [rows[i : i + size] for i in range(0, len(rows), size)]
+    columns = []
+    for start in range(0, len(chunks), 4 * workers):
+        if job:
+            job.check()
+            job.report(0.9 * start / len(chunks), f"{start * size}/{len(rows)} fusions")
+        jobs = [
+            (metric, qrels, paths, chunk)
+            for chunk in chunks[start : start + 4 * workers]
+        ]
+        for scores, captured in map_jobs(score_candidates, jobs, workers):
+            metrics.merge(captured)
+            columns.extend(scores)
+    metrics.inc("fusions_scored_total", len(rows))
+    return score_matrix(list(zip(candidates.index, columns)))
+
+
+def rank_candidates(candidates, scores):
+    # Candidates with their mean score over the topics, best first.
+    ranked = candidates.assign(mean=scores.mean(), topics=scores.count())
+    return ranked.sort_values("mean", ascending=False, kind="mergesort")
+
+
+def cross_validate(scores, folds, seed=0):
+    # Choose the best candidate on all folds of the topics but one and score
+    # it on that one. Returns a frame per fold and the mean held-out score
+    # over all topics.
+    topics = np.random.default_rng(seed).permutation(scores.index)
+    rows, held_out = [], []
+    for test in np.array_split(topics, folds):
+        train = scores.drop(index=test)
+        best = train.mean().idxmax()
+        held_out.append(scores.loc[test, best])
+        rows.append(
+            {
+                "topics": len(test),
+                "candidate": best,
+                "train": train[best].mean(),
+                "test": held_out[-1].mean(),
+            }
+        )
+    df = pd.DataFrame(rows)
+    df.index.name = "fold"
+    return df, pd.concat(held_out).mean()
+
+
+def write_best(ranked, paths, n, folder, prefix="sweep"):
+    # Fuse the n best candidates again and write them as runs, returns the
+    # file names.
+    names = []
+    for i, row in enumerate(ranked.head(n).to_dict("records"), 1):
+        fused = fuse(
+            [load_run(paths[name]) for name in row["runs"]], **fusion_options(row)
+        )
+        tag = fusion_tag(row["method"], row["k"], row["norm"])
+        names.append(f"{prefix}_{i}_{tag}.txt")
+        write_run(fused, os.path.join(folder, names[-1]), tag)
+    return names
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Search fusion settings of TREC runs against a qrels file."
+    )
+    parser.add_argument("runs", nargs="+", help="run files, folders or globs")
+    parser.add_argument("-q", "--qrels", required=True)
+    parser.add_argument("-m", "--metric", default="ndcg_cut_10")
+    parser.add_argument("-o", "--output", default="sweep")
+    parser.add_argument("-w", "--workers", type=int, default=WORKERS)
+    parser.add_argument("--methods", nargs="+", choices=METHODS, default=METHODS)
+    parser.add_argument("--k", nargs="+", type=int, default=K_VALUES, help="RRF k")
+    parser.add_argument(
+        "--norms", nargs="+", choices=NORMALIZATIONS, default=NORMALIZATIONS
+    )
+    parser.add_argument("--max-docs", nargs="+", type=int, default=[1000])
+    parser.add_argument("--weights", nargs="+", type=float, default=[1.0])
+    parser.add_argument(
+        "--sizes", nargs="+", type=int, help="fuse subsets of these sizes"
+    )
+    parser.add_argument("--samples", type=int, help="random candidates of the grid")
+    parser.add_argument("--folds", type=int, help="cross-validate over topics")
+    parser.add_argument("--best", type=int, default=1, help="runs to write")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    names = run_names(find_runs(args.runs))
+    if not names:
+        sys.exit("No runs found.")
+    paths = {name: path for path, name in names.items()}
+    space = dict(
+        methods=args.methods,
+        ks=args.k,
+        norms=args.norms,
+        max_docs=args.max_docs,
+        weights=args.weights,
+        sizes=args.sizes,
+    )
+    if args.samples:
+        candidates = sample_candidates(
+            list(paths), args.samples, seed=args.seed, **space
+        )
+    else:
+        candidates = grid_candidates(list(paths), **space)
+    if not len(candidates):
+        sys.exit("No candidates, check --sizes.")
+    os.makedirs(args.output, exist_ok=True)
+    logging.info(f"Scoring {len(candidates)} fusions on {args.workers} workers.")
+
+    scores = sweep(args.metric, args.qrels, paths, candidates, args.workers)
+    ranked = rank_candidates(candidates, scores)
+    ranked.to_csv(os.path.join(args.output, "candidates.csv"), index_label="candidate")
+    best = ranked.iloc[0]
+    tag = fusion_tag(best["method"], best["k"], best["norm"])
+    logging.info(
+        f"Best {args.metric}: {best['mean']:.4f} ({tag} of {', '.join(best['runs'])},"
+        f" weights {best['weights']})"
+    )
+
+    if args.folds:
+        folds, held_out = cross_validate(scores, args.folds, args.seed)
+        folds.to_csv(os.path.join(args.output, "folds.csv"))
+        logging.info(
+            f"Cross-validated {args.metric}: {held_out:.4f} ({args.folds} folds)"
+        )
+
+    written = write_best(ranked, paths, args.best, args.output)
+    logging.info(f"Wrote {args.output}/ ({', '.join(written)}).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Synthetic TREC runs and qrels of any size, for benchmarks. Every topic has
+# a pool of candidate documents; a fraction of the pool is judged, and each
+# run ranks the pool by a noisy version of the grades, so runs overlap and
+# score like real systems do.
+
+DOCID_FORMATS = ["uuid", "hex", "mixed"]
+GRADES = [0, 1, 2]
+GRADE_WEIGHTS = [0.7, 0.2, 0.1]
+
+
+def make_docids(n, fmt="mixed", seed=0):
+    # n unique docids like the ones in runs/sample*.txt:
+    #   uuid  557d39aa-86dc-11e4-b9b7-b8632ae73d25
+    #   hex   1dd6be099ea95e49f4341b8e335acc30
+    rng = np.random.default_rng(seed)
+    raw = rng.bytes(16 * n)
+    hexes = [raw[i : i + 16].hex() for i in range(0, 16 * n, 16)]
+    if fmt == "hex":
+        return np.array(hexes, dtype=object)
+    uuids = [f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}" for h in hexes]
+    if fmt == "uuid":
+        return np.array(uuids, dtype=object)
+    if fmt == "mixed":
+        return np.where(rng.random(n) < 0.5, hexes, uuids).astype(object)
+    raise ValueError(f"Unknown docid format: {fmt}")
+
+
+class Collection:
+    # Topics, per-topic document pools and their hidden grades.
+
+    def __init__(
+        self, topics=50, depth=100, pool=None, density=0.3, fmt="mixed", seed=0
+    ):
+        self.rng = np.random.default_rng(seed)
+        self.topics = np.arange(1, topics + 1) + 800
+        self.depth = depth
+        self.pool = pool or 3 * depth
+        self.density = density
+        self.docids = make_docids(topics * self.pool, fmt, seed).reshape(
+            topics, self.pool
+        )
+        self.grades = self.rng.choice(GRADES, size=(topics, self.pool), p=GRADE_WEIGHTS)
+
+    def write_qrels(self, path):
+        # Judge a random `density` fraction of every pool.
+        judged = self.rng.random(self.grades.shape) < self.density
+        rows, cols = np.nonzero(judged)
+        pd.DataFrame(
+            {
+                "topic": self.topics[rows],
+                "iter": 0,
+                "docid": self.docids[rows, cols],
+                "rel": self.grades[rows, cols],
+            }
+        ).to_csv(path, sep=" ", header=False, index=False)
+
+    def write_run(self, path, quality=1.0, tag="synthetic", chunk_topics=100):
+        # Rank the pool by grade * quality + noise, written per chunk of topics.
+        with open(path, "w") as f:
+            for start in range(0, len(self.topics), chunk_topics):
+                grades = self.grades[start : start + chunk_topics]
+                noise = self.rng.standard_normal(grades.shape)
+                scores = quality * grades + noise
+                top = np.argpartition(-scores, self.depth - 1, axis=1)[:, : self.depth]
+                order = np.argsort(-np.take_along_axis(scores, top, 1), axis=1)
+                cols = np.take_along_axis(top, order, 1)
+                rows = np.arange(len(grades))[:, None].repeat(self.depth, 1)
+                pd.DataFrame(
+                    {
+                        "topic": self.topics[start + rows.ravel()],
+                        "q0": "Q0",
+                        "docid": self.docids[start + rows.ravel(), cols.ravel()],
+                        "rank": np.tile(np.arange(1, self.depth + 1), len(grades)),
+                        "score": np.take_along_axis(scores, cols, 1).ravel().round(6),
+                        "tag": tag,
+                    }
+                ).to_csv(f, sep=" ", header=False, index=False)
+
+
+def generate(
+    folder,
+    topics=50,
+    depth=100,
+    runs=3,
+    density=0.3,
+    fmt="mixed",
+    seed=0,
+):
+    # Write qrels/synthetic.txt and runs/synthetic_<i>.txt under `folder`,
+    # returns the run names.
+    collection = Collection(topics, depth, density=density, fmt=fmt, seed=seed)
+    os.makedirs(os.path.join(folder, "qrels"), exist_ok=True)
+    os.makedirs(os.path.join(folder, "runs"), exist_ok=True)
+    collection.write_qrels(os.path.join(folder, "qrels", "synthetic.txt"))
+
+    names = []
+    width = len(str(runs))
+    for i in range(runs):
+        name = f"synthetic_{i:0{width}d}.txt"
+        quality = collection.rng.uniform(0.2, 2.0)
+        collection.write_run(os.path.join(folder, "runs", name), quality, f"run{i}")
+        names.append(name)
+    return names
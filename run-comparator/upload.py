@@ -0,0 +1,207 @@
+import fcntl
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+from flask import Blueprint, abort, jsonify, request
+
+from cache import score_cache
+from compression import compression
+from folder_index import run_index
+from runstore import RunBuilder, drop_snapshot, write_snapshot
+
+CHUNK_SIZE = 2 ** 20
+
+# Resumable upload of runs in raw chunks:
+#   GET  /upload/<name>                  -> {"offset": bytes received so far}
+#   POST /upload/<name>?offset=<n>       -> append the request body at n
+#   POST /upload/<name>/complete         -> move the run into runs/
+# Bytes go straight to runs/.<name>.part and into a RunBuilder, which spills
+# the parsed chunks to runs/.<name>.build/, so the run is parsed and
+# snapshotted by the time the upload completes. Chunks may arrive at
+# different server processes: runs/.<name>.lock serializes them (and is
+# removed with the part file), and a process catches up from the builder
+# state saved after every chunk and the bytes another process appended
+# after it.
+
+upload_blueprint = Blueprint("upload", __name__)
+
+_uploads = {}  # {name: Upload}
+_uploads_lock = threading.Lock()
+
+
+class Upload:
+    def __init__(self, name):
+        self.name = name
+        self.part = os.path.join("runs", f".{name}.part")
+        self.build = os.path.join("runs", f".{name}.build")
+        self.lock = threading.Lock()
+        self.resume()
+
+    def resume(self):
+        # Catch up with the part file, e.g. after another server process
+        # appended to it: from the builder state saved next to it, so only
+        # the bytes after that state are parsed.
+        try:
+            size = os.path.getsize(self.part)
+        except OSError:
+            size = 0
+        if compression(self.name):
+            # A decompressor cannot be saved: once chunks of a compressed run
+            # went to several processes, it is parsed when it completes.
+            self.builder = None if size else RunBuilder(self.build, name=self.name)
+            self.received = size
+            return
+        try:
+            self.builder = RunBuilder(self.build, name=self.name, resume=True)
+            if self.builder.offset > size:
+                raise ValueError("Saved state is ahead of the part file")
+        except (OSError, ValueError, KeyError):
+            self.builder = RunBuilder(self.build, name=self.name)
+        self.received = self.builder.offset
+        self.parse(size)
+
+    def parse(self, size):
+        # Feed the part file from what was received up to size.
+        if self.received >= size:
+            return
+        with open(self.part, "rb") as f:
+            f.seek(self.received)
+            while self.received < size:
+                chunk = f.read(min(CHUNK_SIZE, size - self.received))
+                self.builder.feed(chunk)
+                self.received += len(chunk)
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            f = lock_file(os.path.join("runs", f".{self.name}.lock"))
+            try:
+                try:
+                    size = os.path.getsize(self.part)
+                except OSError:
+                    size = 0
+                if size != self.received:
+                    self.resume()
+                yield
+            finally:
+                # No upload left (completed, discarded or never started):
+                # drop its state and the lock file while still holding it.
+                if not os.path.exists(self.part):
+                    discard(self)
+                    try:
+                        os.remove(f.name)
+                    except OSError:
+                        pass
+                f.close()
+
+    def append(self, stream):
+        with open(self.part, "ab") as f:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                f.write(chunk)
+                if self.builder:
+                    self.builder.feed(chunk)
+                self.received += len(chunk)
+        if self.builder and not self.builder.decompressor:
+            self.builder.save(self.received)
+
+    def complete(self):
+        path = os.path.join("runs", self.name)
+        if self.builder is None:
+            self.builder = RunBuilder(self.build, name=self.name)
+            self.received = 0
+            self.parse(os.path.getsize(self.part))
+        columns = self.builder.finish()
+        os.replace(self.part, path)
+
+        # Drop state of a previous run with the same name.
+        score_cache.invalidate(path)
+        drop_snapshot(path)
+        write_snapshot(path, *columns)
+        self.builder.discard()
+        with _uploads_lock:
+            _uploads.pop(self.name, None)
+        return len(columns[1]), len(columns[0])
+
+
+def lock_file(path):
+    # Open and lock path. Lock files are removed by their holder, so a file
+    # locked after waiting may be gone: lock the new one then.
+    while True:
+        f = open(path, "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except OSError:
+            pass
+        f.close()
+
+
+def run_name(name):
+    name = os.path.basename(name)
+    if not name or name.startswith("."):
+        abort(400, "Invalid run name")
+    return name
+
+
+def get_upload(name):
+    with _uploads_lock:
+        # Uploads another process completed or discarded.
+        for other in [n for n, u in _uploads.items() if not os.path.exists(u.part)]:
+            if other != name:
+                del _uploads[other]
+        if name not in _uploads:
+            _uploads[name] = Upload(name)
+        return _uploads[name]
+
+
+@upload_blueprint.route("/upload/<name>", methods=["GET"])
+def upload_offset(name):
+    upload = get_upload(run_name(name))
+    with upload.locked():
+        return jsonify(offset=upload.received)
+
+
+@upload_blueprint.route("/upload/<name>", methods=["POST"])
+def upload_chunk(name):
+    upload = get_upload(run_name(name))
+    with upload.locked():
+        offset = request.args.get("offset", type=int, default=upload.received)
+        if offset != upload.received:
+            # Client is out of sync, tell it where to resume.
+            return jsonify(offset=upload.received), 409
+        try:
+            upload.append(request.stream)
+        except ValueError as e:
+            discard(upload)
+            return jsonify(error=f"{name} is not a TREC run. --> {e}"), 400
+        return jsonify(offset=upload.received)
+
+
+@upload_blueprint.route("/upload/<name>/complete", methods=["POST"])
+def upload_complete(name):
+    upload = get_upload(run_name(name))
+    with upload.locked():
+        try:
+            rows, topics = upload.complete()
+        except ValueError as e:
+            discard(upload)
+            return jsonify(error=f"{name} is not a TREC run. --> {e}"), 400
+
+    # The snapshot is written, the ingest job only hashes the run.
+    run_index.refresh()
+    logging.info(f"Uploaded {name}: {rows} rows, {topics} topics")
+    return jsonify(name=name, rows=rows, topics=topics)
+
+
+def discard(upload):
+    with _uploads_lock:
+        _uploads.pop(upload.name, None)
+    shutil.rmtree(upload.build, ignore_errors=True)
+    try:
+        os.remove(upload.part)
+    except OSError:
+        pass
@@ -1,30 +1,13 @@
 import os
 from base64 import b64decode
-from collections import defaultdict
-from io import StringIO
 from os import listdir
 from os.path import isfile, join
 
 import numpy as np
-from trectools import TrecRun, fusion
+import pandas as pd
 
-
-def fuse_runs(run1, run2):
-    # https://dl.acm.org/doi/10.1145/1571941.1572114
-    r1 = TrecRun(f"runs/{run1}")
-    r2 = TrecRun(f"runs/{run2}")
-
-    # Perform reciprocal rank fusion.
-    fused_run = fusion.reciprocal_rank_fusion([r1, r2], max_docs=100)
-
-    # Clear names.
-    name1 = run1.replace(".txt", "")
-    name2 = run2.replace(".txt", "")
-
-    # Save fused file to disk.
-    fused_run.print_subset(
-        f"runs/fuse_{name1}_{name2}.txt", topics=fused_run.topics()
-    )
+from cache import score_cache
+from runstore import drop_snapshot
 
 
 def make_folder(name):
@@ -44,56 +27,15 @@ def write_to_file(list_of_contents, list_of_names):
         # decode input
         content_type, content_string = contents.split(",")
         decoded = b64decode(content_string)
-        content = StringIO(decoded.decode("utf-8"))
-
-        # write content to file
-        f = open(f"runs/{name}", "w")
-        f.write(content.read())
-        f.close()
-    return True
-
-
-def read_qrels(mypath):
-    # 886 0 00183d98-741b-11e5-8248-98e0f5a2e830 0
-    relevance_dict = defaultdict(dict)  # {topic: {docid: relevance, }}
-    with open(mypath) as f:
-        content = f.readlines()
-        for line in content:
-            row = line.split()
-            relevance_dict[row[0]][row[2]] = int(row[3])
-    return relevance_dict
-
 
-def read_run(mypath):
-    # 886 Q0 39fff39a71e2e8e0aeaf1666f7d78697 1 1.0 run1
-    run = defaultdict(list)  # {topic: {docid: relevance, }}
-    with open(mypath) as f:
-        content = f.readlines()
-        for line in content:
-            row = line.split()
-            run[row[0]].append(row[2])
-    return run
+        # write content to file, as is: runs may be compressed
+        with open(f"runs/{name}", "wb") as f:
+            f.write(decoded)
 
-
-def find_relevance(docid, qrels):
-    if docid in qrels.keys():
-        return qrels[docid]
-    else:
-        return 0.0
-
-
-def mark_new(docid, docids):
-    if docid in docids.values:
-        return "grey"
-    else:
-        return "green"
-
-
-def mark_new_text(docid, docids):
-    if docid in docids.values:
-        return docid
-    else:
-        return docid + " <b>(new)</b>"
+        # drop scores and snapshot of a previous upload with the same name
+        score_cache.invalidate(f"runs/{name}")
+        drop_snapshot(f"runs/{name}")
+    return True
 
 
 def mark_current_runs(base, alt, selected):
@@ -106,9 +48,15 @@ def mark_current_runs(base, alt, selected):
 
 
 def new_percentage(run1, run2, n):
-    # number of new docids in run2:
-    new = []
-    for topic in run2:
-        n_new = np.sum([1 for docid in run2[topic][:n] if docid not in run1[topic][:n]])
-        new.append((100 / n) * n_new)
-    return np.mean(new)
+    # number of new docids in the top n of run2 (Run objects), per topic:
+    top1 = np.flatnonzero(run1.positions() < n)
+    top2 = np.flatnonzero(run2.positions() < n)
+
+    # (topic, docid) keys with topics numbered as in run2.
+    topic1 = pd.Index(run2.topics).get_indexer(run1.topics)[run1.topic[top1]]
+    keys1 = topic1.astype(np.int64) << 32 | run1.docid[top1]
+    keys2 = run2.topic[top2].astype(np.int64) << 32 | run2.docid[top2]
+    new = ~np.isin(keys2, keys1[topic1 >= 0])
+
+    n_new = np.bincount(run2.topic[top2][new], minlength=len(run2.topics))
+    return np.mean((100 / n) * n_new)
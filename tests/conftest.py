@@ -0,0 +1,46 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# Tests run from the repository root: python -m pytest
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "run-comparator"))
+os.environ.setdefault("RUN_COMPARATOR_CACHE", tempfile.mkdtemp(prefix="cache-"))
+os.environ.setdefault("RUN_COMPARATOR_WORKERS", "1")
+
+QRELS = "qrels.backgroundlinking19.txt"
+RUNS = ["sample1.txt", "sample2.txt", "sample3.txt"]
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    # Copy of the sample runs and qrels, as the current directory: the app
+    # reads runs/ and qrels/ relative to it and writes snapshots next to them.
+    for folder, names in [("runs", RUNS), ("qrels", [QRELS])]:
+        os.makedirs(tmp_path / folder)
+        for name in names:
+            shutil.copy(os.path.join(ROOT, folder, name), tmp_path / folder)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def read_trec(path, column, cast):
+    # {topic: {docid: value}} of a run (score) or qrels (grade) file, the
+    # input of pytrec_eval.
+    result = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            result.setdefault(fields[0], {})[fields[2]] = cast(fields[column])
+    return result
+
+
+def read_run(path):
+    return read_trec(path, 4, float)
+
+
+def read_qrels(path):
+    return read_trec(path, 3, int)
@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pytest
+from conftest import QRELS, ROOT, RUNS, read_qrels, read_run
+
+from evaluator import FAMILY, evaluate, evaluate_metrics
+from qrels import load_qrels
+from runstore import load_run
+
+pytrec_eval = pytest.importorskip("pytrec_eval")
+
+# Cutoffs outside the family are computed on their own.
+METRICS = FAMILY + ["ndcg_cut_7", "P_3", "recall_1", "map_cut_2"]
+
+
+def pytrec_measures(names):
+    # {"ndcg_cut.5,10", "map", ...} of trec_eval metric names.
+    cutoffs = {}
+    for name in names:
+        measure, _, k = name.rpartition("_")
+        if k.isdigit():
+            cutoffs.setdefault(measure, []).append(k)
+        else:
+            cutoffs[name] = []
+    return {m + ("." + ",".join(k) if k else "") for m, k in cutoffs.items()}
+
+
+@pytest.fixture(scope="module")
+def reference():
+    # {run: {topic: {metric: score}}} of pytrec_eval.
+    evaluator = pytrec_eval.RelevanceEvaluator(
+        read_qrels(os.path.join(ROOT, "qrels", QRELS)), pytrec_measures(METRICS)
+    )
+    runs = {run: read_run(os.path.join(ROOT, "runs", run)) for run in RUNS}
+    return {run: evaluator.evaluate(ranking) for run, ranking in runs.items()}
+
+
+@pytest.mark.parametrize("run", RUNS)
+def test_metrics_match_pytrec_eval(workspace, reference, run):
+    scores = evaluate_metrics(
+        METRICS, load_qrels(f"qrels/{QRELS}"), load_run(f"runs/{run}")
+    )
+    expected = reference[run]
+    assert list(scores.index) == sorted(expected)
+    for metric in METRICS:
+        want = [expected[topic][metric] for topic in scores.index]
+        np.testing.assert_allclose(scores[metric], want, atol=1e-9, err_msg=metric)
+
+
+@pytest.mark.parametrize("metric", ["ndcg_cut_5", "P_10", "ndcg_cut_7", "map"])
+def test_evaluate_rounds_as_trec_eval(workspace, reference, metric):
+    for run in RUNS:
+        scores = evaluate(metric, f"qrels/{QRELS}", run)[run]
+        want = [round(reference[run][topic][metric], 4) for topic in scores.index]
+        np.testing.assert_allclose(scores, want, atol=1e-9)
+        # Again from the score cache.
+        cached = evaluate(metric, f"qrels/{QRELS}", run)[run]
+        np.testing.assert_array_equal(cached, scores)
+
+
+def test_tied_scores_ranked_as_trec_eval(workspace):
+    # Scores rounded to one decimal: many ties, which trec_eval breaks by
+    # docid descending.
+    with open("runs/sample1.txt") as f, open("runs/tied.txt", "w") as out:
+        for line in f:
+            topic, q0, docid, rank, score, tag = line.split()
+            out.write(f"{topic} {q0} {docid} {rank} {float(score):.1f} {tag}\n")
+    qrels = read_qrels(f"qrels/{QRELS}")
+    names = ["ndcg_cut_10", "P_5", "map", "recip_rank"]
+    evaluator = pytrec_eval.RelevanceEvaluator(qrels, pytrec_measures(names))
+    expected = evaluator.evaluate(read_run("runs/tied.txt"))
+    scores = evaluate_metrics(
+        names, load_qrels(f"qrels/{QRELS}"), load_run("runs/tied.txt")
+    )
+    for metric in names:
+        want = [expected[topic][metric] for topic in scores.index]
+        np.testing.assert_allclose(scores[metric], want, atol=1e-9, err_msg=metric)
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import RUNS
+
+from fusion import fuse
+from runstore import load_run
+
+trectools = pytest.importorskip("trectools")
+trec_fusion = pytest.importorskip("trectools.fusion")
+
+
+def named(fused, run):
+    # Fused ranking with docid strings, sorted per topic by rank.
+    df = fused.assign(docid=run.table.lookup(fused["docid"].values))
+    return df.sort_values(["query", "rank"]).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("names", [RUNS[:2], RUNS])
+@pytest.mark.parametrize("k, max_docs", [(60, 100), (10, 1000)])
+def test_rrf_matches_trectools(workspace, names, k, max_docs):
+    runs = [load_run(f"runs/{name}") for name in names]
+    trec_runs = []
+    for name, run in zip(names, runs):
+        # trectools ranks a run by its order: as the run's own ranking.
+        trec_run = trectools.TrecRun()
+        trec_run.run_data = run.frame(name)
+        trec_runs.append(trec_run)
+    expected = trec_fusion.reciprocal_rank_fusion(trec_runs, k, max_docs)
+    expected = expected.run_data.sort_values(["query", "rank"])
+
+    fused = named(fuse(runs, k=k, max_docs=max_docs), runs[0])
+    np.testing.assert_array_equal(fused["query"], expected["query"])
+    np.testing.assert_array_equal(fused["docid"], expected["docid"])
+    np.testing.assert_array_equal(fused["rank"], expected["rank"])
+    np.testing.assert_allclose(fused["score"], expected["score"], rtol=1e-12)
+
+
+def write(path, rows):
+    with open(path, "w") as f:
+        for docid, score in rows:
+            f.write(f"1 Q0 {docid} 0 {score} tag\n")
+
+
+def test_ties(workspace):
+    # x ranks its tie b, c as trec_eval does (docid descending): a, c, b.
+    write("runs/x.txt", [("a", 2.0), ("b", 1.0), ("c", 1.0)])
+    write("runs/y.txt", [("d", 1.0), ("c", 0.9), ("b", 0.5)])
+    runs = [load_run("runs/x.txt"), load_run("runs/y.txt")]
+    fused = named(fuse(runs), runs[0])
+
+    # a and d tie at 1 / 61, broken by docid ascending.
+    assert list(fused["docid"]) == ["c", "b", "a", "d"]
+    expected = [1 / 62 + 1 / 62, 1 / 63 + 1 / 63, 1 / 61, 1 / 61]
+    np.testing.assert_allclose(fused["score"], expected)
+
+
+@pytest.mark.parametrize("norm", ["minmax", "zscore", "none"])
+@pytest.mark.parametrize("method", ["combsum", "combmnz"])
+def test_comb_matches_pandas(workspace, method, norm):
+    weights = [1.0, 0.5, 2.0]
+    runs = [load_run(f"runs/{name}") for name in RUNS]
+    frames = []
+    for run, weight, name in zip(runs, weights, RUNS):
+        df = run.frame(name)
+        score = df.groupby("query")["score"]
+        if norm == "minmax":
+            spread = score.transform("max") - score.transform("min")
+            df["score"] = ((df["score"] - score.transform("min")) / spread).fillna(1.0)
+        elif norm == "zscore":
+            std = score.transform("std", ddof=0)
+            df["score"] = ((df["score"] - score.transform("mean")) / std).fillna(0.0)
+        df["score"] *= weight
+        frames.append(df)
+    grouped = pd.concat(frames).groupby(["query", "docid"])["score"]
+    expected = grouped.sum()
+    if method == "combmnz":
+        expected *= grouped.count()
+
+    fused = named(fuse(runs, method, weights=weights, norm=norm), runs[0])
+    fused = fused.set_index(["query", "docid"])["score"]
+    np.testing.assert_allclose(fused, expected.reindex(fused.index), rtol=1e-9)
+    assert len(fused) == len(expected)
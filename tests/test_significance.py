@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+from significance import benjamini_hochberg, holm, significance
+
+
+def scores(topics, runs, seed=0):
+    # Topic x run scores around a base run, shifted by a different mean.
+    rng = np.random.default_rng(seed)
+    base = pd.Series(rng.uniform(0, 1, topics), index=[str(t) for t in range(topics)])
+    others = pd.DataFrame(
+        {f"run{i}": base + rng.normal(0.05 * (i - 1), 0.1, topics) for i in range(runs)}
+    )
+    return base, others
+
+
+def test_ttest_matches_scipy():
+    base, others = scores(40, 4)
+    # A run missing some topics is tested on the topics it has.
+    others.iloc[:5, 1] = np.nan
+    result = significance(base, others, permutations=10, bootstrap=10, workers=1)
+    for run in others:
+        expected = stats.ttest_rel(others[run], base, nan_policy="omit")
+        assert result.loc[run, "t"] == pytest.approx(expected.statistic)
+        assert result.loc[run, "p_ttest"] == pytest.approx(expected.pvalue)
+        assert result.loc[run, "diff"] == pytest.approx((others[run] - base).mean())
+
+
+def test_permutation_matches_exact_test():
+    # 10 topics: scipy enumerates all 1024 sign flips.
+    base, others = scores(10, 3, seed=1)
+    result = significance(base, others, permutations=20000, bootstrap=10, workers=1)
+    for run in others:
+        expected = stats.permutation_test(
+            (others[run].values, base.values),
+            lambda x, y: np.mean(x - y),
+            permutation_type="samples",
+            n_resamples=np.inf,
+        )
+        assert result.loc[run, "p_permutation"] == pytest.approx(
+            expected.pvalue, abs=0.01
+        )
+
+
+def test_bootstrap_matches_scipy():
+    base, others = scores(50, 3, seed=2)
+    result = significance(base, others, permutations=10, bootstrap=20000, workers=1)
+    for run in others:
+        expected = stats.bootstrap(
+            ((others[run] - base).values,),
+            np.mean,
+            n_resamples=20000,
+            method="percentile",
+            random_state=0,
+        ).confidence_interval
+        assert result.loc[run, "ci_low"] == pytest.approx(expected.low, abs=2e-3)
+        assert result.loc[run, "ci_high"] == pytest.approx(expected.high, abs=2e-3)
+
+
+@pytest.mark.parametrize("correction, method", [("holm", "holm"), ("bh", "fdr_bh")])
+def test_corrections_match_statsmodels(correction, method):
+    multitest = pytest.importorskip("statsmodels.stats.multitest")
+    p = np.random.default_rng(3).uniform(0, 0.1, 30)
+    p[[4, 17]] = np.nan
+    adjusted = {"holm": holm, "bh": benjamini_hochberg}[correction](p)
+    tested = ~np.isnan(p)
+    expected = multitest.multipletests(p[tested], method=method)[1]
+    np.testing.assert_allclose(adjusted[tested], expected)
+    assert np.isnan(adjusted[~tested]).all()
+
+
+def test_correction_is_applied_to_both_tests():
+    base, others = scores(30, 5, seed=4)
+    plain = significance(base, others, permutations=1000, bootstrap=10, workers=1)
+    corrected = significance(
+        base, others, permutations=1000, bootstrap=10, correction="holm", workers=1
+    )
+    for column in ["p_ttest", "p_permutation"]:
+        np.testing.assert_allclose(corrected[column], holm(plain[column].values))
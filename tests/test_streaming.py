@@ -0,0 +1,85 @@
+import gzip
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import QRELS, RUNS, read_qrels, read_run
+
+from evaluator import FAMILY, evaluate_metrics
+from fusion import fuse, fusion_tag, write_run
+from qrels import load_qrels
+from runstore import load_run
+from streaming import evaluate_stream, fuse_stream
+
+pytrec_eval = pytest.importorskip("pytrec_eval")
+
+# 1 MB is a few thousand rows: the sample runs are read in several chunks,
+# or spilled to more than one bucket.
+MEMORY_MB = 1
+COLUMNS = ["query", "q0", "docid", "rank", "score", "tag"]
+
+
+def copy_run(source, target, shuffle=False, compress=False):
+    with open(source) as f:
+        lines = f.readlines()
+    if shuffle:
+        random.Random(0).shuffle(lines)
+    data = "".join(lines).encode()
+    with open(target, "wb") as f:
+        f.write(gzip.compress(data) if compress else data)
+
+
+@pytest.mark.parametrize(
+    "shuffle, compress", [(False, False), (True, False), (False, True), (True, True)]
+)
+def test_evaluate_stream_matches_pytrec_eval(workspace, shuffle, compress):
+    path = "runs/stream.txt" + (".gz" if compress else "")
+    copy_run("runs/sample2.txt", path, shuffle, compress)
+    measures = {"ndcg_cut.5,10,100", "P.5,10", "recall.1000", "map", "recip_rank"}
+    names = ["ndcg_cut_5", "ndcg_cut_10", "ndcg_cut_100", "P_5", "P_10"]
+    names += ["recall_1000", "map", "recip_rank"]
+    evaluator = pytrec_eval.RelevanceEvaluator(read_qrels(f"qrels/{QRELS}"), measures)
+    expected = evaluator.evaluate(read_run("runs/sample2.txt"))
+
+    scores = evaluate_stream(names, load_qrels(f"qrels/{QRELS}"), path, MEMORY_MB)
+    assert list(scores.index) == sorted(expected)
+    for metric in names:
+        want = [expected[topic][metric] for topic in scores.index]
+        np.testing.assert_allclose(scores[metric], want, atol=1e-9, err_msg=metric)
+
+
+def test_evaluate_stream_matches_memory(workspace):
+    qrels = load_qrels(f"qrels/{QRELS}")
+    copy_run("runs/sample3.txt", "runs/shuffled.txt", shuffle=True)
+    in_memory = evaluate_metrics(FAMILY, qrels, load_run("runs/sample3.txt"))
+    scores = evaluate_stream(FAMILY, qrels, "runs/shuffled.txt", MEMORY_MB)
+    pd.testing.assert_frame_equal(scores, in_memory)
+
+
+def read_fused(path):
+    df = pd.read_csv(path, sep=" ", names=COLUMNS, dtype={"query": str})
+    return df.sort_values(["query", "rank"]).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+@pytest.mark.parametrize(
+    "options",
+    [
+        {"method": "rrf", "k": 60, "max_docs": 100},
+        {"method": "combsum", "norm": "zscore", "weights": [1.0, 0.5, 2.0]},
+        {"method": "combmnz", "norm": "minmax", "max_docs": 50},
+    ],
+)
+def test_fuse_stream_matches_memory(workspace, shuffle, options):
+    paths = []
+    for run in RUNS:
+        paths.append(f"runs/stream_{run}")
+        copy_run(f"runs/{run}", paths[-1], shuffle)
+    tag = fusion_tag(options["method"])
+    fuse_stream(paths, "runs/streamed.txt", tag, MEMORY_MB, **options)
+    fused = fuse([load_run(f"runs/{run}") for run in RUNS], **options)
+    write_run(fused, "runs/fused.txt", tag)
+
+    streamed, expected = read_fused("runs/streamed.txt"), read_fused("runs/fused.txt")
+    pd.testing.assert_frame_equal(streamed, expected)
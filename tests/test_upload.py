@@ -0,0 +1,117 @@
+import gzip
+import os
+
+import numpy as np
+import pytest
+from flask import Flask
+
+import upload
+from runstore import load_run
+
+CHUNK = 50000
+
+
+@pytest.fixture
+def client(workspace):
+    upload._uploads.clear()
+    app = Flask(__name__)
+    app.register_blueprint(upload.upload_blueprint)
+    return app.test_client()
+
+
+def upload_state():
+    # Upload state left in runs/: part files, builders and locks.
+    return [
+        name
+        for name in sorted(os.listdir("runs"))
+        if name.endswith((".part", ".build", ".lock"))
+    ]
+
+
+def send(client, name, data, processes=False):
+    # Chunks at the offsets the server returns; with processes, every chunk
+    # lands on a server process that has not seen the upload yet.
+    offset = 0
+    for start in range(0, len(data), CHUNK):
+        response = client.post(
+            f"/upload/{name}?offset={offset}", data=data[start : start + CHUNK]
+        )
+        assert response.status_code == 200
+        offset = response.json["offset"]
+        if processes:
+            upload._uploads.pop(name)
+    return offset
+
+
+def assert_same_run(path, original):
+    run, expected = load_run(path), load_run(original)
+    np.testing.assert_array_equal(run.topics, expected.topics)
+    np.testing.assert_array_equal(
+        run.table.lookup(run.docid), expected.table.lookup(expected.docid)
+    )
+    np.testing.assert_array_equal(run.score, expected.score)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize("processes", [False, True])
+def test_upload_complete(client, compress, processes):
+    with open("runs/sample1.txt", "rb") as f:
+        data = f.read()
+    name = "up.txt.gz" if compress else "up.txt"
+    blob = gzip.compress(data) if compress else data
+
+    assert send(client, name, blob, processes) == len(blob)
+    response = client.post(f"/upload/{name}/complete")
+    assert response.status_code == 200
+    original = load_run("runs/sample1.txt")
+    rows, topics = len(original.docid), len(original.topics)
+    assert response.json == {"name": name, "rows": rows, "topics": topics}
+    assert_same_run(f"runs/{name}", "runs/sample1.txt")
+    assert upload_state() == []
+
+
+def test_resume(client):
+    with open("runs/sample2.txt", "rb") as f:
+        data = f.read()
+    client.post("/upload/up.txt?offset=0", data=data[:CHUNK])
+
+    # A client that lost track asks where to go on.
+    upload._uploads.clear()
+    assert client.get("/upload/up.txt").json == {"offset": CHUNK}
+    response = client.post("/upload/up.txt?offset=0", data=data[:CHUNK])
+    assert response.status_code == 409
+    assert response.json == {"offset": CHUNK}
+
+    # Bytes appended after the last saved state are parsed on resume.
+    with open("runs/.up.txt.part", "ab") as f:
+        f.write(data[CHUNK : 2 * CHUNK])
+    upload._uploads.clear()
+    assert client.get("/upload/up.txt").json == {"offset": 2 * CHUNK}
+    client.post(f"/upload/up.txt?offset={2 * CHUNK}", data=data[2 * CHUNK :])
+    assert client.post("/upload/up.txt/complete").status_code == 200
+    assert_same_run("runs/up.txt", "runs/sample2.txt")
+    assert upload_state() == []
+
+
+def test_invalid_run(client):
+    response = client.post("/upload/bad.txt?offset=0", data=b"1 Q0 a one 1.0 r\n")
+    assert response.status_code == 400
+    assert "not a TREC run" in response.json["error"]
+    assert not os.path.exists("runs/bad.txt")
+    assert upload_state() == []
+
+
+def test_invalid_compressed_run(client):
+    data = gzip.compress(b"1 Q0 a 1 1.0 r\n" * 1000)[:-20]
+    assert client.post("/upload/bad.txt.gz?offset=0", data=data).status_code == 200
+    response = client.post("/upload/bad.txt.gz/complete")
+    assert response.status_code == 400
+    assert not os.path.exists("runs/bad.txt.gz")
+    assert upload_state() == []
+
+
+def test_nothing_to_complete(client):
+    assert client.get("/upload/none.txt").json == {"offset": 0}
+    assert client.post("/upload/none.txt/complete").status_code == 400
+    assert client.post("/upload/.hidden?offset=0", data=b"").status_code == 400
+    assert upload_state() == []